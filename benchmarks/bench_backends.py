@@ -0,0 +1,36 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# Wall clock time of raster.py for every backend and number of jobs, e.g.
+#   python benchmarks/bench_backends.py -s mirror_scene2 -j 1 2 4 8
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run(scene, backend, num_jobs, num_samples, tile_size, output):
+    command = [sys.executable, 'raster.py', '-s', scene, '-n', str(num_samples), '-j', str(num_jobs),
+               '--backend', backend, '--tile_size', str(tile_size), '-o', output]
+    start = time.perf_counter()
+    subprocess.run(command, cwd=root, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the rendering backends")
+    parser.add_argument('-s', '--scene', type=str, help='Scene name', default='ball_scene')
+    parser.add_argument('-n', '--num_samples', type=int, help='Number of samples per pixel', default=1)
+    parser.add_argument('-j', '--num_jobs', type=int, nargs='+', help='Numbers of jobs to test', default=[1, 2, 4])
+    parser.add_argument('--tile_size', type=int, help='Tile size in pixels', default=16)
+    parser.add_argument('-o', '--output', type=str, help='Scratch output image', default='/tmp/bench_backends.png')
+    args = parser.parse_args()
+
+    serial = run(args.scene, 'serial', 1, args.num_samples, args.tile_size, args.output)
+    print(f"{'backend':>8} {'jobs':>4} {'seconds':>8} {'speedup':>7}")
+    print(f"{'serial':>8} {1:>4} {serial:8.2f} {1.0:7.2f}")
+    for backend in ('process', 'thread'):
+        for num_jobs in args.num_jobs:
+            if num_jobs <= 1:
+                continue
+            elapsed = run(args.scene, backend, num_jobs, args.num_samples, args.tile_size, args.output)
+            print(f"{backend:>8} {num_jobs:>4} {elapsed:8.2f} {serial / elapsed:7.2f}")
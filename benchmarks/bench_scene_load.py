@@ -0,0 +1,71 @@
+import os
+import sys
+import json
+import shutil
+import time
+import argparse
+
+import numpy as np
+
+# Load time of a scene with many spheres: one Ball per sphere built by a
+# Python loop, as a scene module would, against a scene file with the
+# spheres in .npy sidecars (first load, building the BVH into the cache,
+# and the following ones, memory mapping it), e.g.
+#   python benchmarks/bench_scene_load.py -n 10000 100000
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+from src.base import BaseScene, Color
+from src.vector3d import Vector3D
+from src.shapes import Ball
+from src.materials import SimpleMaterial
+from src.scene_file import load_scene
+
+def write_scene(directory, num_spheres, seed=0):
+    rng = np.random.default_rng(seed)
+    np.save(os.path.join(directory, 'centers.npy'), rng.uniform(-50, 50, (num_spheres, 3)))
+    np.save(os.path.join(directory, 'radii.npy'), rng.uniform(0.05, 0.2, num_spheres))
+    material = {'type': 'SimpleMaterial', 'args': [0.1, 0.8, {'rgb': [0.8, 0.2, 0.2]}, 0.2, {'rgb': [1, 1, 1]}]}
+    data = {'format': 1, 'name': f"{num_spheres} spheres",
+            'objects': [{'shape': {'type': 'SphereSet', 'centers': {'npy': 'centers.npy'}, 'radii': {'npy': 'radii.npy'}},
+                         'material': material}]}
+    path = os.path.join(directory, 'spheres.json')
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    return path
+
+def module_load(directory):
+    # what a scene module does: one object per sphere
+    centers = np.load(os.path.join(directory, 'centers.npy')).tolist()
+    radii = np.load(os.path.join(directory, 'radii.npy')).tolist()
+    start = time.perf_counter()
+    scene = BaseScene("spheres")
+    material = SimpleMaterial(0.1, 0.8, Color(0.8, 0.2, 0.2), 0.2, Color(1, 1, 1))
+    for (x, y, z), r in zip(centers, radii):
+        scene.add(Ball(Vector3D(x, y, z), r), material)
+    return time.perf_counter() - start
+
+def file_load(path):
+    start = time.perf_counter()
+    load_scene(path)
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of loading scenes with many spheres")
+    parser.add_argument('-n', '--num_spheres', type=int, nargs='+', help='Numbers of spheres to test', default=[10000, 100000])
+    parser.add_argument('-d', '--directory', type=str, help='Scratch directory for the scenes and the cache', default='/tmp/bench_scene_load')
+    args = parser.parse_args()
+
+    print(f"{'spheres':>9} {'module':>8} {'file, build':>12} {'file, cached':>13}")
+    for num_spheres in args.num_spheres:
+        directory = os.path.join(args.directory, str(num_spheres))
+        os.makedirs(directory, exist_ok=True)
+        path = write_scene(directory, num_spheres)
+        cache = os.path.join(directory, 'cache')
+        shutil.rmtree(cache, ignore_errors=True)
+        os.environ['RAYTRACER_ACCEL_CACHE'] = cache
+        module = module_load(directory)
+        build = file_load(path)
+        cached = file_load(path)
+        print(f"{num_spheres:>9} {module:8.2f} {build:12.2f} {cached:13.3f}")
@@ -0,0 +1,66 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Startup cost of raster.py: the slowest imports from python -X importtime
+# and the wall time from interpreter start to the first traced ray, e.g.
+#   python benchmarks/bench_startup.py --save startup_baseline.json
+#   python benchmarks/bench_startup.py --baseline startup_baseline.json
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+first_ray = """
+import importlib, raster
+scene = importlib.import_module({scene!r}).Scene()
+scene.hit(scene.camera.ray(0.5, 0.5))
+"""
+
+def import_times():
+    # cumulative microseconds per imported module
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import raster'],
+                            cwd=root, check=True, capture_output=True, text=True)
+    times = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+def time_to_first_ray(scene, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', first_ray.format(scene=scene)], cwd=root, check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the startup time of raster.py")
+    parser.add_argument('-s', '--scene', type=str, help='Scene name', default='ball_scene')
+    parser.add_argument('-r', '--repeat', type=int, help='Runs, the best one is reported', default=5)
+    parser.add_argument('--top', type=int, help='Number of slowest imports to show', default=10)
+    parser.add_argument('--save', type=str, help='Write the measurements to this JSON file', default=None)
+    parser.add_argument('--baseline', type=str, help='Compare with the measurements of this JSON file', default=None)
+    args = parser.parse_args()
+
+    times = import_times()
+    first = time_to_first_ray(args.scene, args.repeat)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(f"{'module':<40} {'ms':>8} {'baseline':>9}")
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[:args.top]:
+        before = f"{baseline['imports'].get(name, 0) / 1000:9.1f}" if baseline else ''
+        print(f"{name:<40} {cumulative / 1000:8.1f} {before}")
+    before = f"{baseline['first_ray'] * 1000:9.1f}" if baseline else ''
+    print(f"{'time to first ray':<40} {first * 1000:8.1f} {before}")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'scene': args.scene, 'first_ray': first, 'imports': times}, f, indent=1)
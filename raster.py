@@ -1,84 +1,602 @@
+import os
+import sys
+import time
+import queue
 import random
+import subprocess
 import argparse
 import importlib
-from itertools import product
+from array import array
 from functools import partial
+from contextlib import nullcontext
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
-from tqdm import tqdm
-import matplotlib.pyplot as plt
-
+# NumPy, tqdm and the modules built on NumPy are imported where they are
+# needed, so small renders (and spawned workers) start quickly
 from src.base import Color
+from src.visibility_cache import VisibilityCache
+from src.irradiance_cache import IrradianceCache
+from src.light import PointLight
+from src.shading import ShadingContext, trace_shadow_packets, trace_secondary_rays
+from src.image_io import write_image, read_image
+from src import sampling
+from src.sampling import rng
 
 class Context:
     def __init__(self, **kwargs):
         self.__dict__.update(kwargs)
 
+class NoProgress:
+    # stands in for tqdm when no progress is shown
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def update(self, n=1):
+        pass
+
+    def refresh(self):
+        pass
+
+def progress_bar(total, show=True):
+    if not show:
+        return NoProgress()
+    from tqdm import tqdm
+    return tqdm(total=total)
+
+# per-process rendering context, set once by the pool initializer so the
+# scene (and its caches) lives in the worker instead of being pickled with
+# every task
+worker_context = None
+
+def init_worker(context):
+    global worker_context
+    worker_context = context
+    # forked workers would otherwise share the parent's random state
+    sampling.seed(None)
+
+def render_task(render, ij):
+    return render(worker_context, ij)
+
+def process_pool(context, num_jobs):
+    # worker processes, each with its own copy of the context
+    return Pool(num_jobs, initializer=init_worker, initargs=(context,))
+
+def run_tasks(context, render, tasks, backend, num_jobs, pool=None):
+    # render(context, task) for every task, serially, in a pool of threads
+    # sharing the scene, or in a pool of worker processes (the given pool,
+    # initialized with this context, which is then left open)
+    if backend == 'serial' or num_jobs <= 1:
+        yield from map(partial(render, context), tasks)
+    elif backend == 'thread':
+        with ThreadPoolExecutor(num_jobs) as executor:
+            yield from executor.map(partial(render, context), tasks)
+    elif pool is not None:
+        yield from pool.imap(partial(render_task, render), tasks)
+    else:
+        with process_pool(context, num_jobs) as pool:
+            yield from pool.imap(partial(render_task, render), tasks)
+
+def run_scheduled(context, render, scheduler, backend, num_jobs, pool=None):
+    # like run_tasks, but tasks are pulled from the scheduler one at a time
+    # as workers become free, so it can still reorder and split them
+    if backend == 'serial' or num_jobs <= 1:
+        while (task := scheduler.next()) is not None:
+            yield render(context, task)
+        return
+    done = queue.Queue()
+    # a pool passed in stays open for its owner
+    owned = backend == 'thread' or pool is None
+    if backend == 'thread':
+        pool = ThreadPoolExecutor(num_jobs)
+        def submit(task):
+            future = pool.submit(render, context, task)
+            future.add_done_callback(lambda f: done.put((f.exception(), None if f.exception() else f.result())))
+    else:
+        if owned:
+            pool = process_pool(context, num_jobs)
+        def submit(task):
+            pool.apply_async(render_task, (render, task), callback=lambda r: done.put((None, r)),
+                             error_callback=lambda e: done.put((e, None)))
+    with pool if owned else nullcontext():
+        in_flight = 0
+        while True:
+            # one task per worker, the rest stays with the scheduler
+            while in_flight < num_jobs and (task := scheduler.next()) is not None:
+                submit(task)
+                in_flight += 1
+            if in_flight == 0:
+                break
+            error, result = done.get()
+            in_flight -= 1
+            if error is not None:
+                raise error
+            yield result
+
+def estimate_cost_row(context, i):
+    # time one sample every stride-th pixel of row i
+    costs = []
+    _, _, j0, j1 = context.region
+    for j in range(j0, j1, context.cost_stride):
+        start = time.perf_counter()
+        render_pixel(context.estimate, (i, j))
+        costs.append(time.perf_counter() - start)
+    return costs
+
+def make_tiles(img_height, img_width, tile_size, region=None):
+    # (i0, i1, j0, j1) row and column ranges covering the image, or only
+    # the (i0, i1, j0, j1) region of it
+    i0, i1, j0, j1 = region or (0, img_height, 0, img_width)
+    return [(i, min(i + tile_size, i1), j, min(j + tile_size, j1))
+            for i in range(i0, i1, tile_size)
+            for j in range(j0, j1, tile_size)]
+
+def parse_crop(text):
+    # x0,y0,x1,y1 in pixels, y up from the bottom row like the camera
+    x0, y0, x1, y1 = (int(v) for v in text.split(','))
+    return x0, y0, x1, y1
+
+def crop_region(crop, img_height, img_width):
+    # (i0, i1, j0, j1) rows and columns of the crop, clamped to the frame
+    if crop is None:
+        return (0, img_height, 0, img_width)
+    x0, y0, x1, y1 = crop
+    region = (max(0, y0), min(img_height, y1), max(0, x0), min(img_width, x1))
+    if region[0] >= region[1] or region[2] >= region[3]:
+        raise ValueError(f"crop {crop} is outside of the {img_width}x{img_height} frame")
+    return region
+
+def load_scene(name):
+    # a scene module (ball_scene) or a declarative scene file (scene.json)
+    if name.endswith('.json'):
+        from src.scene_file import load_scene as load_scene_file
+        return load_scene_file(name)
+    return importlib.import_module(name).Scene()
+
+def scale_camera(scene, scale):
+    # another resolution with the same field of view and framing
+    camera = scene.camera
+    scene.camera = camera.updated(img_width=max(1, round(camera.img_width * scale)),
+                                  img_height=max(1, round(camera.img_height * scale)))
+
+def save_image(args, image, img_width, img_height, region, composite=None):
+    # the whole frame, the crop alone, or the crop pasted into composite,
+    # the pixels of a previous render (args.composite) read by main
+    i0, i1, j0, j1 = region
+    if composite is not None:
+        base = array('d', composite)
+        for i in range(i0, i1):
+            start, end = 3 * (i * img_width + j0), 3 * (i * img_width + j1)
+            base[start:end] = image[start:end]
+        write_image(args.output, base, img_width, img_height)
+    elif args.crop:
+        pixels = array('d')
+        for i in range(i0, i1):
+            pixels.extend(image[3 * (i * img_width + j0):3 * (i * img_width + j1)])
+        write_image(args.output, pixels, j1 - j0, i1 - i0)
+    else:
+        write_image(args.output, image, img_width, img_height)
+
+def render_tile(context, tile):
+    i0, i1, j0, j1 = tile
+    if context.frustum_culling and context.first_hit is None:
+        # the primary rays of the tile only need the objects in its frustum
+        planes = context.camera.tile_frustum(j0, i0, j1, i1)
+        context = Context(**dict(vars(context), candidates=context.scene.cull(planes)))
+    if context.shadow_packets or context.sort_secondary:
+        return render_tile_deferred(context, tile)
+    return [context.render(context, (i, j)) for i in range(i0, i1) for j in range(j0, j1)]
+
+def render_tile_deferred(context, tile):
+    # primary hits of the whole tile first, then their reflection and
+    # refraction rays in coherent order and their shadow rays in packets per
+    # light, then the shading; every sample continues its random stream
+    # where its primary ray left it
+    i0, i1, j0, j1 = tile
+    scene = context.scene
+    pixels = []
+    hits = []
+    shading = []
+    for i in range(i0, i1):
+        for j in range(j0, j1):
+            samples = []
+            for sample in range(context.first_sample, context.first_sample + context.num_samples):
+                hit_rec = camera_sample(context, i, j, sample)
+                if hit_rec.hit:
+                    hits.append(hit_rec)
+                    if context.shadow_packets and hit_rec.material.shadow_rays:
+                        # the lights are sampled now, as shade() would do first
+                        shading.append(ShadingContext.of(hit_rec, scene))
+                        shading[-1].lights
+                samples.append((hit_rec, sampling.current()))
+            pixels.append((i, j, samples))
+    if context.sort_secondary:
+        secondary = trace_secondary_rays(scene, hits)
+        if context.shadow_packets and all(isinstance(light, PointLight) for light in scene.lights):
+            # point lights draw no random numbers, so the lights of the
+            # secondary hits can be sampled ahead of their shading too
+            shading.extend(ShadingContext.of(hit_rec, scene) for hit_rec in secondary if hit_rec.material.shadow_rays)
+    if context.shadow_packets:
+        trace_shadow_packets(scene, shading)
+
+    results = []
+    for i, j, samples in pixels:
+        pixel = Color(0, 0, 0)
+        for hit_rec, stream in samples:
+            sampling.resume(stream)
+            pixel = pixel + shade_sample(context, hit_rec)
+        results.append((i, j, pixel if context.sums else pixel / context.num_samples))
+    return results
+
+def primary_hit(context, ray, i, j):
+    # camera rays through pixel (i, j) only need the candidates of the pixel
+    # (first hit buffer) or of its tile (frustum culling)
+    if context.first_hit is not None:
+        return context.scene.hit_among(ray, context.first_hit.candidates(i, j))
+    if context.candidates is None:
+        return context.scene.hit(ray)
+    return context.scene.hit_among(ray, context.candidates)
+
+def camera_sample(context, i, j, sample):
+    # random stream of this sample, also used by the camera and lights
+    sampling.begin(context.seed, i * context.camera.img_width + j, sample)
+    # random offset for anti-aliasing
+    dx = rng().uniform(-0.5, 0.5)
+    dy = rng().uniform(-0.5, 0.5)
+    # middle of pixel coordinates
+    x = j + 0.5 + dx
+    y = i + 0.5 + dy
+    # ray from camera
+    ray = context.camera.ray(x, y)
+    # hit ray with scene
+    return primary_hit(context, ray, i, j)
+
+def shade_sample(context, hit_rec):
+    # test if hit something
+    if hit_rec.hit:
+        return hit_rec.material.shade(hit_rec, context.scene)
+    return context.scene.background
+
 def render_pixel(context, ij):
     i, j = ij
     pixel = Color(0, 0, 0)
-    for _ in range(context.num_samples):
-        # random offset for anti-aliasing
-        dx = np.random.uniform(-0.5, 0.5)
-        dy = np.random.uniform(-0.5, 0.5)
-        # middle of pixel coordinates
-        x = j + 0.5 + dx
-        y = i + 0.5 + dy
-        # ray from camera
-        ray = context.camera.ray(x, y)
-        # hit ray with scene
-        hit_rec = context.scene.hit(ray)
-        # test if hit something
-        if hit_rec.hit:
-            # Simple shading: use the red channel as intensity
-            material = hit_rec.material
-            shaded_color = material.shade(hit_rec, context.scene)
-            # this is box filtering!
-            pixel = pixel + shaded_color / context.num_samples
-        else:
-            # this is box filtering!
-            pixel = pixel + context.scene.background / context.num_samples
-    return (i, j, pixel)
+    for sample in range(context.first_sample, context.first_sample + context.num_samples):
+        hit_rec = camera_sample(context, i, j, sample)
+        pixel = pixel + shade_sample(context, hit_rec)
+    # this is box filtering! Summed first and divided once, like the
+    # distributed render adds the sums of its jobs (context.sums, see
+    # render_job), so both do the same float arithmetic
+    if context.sums:
+        return (i, j, pixel)
+    return (i, j, pixel / context.num_samples)
+
+def render_pixel_reprojected(context, ij):
+    i, j = ij
+    # primary ray through the pixel center: validates the reprojected sample
+    # and gives the sample stored for the next frame
+    center_hit = primary_hit(context, context.camera.ray(j + 0.5, i + 0.5), i, j)
+    shape_id = context.shape_ids[center_hit.shape] if center_hit.hit else -1
+    sample = context.reprojected.get(ij)
+    reused = sample is not None and context.reprojection.validate(sample, center_hit, shape_id)
+    if reused:
+        pixel = Color(*sample[2])
+    else:
+        _, _, pixel = render_pixel(context, ij)
+    record = None
+    if center_hit.hit and not center_hit.material.view_dependent:
+        record = (center_hit.point, shape_id)
+    return (i, j, pixel, record, reused)
+
+def irradiance_prepass_row(context, i):
+    # shade every stride-th pixel of row i; worker processes use a fresh
+    # irradiance cache and return the records it created, to be merged by
+    # the main process, while a shared scene fills its cache in place
+    scene = context.scene
+    if not context.shared_scene:
+        scene.irradiance_cache = IrradianceCache(context.irradiance_radius)
+    _, _, j0, j1 = context.region
+    for j in range(j0, j1, context.prepass_stride):
+        sampling.begin(context.seed, i * context.camera.img_width + j, 0)
+        hit_rec = scene.hit(context.camera.ray(j + 0.5, i + 0.5))
+        if hit_rec.hit and not hit_rec.material.view_dependent:
+            hit_rec.material.shade(hit_rec, scene)
+    return [] if context.shared_scene else scene.irradiance_cache.records
+
+def preview_sample(seed, scene, i, j, sample):
+    # one sample of pixel (i, j) with the current camera of the scene
+    context = Context(scene=scene, camera=scene.camera, num_samples=1, first_sample=sample, seed=seed,
+                      frustum_culling=False, candidates=None, first_hit=None, shadow_packets=False,
+                      sort_secondary=False, sums=False)
+    return render_pixel(context, (i, j))[2]
+
+def render_job(context, job):
+    # one tile of a distributed frame, job['samples'] samples per pixel
+    # summed (context.sums), the coordinator divides once by the total
+    import numpy as np
+    context.num_samples = job['samples']
+    context.first_sample = job['first_sample']
+    i0, i1, j0, j1 = job['tile']
+    buffer = np.zeros((i1 - i0, j1 - j0, 3))
+    for i, j, pixel in render_tile(context, job['tile']):
+        buffer[i - i0, j - j0] = pixel.as_list()
+    return buffer
 
-def main(args, pool):
-    # load scene from file args.scene
-    scene = importlib.import_module(args.scene).Scene()
+def setup_worker(hello):
+    # distributed worker: same scene and options as the coordinator
+    options = hello['options']
+    if options['accel_cache']:
+        os.environ['RAYTRACER_ACCEL_CACHE'] = options['accel_cache']
+    scene = load_scene(hello['scene'])
+    if options['scale'] != 1:
+        scale_camera(scene, options['scale'])
+    if options['shadow_cache'] > 0:
+        scene.visibility_cache = VisibilityCache(options['shadow_cache'], options['shadow_cache_size'])
+    context = Context(scene=scene, camera=scene.camera, num_samples=1, first_sample=0, seed=options['seed'],
+                   shared_scene=True, render=render_pixel, frustum_culling=options['frustum_culling'], candidates=None,
+                   first_hit=None, shadow_packets=options['shadow_packets'],
+                   sort_secondary=options['sort_secondary'], sums=True)
+    if options['first_hit_buffer']:
+        from src.first_hit import build
+        context.first_hit = build(scene, scene.camera)
+    return context
+
+def render_distributed(args, img_height, img_width, region):
+    # hand (tile, sample pass) jobs to the workers connected to the
+    # coordinator and return the merged image
+    from src.distributed import Coordinator, make_jobs
+    hello = {'scene': args.scene, 'options': {'seed': args.seed,
+                                              'scale': args.scale,
+                                              'shadow_cache': args.shadow_cache,
+                                              'shadow_cache_size': args.shadow_cache_size,
+                                              'accel_cache': args.accel_cache,
+                                              'frustum_culling': not args.no_frustum_culling,
+                                              'shadow_packets': args.shadow_packets,
+                                              'sort_secondary': args.sort_secondary,
+                                              'first_hit_buffer': args.first_hit_buffer}}
+    tiles = make_tiles(img_height, img_width, args.tile_size, region)
+    jobs = make_jobs(tiles, args.num_samples, args.sample_passes)
+    coordinator = Coordinator(args.coordinator, hello, jobs, img_height, img_width, args.worker_timeout)
+    host, port = coordinator.address
+    print(f"Coordinator listening on {host}:{port}, {len(jobs)} jobs")
+    # stand-in workers on this machine, more can join from other hosts
+    workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', f"{host}:{port}"])
+               for _ in range(args.local_workers)]
+    with progress_bar(len(jobs), not args.quiet) as pbar:
+        image = coordinator.run(pbar.update, workers)
+    for worker in workers:
+        worker.wait()
+    if coordinator.failures:
+        print(f"Reassigned {coordinator.failures} jobs of failed workers")
+    return image
+
+def main(args, parser):
+    if args.worker:
+        from src.distributed import run_worker
+        run_worker(args.worker, setup_worker, render_job)
+        return
+
+    # on-disk cache for meshes and their BVHs, also seen by the workers
+    if args.accel_cache:
+        os.environ['RAYTRACER_ACCEL_CACHE'] = args.accel_cache
+
+    # load scene from module or scene file args.scene
+    scene = load_scene(args.scene)
+    if args.scale != 1:
+        scale_camera(scene, args.scale)
     camera = scene.camera
     img_width = camera.img_width
     img_height = camera.img_height
-    image = np.zeros((img_height, img_width, 3)) # create tensor for image: RGB
+    image = array('d', bytes(8 * 3 * img_width * img_height)) # RGB rows, bottom row first
+    # rows and columns to render: the whole frame or the crop
+    try:
+        region = crop_region(args.crop, img_height, img_width)
+    except ValueError as error:
+        parser.error(f"--crop: {error}")
+    i0, i1, j0, j1 = region
+
+    # the previous render the crop is pasted into, checked before rendering
+    # so a wrong file does not throw the render away
+    composite = None
+    if args.composite:
+        try:
+            composite, width, height = read_image(args.composite)
+        except (OSError, ValueError) as error:
+            parser.error(f"--composite: cannot read {args.composite}: {error}")
+        if (width, height) != (img_width, img_height):
+            parser.error(f"--composite: {args.composite} is {width}x{height}, the frame is {img_width}x{img_height}")
+
+    if args.coordinator:
+        image = render_distributed(args, img_height, img_width, region)
+        save_image(args, array('d', image.ravel().tolist()), img_width, img_height, region, composite)
+        return
 
     # for each pixel, determine if it is inside any primitive in the scene
-    # use cartesian product for efficiency
+    # the image is split in tiles, the unit of work of the backends
     print("Rendering... with anti-aliasing samples:", args.num_samples)
-    context = Context(scene=scene, camera=camera, num_samples=args.num_samples)
-    with tqdm(total=img_height*img_width) as pbar:
-        if args.num_jobs <= 1:
-            for i, j in product(range(img_height), range(img_width)):
-                _, _, pixel = render_pixel(context, (i, j))
-                image[i, j] = np.clip(pixel.as_list(), 0, 1)
-                pbar.update(1)
-                pbar.refresh()
+    if args.num_jobs <= 1:
+        args.backend = 'serial'
+    # threads (and the serial loop) share one scene instance and its caches
+    shared_scene = args.backend != 'process'
+    context = Context(scene=scene, camera=camera, num_samples=args.num_samples, first_sample=0, seed=args.seed,
+                      shared_scene=shared_scene, region=region, frustum_culling=not args.no_frustum_culling,
+                      candidates=None, first_hit=None, shadow_packets=args.shadow_packets,
+                      sort_secondary=args.sort_secondary, sums=False)
+    render = render_pixel
+
+    # temporal reprojection: reuse view-independent shading of the previous
+    # frame stored in args.reproject (camera-only animations)
+    new_cache = None
+    if args.reproject:
+        if not hasattr(camera, 'project'):
+            print("Reprojection cache needs a pinhole Camera, disabled")
         else:
-            for i, j, pixel in pool.imap(partial(render_pixel, context), product(range(img_height), range(img_width))):
-                image[i, j] = np.clip(pixel.as_list(), 0, 1)
+            from src.reprojection import ReprojectionCache
+            old_cache = ReprojectionCache.load(args.reproject)
+            new_cache = ReprojectionCache(args.reproject_tolerance)
+            context.reprojection = old_cache or new_cache
+            # index of every shape in the scene, looked up per pixel; keyed by
+            # the shapes themselves (hashed by identity) rather than id(), so
+            # the map stays valid in the workers that unpickle the context
+            context.shape_ids = {shape: k for k, shape in enumerate(scene.shapes)}
+            context.reprojected = old_cache.reproject(camera) if old_cache else {}
+            render = render_pixel_reprojected
+
+    # primary rays test the shapes whose projected bounds cover their pixel
+    if args.first_hit_buffer:
+        from src.first_hit import build
+        context.first_hit = build(scene, camera)
+        if context.first_hit is None:
+            print("First hit buffer needs a pinhole Camera, disabled")
+
+    # shadow rays toward point lights answered from a per-process cache
+    # (shared by all threads of the thread backend)
+    if args.shadow_cache > 0:
+        scene.visibility_cache = VisibilityCache(args.shadow_cache, args.shadow_cache_size)
+
+    # interactive preview: threads keep rendering the same scene instance,
+    # modified in place by the commands
+    if args.preview:
+        from src.preview import Preview
+        preview = Preview(scene, partial(preview_sample, args.seed), args.output, args.num_jobs, args.num_samples, args.tile_size)
+        preview.roi = args.crop
+        preview.run(args.preview_port)
+        return
+
+    # array geometry (meshes) goes to shared memory, attached read-only by
+    # every worker instead of being copied into each of them
+    shared_blocks = []
+    if not shared_scene:
+        from src.shared_geometry import share_scene
+        shared_blocks = share_scene(scene)
+
+    # irradiance cache for diffuse materials, populated by a sparse pre-pass
+    # in parallel workers and merged into one cache shared by the main pass
+    if args.irradiance_cache > 0:
+        context.irradiance_radius = args.irradiance_cache
+        context.prepass_stride = args.prepass_stride
+        cache = IrradianceCache(args.irradiance_cache)
+        if shared_scene:
+            scene.irradiance_cache = cache
+        rows = range(i0, i1, args.prepass_stride)
+        with progress_bar(len(rows), not args.quiet) as pbar:
+            for records in run_tasks(context, irradiance_prepass_row, rows, args.backend, args.num_jobs):
+                cache.merge(records)
+                pbar.update(1)
+        print(f"Irradiance cache: {len(cache)} records from pre-pass")
+        scene.irradiance_cache = cache
+
+    reused = 0
+    context.render = render
+    # shadow packets prepare the tests of render_pixel; the irradiance cache
+    # answers most of them without rays
+    context.shadow_packets = args.shadow_packets and render is render_pixel and args.irradiance_cache <= 0
+    context.sort_secondary = args.sort_secondary and render is render_pixel
+    tiles = make_tiles(img_height, img_width, args.tile_size, region)
+    pool = None
+    if args.schedule == 'cost':
+        # low resolution cost estimate, then most expensive tiles first
+        import numpy as np
+        from src.scheduler import TileScheduler, upsample_costs
+        context.cost_stride = args.cost_stride
+        context.estimate = Context(**dict(vars(context), num_samples=1))
+        if args.backend == 'process':
+            # one pool for both passes: the context (with the scene) is
+            # pickled and set up in every worker once
+            pool = process_pool(context, args.num_jobs)
+        rows = range(i0, i1, args.cost_stride)
+        with progress_bar(len(rows), not args.quiet) as pbar:
+            samples = []
+            for costs in run_tasks(context, estimate_cost_row, rows, args.backend, args.num_jobs, pool):
+                samples.append(costs)
                 pbar.update(1)
-                pbar.refresh()
+        samples = np.array(samples)
+        # cost map of the region, placed in a map of the whole frame
+        costs = np.zeros((img_height, img_width))
+        costs[i0:i1, j0:j1] = upsample_costs(samples, args.cost_stride, i1 - i0, j1 - j0)
+        scheduler = TileScheduler(tiles, costs, args.num_jobs, args.min_tile_size)
+        results = run_scheduled(context, render_tile, scheduler, args.backend, args.num_jobs, pool)
+    else:
+        results = run_tasks(context, render_tile, tiles, args.backend, args.num_jobs)
+    with progress_bar((i1 - i0) * (j1 - j0), not args.quiet) as pbar:
+        for tile in results:
+            for result in tile:
+                i, j, pixel = result[:3]
+                k = 3 * (i * img_width + j)
+                image[k:k + 3] = array('d', pixel.as_list())
+                if new_cache is not None:
+                    record, pixel_reused = result[3:]
+                    if record is not None:
+                        new_cache.add(record[0], record[1], pixel)
+                    reused += pixel_reused
+            pbar.update(len(tile))
+            pbar.refresh()
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    for block in shared_blocks:
+        block.close()
+
+    # with a process pool every worker keeps its own caches and counters
+    if shared_scene and scene.visibility_cache is not None:
+        print(scene.visibility_cache.stats())
+    if shared_scene and scene.light_grid.culling:
+        print(scene.light_grid.stats())
+
+    if new_cache is not None:
+        new_cache.save(args.reproject)
+        print(f"Reprojection: reused {reused} of {(i1 - i0) * (j1 - j0)} pixels")
 
-    # save image as png using matplotlib
-    plt.imsave(args.output, image, vmin=0, vmax=1, origin='lower')
+    # save image, clipped to [0, 1]; png and ppm need no matplotlib
+    save_image(args, image, img_width, img_height, region, composite)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Raster module main function")
-    parser.add_argument('-s', '--scene', type=str, help='Scene name', default='ball_scene')
+    parser.add_argument('-s', '--scene', type=str, help='Scene module name, or a .json scene file', default='ball_scene')
     parser.add_argument('-n', '--num_samples', type=int, help='Number of samples per pixel for anti-aliasing', default=1)
     parser.add_argument('-j', '--num_jobs', type=int, help='Number of parallel jobs for rendering', default=4)
+    parser.add_argument('--seed', type=int, help='Random seed; the image only depends on it, not on the jobs or the backend', default=0)
+    parser.add_argument('--backend', type=str, choices=('process', 'thread', 'serial'), help='Parallel backend: worker processes, threads sharing one scene, or serial', default='process')
+    parser.add_argument('--tile_size', type=int, help='Tile size in pixels, the unit of work of the parallel backends', default=16)
+    parser.add_argument('--schedule', type=str, choices=('static', 'cost'), help='Tile order: static, or most expensive first after a cost estimation pass, splitting tiles at the end of the frame', default='static')
+    parser.add_argument('--cost_stride', type=int, help='Pixel stride of the cost estimation pass', default=8)
+    parser.add_argument('--min_tile_size', type=int, help='Smallest tile side the cost scheduler splits down to', default=4)
+    parser.add_argument('--no_frustum_culling', action='store_true', help='Trace primary rays against every object instead of the objects in the frustum of their tile')
+    parser.add_argument('--shadow_packets', action='store_true', help='Trace the shadow rays of the primary hits of every tile in packets per point light before shading them')
+    parser.add_argument('--sort_secondary', action='store_true', help='Trace the reflection and refraction rays of every tile bounce by bounce, sorted by origin and direction, before shading')
+    parser.add_argument('--first_hit_buffer', action='store_true', help='Rasterize the bounds of the shapes into per-pixel candidate lists for primary rays (pinhole cameras only)')
     parser.add_argument('-o', '--output', type=str, help='Output image file name', default='output.png')
+    parser.add_argument('--crop', type=parse_crop, help='Render only the pixels x0,y0,x1,y1 of the frame (y up from the bottom row, after --scale)', default=None)
+    parser.add_argument('--scale', type=float, help='Resolution scale of the scene camera, same field of view', default=1.0)
+    parser.add_argument('--composite', type=str, help='With --crop, paste the crop into this previous render of the full frame instead of saving the crop alone', default=None)
+    parser.add_argument('-q', '--quiet', action='store_true', help='Do not show progress bars')
+    parser.add_argument('--reproject', type=str, help='Temporal reprojection cache file (.npz), read from the previous frame and rewritten', default=None)
+    parser.add_argument('--reproject_tolerance', type=float, help='Relative distance tolerance to reuse a reprojected sample', default=1e-2)
+    parser.add_argument('--shadow_cache', type=float, help='Cell size of the point light visibility cache (0 disables it)', default=0)
+    parser.add_argument('--shadow_cache_size', type=int, help='Maximum number of entries of the visibility cache', default=100000)
+    parser.add_argument('--irradiance_cache', type=float, help='Maximum record radius of the irradiance cache for diffuse materials (0 disables it)', default=0)
+    parser.add_argument('--prepass_stride', type=int, help='Pixel stride of the irradiance cache pre-pass', default=8)
+    parser.add_argument('--accel_cache', type=str, help='Directory of the on-disk cache for meshes and acceleration structures (default $RAYTRACER_ACCEL_CACHE)', default=None)
+    parser.add_argument('--preview', action='store_true', help='Interactive preview: refine the output image progressively and take commands on stdin (see src/preview.py)')
+    parser.add_argument('--preview_port', type=int, help='Also take preview commands on this local TCP port (0 picks a free one)', default=None)
+    parser.add_argument('--coordinator', type=str, help='Render distributed: listen for workers on host:port (port 0 picks a free one)', default=None)
+    parser.add_argument('--worker', type=str, help='Run as a distributed worker of the coordinator at host:port', default=None)
+    parser.add_argument('--local_workers', type=int, help='Number of workers the coordinator starts on this machine', default=0)
+    parser.add_argument('--sample_passes', type=int, help='Split the samples of every tile over this many distributed jobs', default=1)
+    parser.add_argument('--worker_timeout', type=float, help='Seconds without an answer before a worker is considered failed', default=600)
     args = parser.parse_args()
+    if args.composite and not args.crop:
+        parser.error("--composite needs --crop")
+    if args.coordinator:
+        # the workers only render tiles of the frame
+        unsupported = [name for name, used in (('--reproject', args.reproject),
+                                               ('--irradiance_cache', args.irradiance_cache > 0),
+                                               ('--schedule cost', args.schedule == 'cost'),
+                                               ('--preview', args.preview)) if used]
+        if unsupported:
+            parser.error(f"{', '.join(unsupported)} cannot be used with --coordinator")
 
-    # create a pool of workers for parallel processing
-    pool = Pool(args.num_jobs)
-    main(args, pool)
-    pool.close()
-    pool.join()
\ No newline at end of file
+    main(args, parser)
\ No newline at end of file
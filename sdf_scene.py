@@ -0,0 +1,69 @@
+from src.base import BaseScene, Color
+from src.shapes import PlaneUV
+from src.sdf import (SDFShape, GridSDF, Sphere, Box, Torus, Cylinder, Translate, Repeat,
+                     Union, SmoothUnion, Intersection, Subtraction)
+from src.camera import Camera
+from src.vector3d import Vector3D
+from src.light import PointLight
+from src.materials import SimpleMaterialWithShadows, CheckerboardMaterial
+
+# signed distance field shapes: combinators, repetition and a baked grid
+class Scene(BaseScene):
+    def __init__(self):
+        super().__init__("SDF Scene")
+
+        self.background = Color(0.05, 0.05, 0.05)
+        self.ambient_light = Color(0.1, 0.1, 0.1)
+        self.max_depth = 4
+
+        self.camera = Camera(
+            eye=Vector3D(0.0, -10.0, 3.0),
+            look_at=Vector3D(0.0, 0.0, 0.0),
+            up=Vector3D(0.0, 0.0, 1.0),
+            fov=45,
+            img_width=400,
+            img_height=300
+        )
+
+        self.lights = [
+            PointLight(position=Vector3D(-4.0, -6.0, 6.0), color=Color(1.0, 1.0, 1.0), intensity=1.5),
+            PointLight(position=Vector3D(4.0, -6.0, 6.0), color=Color(1.0, 1.0, 1.0), intensity=1.0)
+        ]
+
+        floor_mat = CheckerboardMaterial(
+            ambient_coefficient=0.1, diffuse_coefficient=0.6, square_size=1.0,
+            white_color=Color(0.7, 0.7, 0.7), black_color=Color(0.2, 0.2, 0.2)
+        )
+        red_mat = SimpleMaterialWithShadows(
+            ambient_coefficient=0.1, diffuse_coefficient=0.8, diffuse_color=Color(0.8, 0.1, 0.05),
+            specular_coefficient=0.6, specular_color=Color(1.0, 0.8, 0.8), specular_shininess=64
+        )
+        metal_mat = SimpleMaterialWithShadows(
+            ambient_coefficient=0.1, diffuse_coefficient=0.5, diffuse_color=Color(0.6, 0.6, 0.7),
+            specular_coefficient=0.9, specular_color=Color(1.0, 1.0, 1.0), specular_shininess=128
+        )
+        green_mat = SimpleMaterialWithShadows(
+            ambient_coefficient=0.1, diffuse_coefficient=0.8, diffuse_color=Color(0.1, 0.6, 0.2),
+            specular_coefficient=0.4, specular_color=Color(1.0, 1.0, 1.0), specular_shininess=32
+        )
+
+        # floor
+        self.add(PlaneUV(point=Vector3D(0, 0, -1.0), normal=Vector3D(0, 0, 1), forward_direction=Vector3D(0, 1, 0)), floor_mat)
+
+        # a torus blended into a sphere
+        blob = SmoothUnion(Sphere(0.7), Torus(1.0, 0.25), 0.4)
+        self.add(SDFShape(Translate(blob, Vector3D(-2.5, 0.0, 0.0))), red_mat)
+
+        # a rounded box with a sphere and a cylinder carved out
+        carved = Subtraction(
+            Intersection(Box(Vector3D(1.6, 1.6, 1.6), rounding=0.1), Sphere(1.05)),
+            Cylinder(0.4, 3.0)
+        )
+        self.add(SDFShape(carved), metal_mat)
+
+        # a row of small spheres, baked into a distance grid
+        spheres = Union(
+            Repeat(Sphere(0.3), Vector3D(0.8, 0.0, 0.0), counts=(1, 0, 0)),
+            Translate(Sphere(0.45), Vector3D(0.0, 0.0, 0.6))
+        )
+        self.add(SDFShape(GridSDF(Translate(spheres, Vector3D(2.5, 0.0, -0.5)), resolution=48)), green_mat)
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Persistent on-disk cache for acceleration structures and parsed geometry.
+#
+# An entry is a directory named after a content hash, with one .npy file per
+# array and a manifest. Entries are loaded with np.load(mmap_mode='r'), so
+# every process that opens the same entry shares the same physical pages.
+# Bump CacheVersion whenever the layout of the cached arrays changes.
+#
+# The cache directory defaults to $RAYTRACER_ACCEL_CACHE; when it is not set
+# geometry is built in memory as usual.
+
+CacheVersion = 2
+
+def default_cache():
+    directory = os.environ.get('RAYTRACER_ACCEL_CACHE')
+    return AccelCache(directory) if directory else None
+
+class AccelCache:
+    def __init__(self, directory):
+        self.directory = directory
+
+    @staticmethod
+    def key(kind, *parts, files=()):
+        # content hash of everything that defines the cached structure
+        digest = hashlib.sha256()
+        digest.update(f"{kind}:{CacheVersion}".encode())
+        for part in parts:
+            digest.update(repr(part).encode())
+        for path in files:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        return f"{kind}-{digest.hexdigest()[:32]}"
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def load(self, key):
+        # dict of read-only memory mapped arrays, None on a miss
+        entry = self.path(key)
+        try:
+            with open(os.path.join(entry, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('version') != CacheVersion:
+            return None
+        return {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in manifest['arrays']}
+
+    def store(self, key, arrays):
+        os.makedirs(self.directory, exist_ok=True)
+        # write into a temporary directory and rename it, so concurrent
+        # writers never expose half written entries
+        tmp = tempfile.mkdtemp(prefix=key + '.', dir=self.directory)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp, name + '.npy'), np.ascontiguousarray(array))
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump({'version': CacheVersion, 'arrays': sorted(arrays)}, f)
+        try:
+            os.rename(tmp, self.path(key))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+        return self.load(key)
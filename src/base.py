@@ -2,8 +2,6 @@ from .ray import Ray
 from .camera import Camera
 from .vector3d import Vector3D
 
-CastEpsilon = 1e-4
-
 class Shape:
     def __init__(self, type):
         self.type = type
@@ -12,6 +10,18 @@ class Shape:
         # Placeholder method for point-in-primitive test
         raise NotImplementedError("in_out method not implemented")
 
+    # Hits are computed in two phases: hit() only finds t (plus whatever
+    # small payload the shape needs later), and finalize() fills in point,
+    # normal and uv for the closest hit, right before shading. Shapes that
+    # compute everything in hit() keep this default.
+    def finalize(self, ray, hit_rec):
+        pass
+
+    # (min corner, max corner) of an axis aligned box around the shape, or
+    # None for unbounded shapes, which are never culled
+    def bounding_box(self):
+        return None
+
 class Color(Vector3D):
     def __init__(self, r, g, b):
         super().__init__(r, g, b)
@@ -43,6 +53,12 @@ class BaseScene:
         self.background = Color(0, 0, 0)
         # ambient light
         self.ambient_light = Color(0.1, 0.1, 0.1)
+        self.lights = list()
+        self._light_grid = None
+        # optional shadow ray cache for point lights (see visibility_cache.py)
+        self.visibility_cache = None
+        # optional irradiance cache for diffuse materials (see irradiance_cache.py)
+        self.irradiance_cache = None
 
         self.camera = Camera(
             eye=Vector3D(0, 0, 5),
@@ -53,6 +69,23 @@ class BaseScene:
             img_height=600
         )
 
+    @property
+    def light_grid(self):
+        # built on first use, and again if the scene replaced its light list
+        if self._light_grid is None or self._light_grid.lights is not self.lights:
+            from .light import LightGrid
+            self._light_grid = LightGrid(self.lights)
+        return self._light_grid
+
+    def invalidate_caches(self):
+        # drop everything derived from lights, materials or geometry, after
+        # they were modified in place
+        self._light_grid = None
+        if self.visibility_cache is not None:
+            self.visibility_cache.clear()
+        if self.irradiance_cache is not None:
+            self.irradiance_cache.clear()
+
     def display(self):
         print(f"Scene: {self.name}")
 
@@ -63,20 +96,66 @@ class BaseScene:
     # add iterator support for primitives zip and colors
     def __iter__(self):
         return iter(zip(self.shapes, self.materials))
-    def hit(self, ray):
-        # check for hits with all shapes
+    def hit(self, ray, finalize=True):
+        # check for hits with all shapes; shadow queries only need to know
+        # whether there is a hit and skip finalize
+        return self.hit_among(ray, zip(self.shapes, self.materials), finalize)
+
+    def occluder_among(self, ray, objects):
+        # the first (shape, material) pair hit within the interval of the
+        # ray, or None: enough for shadow rays, which stop there
+        for shape, material in objects:
+            new_hit = shape.hit(ray)
+            if new_hit.hit and ray.t_min < new_hit.t < ray.t_max:
+                return shape, material
+        return None
+
+    def object_boxes(self):
+        # bounding box (or None) of every shape, for repeated cull() calls
+        return [shape.bounding_box() for shape in self.shapes]
+
+    def cull(self, planes, boxes=None):
+        # (shape, material) pairs that may be inside the convex region
+        # n.p >= c of the planes (nx, ny, nz, c), in scene order
+        if boxes is None:
+            boxes = self.object_boxes()
+        candidates = []
+        for shape, material, box in zip(self.shapes, self.materials, boxes):
+            if box is not None:
+                lo, hi = box
+                outside = False
+                for nx, ny, nz, c in planes:
+                    # the corner of the box furthest along n
+                    far = (nx * (hi.x if nx > 0 else lo.x) + ny * (hi.y if ny > 0 else lo.y)
+                           + nz * (hi.z if nz > 0 else lo.z))
+                    if far < c - 1e-6 * (abs(c) + 1.0):
+                        outside = True
+                        break
+                if outside:
+                    continue
+            candidates.append((shape, material))
+        return candidates
+
+    def hit_among(self, ray, objects, finalize=True):
+        # hit() over some (shape, material) pairs only, e.g. the candidates
+        # of cull() for rays known to stay inside its region
         hit_rec = HitRecord()
-        for shape, material in zip(self.shapes, self.materials):
+        for shape, material in objects:
             new_hit = shape.hit(ray)
-            if new_hit.hit and new_hit.t < hit_rec.t and new_hit.t > CastEpsilon:
+            if new_hit.hit and ray.t_min < new_hit.t < ray.t_max:
                 hit_rec = new_hit
+                # later shapes only need to look closer than this hit
+                ray.t_max = new_hit.t
                 # set material
                 hit_rec.material = material
                 hit_rec.ray = ray
+                hit_rec.shape = shape
+        if finalize and hit_rec.hit:
+            hit_rec.shape.finalize(ray, hit_rec)
         return hit_rec
 
 class HitRecord:
-    def __init__(self, hit=False, t=float('inf'), point=None, normal=None, material=None, ray=None, uv=None):
+    def __init__(self, hit=False, t=float('inf'), point=None, normal=None, material=None, ray=None, uv=None, shape=None, payload=None):
         self.hit = hit
         self.t = t
         self.point = point
@@ -84,11 +163,29 @@ class HitRecord:
         self.material = material
         self.ray = ray
         self.uv = uv
+        self.shape = shape
+        # shape specific data from hit() for finalize()
+        self.payload = payload
+        # ShadingContext, built on demand (see shading.py)
+        self.shading = None
 
 class Material:
+    # True when the shaded color changes with the viewing direction
+    # (specular highlights, reflections, refraction)
+    view_dependent = True
+    # True when shade() tests shadow rays toward the lights in front of the
+    # surface through ShadingContext.shadowed, which a renderer may then
+    # trace beforehand (see trace_shadow_packets in shading.py)
+    shadow_rays = False
+
     def __init__(self):
         pass
 
     def shade(self, hit_record, scene):
         # Placeholder method for shading
-        raise NotImplementedError("shade method not implemented")
\ No newline at end of file
+        raise NotImplementedError("shade method not implemented")
+
+    def secondary_rays(self, hit_record, scene):
+        # reflection and refraction rays shade() follows from this hit, in
+        # the order of ShadingContext.secondary_hits()
+        return []
\ No newline at end of file
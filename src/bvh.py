@@ -0,0 +1,127 @@
+import numpy as np
+
+# Binned SAH bounding volume hierarchy over axis aligned boxes, stored in
+# flat NumPy arrays so it can be cached on disk or shared between processes.
+#
+#   node_bounds  (K, 6) float64  min x, y, z, max x, y, z
+#   node_child   (K,)   int64    index of the first child (the second one
+#                                is node_child + 1), -1 for leaves
+#   node_start   (K,)   int64    first primitive of a leaf in `order`
+#   node_count   (K,)   int64    number of primitives of a leaf
+#   order        (M,)   int64    primitive indices, leaves are contiguous
+
+TraversalCost = 1.0
+IntersectionCost = 1.0
+
+def _area(lo, hi):
+    d = np.maximum(hi - lo, 0.0)
+    return 2.0 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+def _best_split(prim_lo, prim_hi, centroids, bins):
+    # returns (cost, axis, bin, centroid min, centroid extent) of the best
+    # SAH split over the three axes at once, or None
+    c_lo = centroids.min(axis=0)
+    extent = centroids.max(axis=0) - c_lo
+    if not np.any(extent > 0):
+        return None
+    scale = np.divide(bins, extent, out=np.zeros(3), where=extent > 0)
+    ids = np.minimum(((centroids - c_lo) * scale).astype(np.int64), bins - 1)
+
+    # per (axis, bin) bounds with a single sort + reduceat
+    keys = (ids + np.arange(3) * bins).T.ravel()
+    counts = np.bincount(keys, minlength=3 * bins)
+    used = counts > 0
+    starts = (np.cumsum(counts) - counts)[used]
+    order = np.argsort(keys, kind='stable') % len(centroids)
+    bin_lo = np.full((3 * bins, 3), np.inf)
+    bin_hi = np.full((3 * bins, 3), -np.inf)
+    bin_lo[used] = np.minimum.reduceat(prim_lo[order], starts, axis=0)
+    bin_hi[used] = np.maximum.reduceat(prim_hi[order], starts, axis=0)
+    counts = counts.reshape(3, bins)
+    bin_lo = bin_lo.reshape(3, bins, 3)
+    bin_hi = bin_hi.reshape(3, bins, 3)
+
+    # sweep from both sides: split after bin i, i in [0, bins - 2]
+    left_count = np.cumsum(counts, axis=1)[:, :-1]
+    right_count = np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    left_area = _area(np.minimum.accumulate(bin_lo, axis=1)[:, :-1], np.maximum.accumulate(bin_hi, axis=1)[:, :-1])
+    right_area = _area(np.minimum.accumulate(bin_lo[:, ::-1], axis=1)[:, ::-1][:, 1:],
+                       np.maximum.accumulate(bin_hi[:, ::-1], axis=1)[:, ::-1][:, 1:])
+    cost = left_count * left_area + right_count * right_area
+    cost[(left_count == 0) | (right_count == 0)] = np.inf
+    cost[extent <= 0] = np.inf
+
+    axis, i = np.unravel_index(int(np.argmin(cost)), cost.shape)
+    if not np.isfinite(cost[axis, i]):
+        return None
+    return (float(cost[axis, i]), int(axis), int(i), c_lo[axis], extent[axis])
+
+def build_bvh(prim_lo, prim_hi, leaf_size=4, bins=16):
+    # prim_lo, prim_hi: (M, 3) bounds of every primitive
+    prim_lo = np.asarray(prim_lo, dtype=np.float64)
+    prim_hi = np.asarray(prim_hi, dtype=np.float64)
+    centroids = 0.5 * (prim_lo + prim_hi)
+    order = np.arange(len(prim_lo), dtype=np.int64)
+
+    bounds, child, start, count = [], [], [], []
+
+    def new_node():
+        bounds.append(None)
+        child.append(-1)
+        start.append(0)
+        count.append(0)
+        return len(bounds) - 1
+
+    root = new_node()
+    # (node, first, last) ranges of `order`, built depth first
+    stack = [(root, 0, len(order))]
+    while stack:
+        node, first, last = stack.pop()
+        idx = order[first:last]
+        lo = prim_lo[idx].min(axis=0) if len(idx) else np.zeros(3)
+        hi = prim_hi[idx].max(axis=0) if len(idx) else np.zeros(3)
+        bounds[node] = np.concatenate((lo, hi))
+
+        n = last - first
+        split = _best_split(prim_lo[idx], prim_hi[idx], centroids[idx], bins) if n > leaf_size else None
+        if split is not None:
+            cost, axis, i, c_lo, extent = split
+            # SAH: compare against intersecting everything in a leaf
+            leaf_cost = IntersectionCost * n
+            split_cost = TraversalCost + IntersectionCost * cost / max(_area(lo, hi), 1e-30)
+            if split_cost >= leaf_cost and n <= 4 * leaf_size:
+                split = None
+        if split is None and n > 4 * leaf_size:
+            # SAH found nothing (e.g. identical centroids): median split
+            axis = int(np.argmax(hi - lo))
+            split = (0.0, axis, None, None, None)
+
+        if split is None:
+            start[node] = first
+            count[node] = n
+            continue
+
+        _, axis, i, c_lo, extent = split
+        if i is None:
+            mid = first + n // 2
+            part = np.argsort(centroids[idx, axis], kind='stable')
+        else:
+            ids = np.minimum(((centroids[idx, axis] - c_lo) * (bins / extent)).astype(np.int64), bins - 1)
+            left = ids <= i
+            mid = first + int(left.sum())
+            part = np.concatenate((np.nonzero(left)[0], np.nonzero(~left)[0]))
+        order[first:last] = idx[part]
+
+        left_node = new_node()
+        right_node = new_node()
+        child[node] = left_node
+        stack.append((right_node, mid, last))
+        stack.append((left_node, first, mid))
+
+    return {
+        'node_bounds': np.array(bounds, dtype=np.float64).reshape(-1, 6),
+        'node_child': np.array(child, dtype=np.int64),
+        'node_start': np.array(start, dtype=np.int64),
+        'node_count': np.array(count, dtype=np.int64),
+        'order': order,
+    }
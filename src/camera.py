@@ -3,8 +3,37 @@ import math
 
 from .ray import Ray
 
+def frustum_planes(corners, lens):
+    # planes (nx, ny, nz, c), n.p >= c inside, bounding every ray that
+    # starts at a point of the convex lens polygon and goes through the
+    # convex quad of corners (in order). Each side plane goes through an
+    # edge of the quad and leans on the lens point furthest inside, then is
+    # moved back over the whole lens; a side that cannot bound the rays
+    # beyond the quad (a lens wider than the quad allows) is dropped.
+    center = sum(corners[1:], corners[0]) / len(corners)
+    planes = []
+    for a, b in zip(corners, corners[1:] + corners[:1]):
+        # the lens point furthest towards the inside of this side
+        inward = (center - (a + b) * 0.5)
+        apex = max(lens, key=inward.dot)
+        n = (a - apex).cross(b - apex)
+        if n.dot(center - apex) < 0:
+            n = -n
+        length = n.length()
+        if length == 0:
+            continue
+        n = n / length
+        c = min(n.dot(p) for p in lens)
+        # rays leave the lens towards the quad: n.(p - o) >= 0
+        if min(n.dot(p) for p in corners) < max(n.dot(p) for p in lens) - 1e-9:
+            continue
+        planes.append((n.x, n.y, n.z, c))
+    return planes
+
 class Camera:
     def __init__(self, eye, look_at, up, fov, img_width, img_height):
+        # constructor arguments, to derive modified cameras (see updated)
+        self.params = dict(eye=eye, look_at=look_at, up=up, fov=fov, img_width=img_width, img_height=img_height)
         self.eye = eye
         # self.look_at = look_at
         # self.up = up
@@ -17,6 +46,8 @@ class Camera:
 
         self.su = 2 * math.tan(math.radians(fov) / 2)
         self.sv = self.su * aspect_ratio
+        # angle covered by one pixel at the center of the image
+        self.pixel_angle = self.su / img_width
 
         self.w = (eye - look_at).normalize()
         up = up.normalize()
@@ -33,13 +64,36 @@ class Camera:
         # from view plane to world coordinates
         return self.eye + self.u * x_ndc + self.v * y_ndc - self.w
 
+    def project(self, point):
+        # inverse of point_image2world: from world coordinates to
+        # image coordinates, None if the point is behind the camera
+        rel = point - self.eye
+        depth = -rel.dot(self.w)
+        if depth <= 0:
+            return None
+        x_ndc = rel.dot(self.u) / depth
+        y_ndc = rel.dot(self.v) / depth
+        x = (x_ndc + self.su / 2) * self.img_width / self.su
+        y = (y_ndc + self.sv / 2) * self.img_height / self.sv
+        return x, y, depth
+
+    def tile_frustum(self, x0, y0, x1, y1):
+        # planes bounding the rays through the image rectangle [x0, x1] x
+        # [y0, y1], see frustum_planes
+        corners = [self.point_image2world(x, y) for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+        return frustum_planes(corners, [self.eye])
+
+    def updated(self, **changes):
+        # same camera with some constructor arguments changed
+        return type(self)(**dict(self.params, **changes))
+
     def ray(self, x, y):
         point_world = self.point_image2world(x, y)
         direction = (point_world - self.eye).normalize()
         return Ray(self.eye, direction)
 
 import math
-import random
+from src.sampling import rng
 from src.vector3d import Vector3D
 from src.ray import Ray
 
@@ -48,13 +102,17 @@ def random_in_unit_disk() -> Vector3D:
     # Demostración: El método de rechazo genera coordenadas uniformes en el rango [-1, 1].
     # Se descartan los vectores cuya norma al cuadrado supere el radio unitario (x^2 + y^2 >= 1).
     # La distribución resultante es estrictamente uniforme sobre la superficie del disco.
+    uniform = rng().uniform
     while True:
-        p = Vector3D(random.uniform(-1.0, 1.0), random.uniform(-1.0, 1.0), 0.0)
+        p = Vector3D(uniform(-1.0, 1.0), uniform(-1.0, 1.0), 0.0)
         if p.length_squared() < 1.0:
             return p
 
 class ThinLensCamera:
     def __init__(self, eye: Vector3D, look_at: Vector3D, up: Vector3D, fov: float, img_width: int, img_height: int, lens_radius: float, focal_distance: float):
+        # constructor arguments, to derive modified cameras (see updated)
+        self.params = dict(eye=eye, look_at=look_at, up=up, fov=fov, img_width=img_width, img_height=img_height,
+                           lens_radius=lens_radius, focal_distance=focal_distance)
         self.eye = eye
         self.lens_radius = lens_radius
         self.focal_distance = focal_distance
@@ -67,6 +125,8 @@ class ThinLensCamera:
         half_height = math.tan(theta / 2.0)
         aspect_ratio = img_width / img_height
         half_width = aspect_ratio * half_height
+        # angle covered by one pixel at the center of the image
+        self.pixel_angle = 2.0 * half_height / img_height
         
         self.w = (eye - look_at).normalize()
         self.u = up.cross(self.w).normalize()
@@ -94,3 +154,15 @@ class ThinLensCamera:
         
         return Ray(new_origin, new_direction)
 
+    def tile_frustum(self, x0, y0, x1, y1):
+        # rays start anywhere on the lens (bounded by a square) and go
+        # through the focal plane rectangle of [x0, x1] x [y0, y1]
+        corners = [self.lower_left_corner + self.horizontal * (x / self.img_width) + self.vertical * (y / self.img_height)
+                   for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+        r = self.lens_radius
+        lens = [self.eye + self.u * (su * r) + self.v * (sv * r) for su in (-1, 1) for sv in (-1, 1)]
+        return frustum_planes(corners, lens)
+
+    def updated(self, **changes):
+        return type(self)(**dict(self.params, **changes))
+
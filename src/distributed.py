@@ -0,0 +1,201 @@
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+
+import numpy as np
+
+# Multi-node rendering over TCP.
+#
+# The coordinator splits a frame into jobs, one per (tile, sample pass), and
+# hands them to the workers connected to it. Workers load the scene by
+# module name, so only job descriptors and pixel buffers cross the wire:
+#
+#   message  = 4 byte big endian header length, JSON header, payload bytes
+#   hello    coordinator -> worker  {scene, options}
+#   job      coordinator -> worker  {job, tile: [i0, i1, j0, j1], samples, first_sample}
+#   result   worker -> coordinator  {job, shape, samples} + float64 RGB sums
+#   done     coordinator -> worker  {done: true}
+#
+# Results are per pixel sums of the sample colors. They are kept until every
+# job is done, then added up in job order with their sample counts and
+# divided once, so the image does not depend on which worker finished
+# first; with one pass per tile (--sample_passes 1) it is exactly the image
+# of a local render, which sums its samples and divides once as well.
+# A job whose worker disconnects or times out goes back to the queue for
+# another worker; if the workers started on this machine have all exited and
+# no other worker is connected, the render fails instead of waiting forever.
+
+Header = struct.Struct('>I')
+
+def parse_address(address):
+    host, _, port = address.rpartition(':')
+    return (host or 'localhost', int(port))
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("connection closed")
+        data += chunk
+    return bytes(data)
+
+def send_message(sock, header, payload=b''):
+    header = dict(header, payload=len(payload))
+    data = json.dumps(header).encode()
+    sock.sendall(Header.pack(len(data)) + data + payload)
+
+def recv_message(sock):
+    size, = Header.unpack(_recv_exactly(sock, Header.size))
+    header = json.loads(_recv_exactly(sock, size))
+    payload = _recv_exactly(sock, header['payload']) if header['payload'] else b''
+    return header, payload
+
+def make_jobs(tiles, num_samples, sample_passes):
+    # split the samples of every tile over sample_passes jobs
+    # with the sample indices of a local render, so every pass draws from
+    # its own random streams
+    passes = max(1, min(sample_passes, num_samples))
+    jobs = []
+    first_sample = 0
+    for p in range(passes):
+        samples = num_samples // passes + (p < num_samples % passes)
+        for tile in tiles:
+            jobs.append({'job': len(jobs), 'tile': list(tile), 'samples': samples, 'first_sample': first_sample})
+        first_sample += samples
+    return jobs
+
+class Coordinator:
+    def __init__(self, address, hello, jobs, img_height, img_width, timeout=600.0):
+        self.hello = hello
+        self.jobs = jobs
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        for job in jobs:
+            self.queue.put(job)
+        self.remaining = len(jobs)
+        self.finished = threading.Event()
+        self.lock = threading.Lock()
+        self.img_height = img_height
+        self.img_width = img_width
+        # job -> sums of its tile, merged in job order by run()
+        self.results = dict()
+        self.failures = 0
+        # open worker connections
+        self.connections = 0
+        self.server = socket.create_server(parse_address(address))
+        self.address = self.server.getsockname()[:2]
+
+    def merge(self, job, header, payload):
+        i0, i1, j0, j1 = job['tile']
+        buffer = np.frombuffer(payload, dtype=np.float64).reshape(header['shape'])
+        if buffer.shape != (i1 - i0, j1 - j0, 3):
+            raise ValueError("result of the wrong size")
+        with self.lock:
+            if job['job'] in self.results:
+                return
+            self.results[job['job']] = buffer
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.finished.set()
+
+    def serve(self, conn, progress):
+        job = None
+        try:
+            conn.settimeout(self.timeout)
+            send_message(conn, self.hello)
+            while True:
+                try:
+                    job = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    if self.finished.is_set():
+                        break
+                    continue
+                send_message(conn, job)
+                header, payload = recv_message(conn)
+                if header.get('job') != job['job']:
+                    raise ConnectionError("unexpected result")
+                self.merge(job, header, payload)
+                job = None
+                if progress is not None:
+                    progress(1)
+            send_message(conn, {'done': True})
+        except (OSError, ValueError, KeyError):
+            # lost or misbehaving worker: its job is rendered by another one
+            if job is not None:
+                with self.lock:
+                    self.failures += 1
+                self.queue.put(job)
+        finally:
+            conn.close()
+            with self.lock:
+                self.connections -= 1
+
+    def accept(self, progress):
+        self.server.settimeout(0.1)
+        while not self.finished.is_set():
+            try:
+                conn, _ = self.server.accept()
+            except socket.timeout:
+                continue
+            with self.lock:
+                self.connections += 1
+            threading.Thread(target=self.serve, args=(conn, progress), daemon=True).start()
+
+    def run(self, progress=None, local_workers=()):
+        # returns the merged image once every job has a result; local_workers
+        # are the Popen handles of the workers started on this machine
+        acceptor = threading.Thread(target=self.accept, args=(progress,), daemon=True)
+        acceptor.start()
+        failed = False
+        while not self.finished.wait(0.5):
+            with self.lock:
+                connections = self.connections
+            if local_workers and connections == 0 and all(w.poll() is not None for w in local_workers):
+                # nobody left to render the remaining jobs
+                failed = True
+                self.finished.set()
+        acceptor.join()
+        self.server.close()
+        if failed:
+            raise RuntimeError(f"All workers exited with {self.remaining} of {len(self.jobs)} jobs left")
+        accum = np.zeros((self.img_height, self.img_width, 3))
+        weight = np.zeros((self.img_height, self.img_width, 1))
+        for job in self.jobs:
+            i0, i1, j0, j1 = job['tile']
+            accum[i0:i1, j0:j1] += self.results[job['job']]
+            weight[i0:i1, j0:j1] += job['samples']
+        return accum / np.maximum(weight, 1)
+
+def connect(address, retry=30.0):
+    # the coordinator may not be listening yet
+    deadline = time.monotonic() + retry
+    while True:
+        try:
+            return socket.create_connection(parse_address(address))
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+def run_worker(address, setup, render):
+    # setup(hello) -> state, render(state, job) -> (h, w, 3) sums of the
+    # sample colors of every pixel
+    sock = connect(address)
+    try:
+        hello, _ = recv_message(sock)
+        state = setup(hello)
+        while True:
+            job, _ = recv_message(sock)
+            if job.get('done'):
+                break
+            buffer = np.ascontiguousarray(render(state, job), dtype=np.float64)
+            send_message(sock, {'job': job['job'], 'shape': list(buffer.shape), 'samples': job['samples']}, buffer.tobytes())
+    except ConnectionError:
+        # coordinator finished (or went away) while we were rendering
+        pass
+    finally:
+        sock.close()
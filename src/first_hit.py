@@ -0,0 +1,74 @@
+from array import array
+
+import numpy as np
+
+# Rasterized candidate buffer for primary rays of pinhole cameras.
+#
+# Before rendering, the bounding box of every shape is projected into the
+# image in one NumPy pass, and each pixel gets the list of shapes whose
+# projected box covers it (grown by a pixel for the anti-aliasing jitter).
+# Primary rays then only test that list; secondary and shadow rays still
+# go through the whole scene. Shapes without bounds, or with a corner behind
+# the camera, cover every pixel. Pixels with the same list share it, so the
+# buffer is one small integer per pixel plus the distinct lists.
+#
+# Only cameras with project() (the pinhole Camera) can be rasterized; for
+# the others build() returns None and rendering falls back to the tracer.
+
+class FirstHitBuffer:
+    def __init__(self, width, lists, ids):
+        self.width = width
+        # distinct (shape, material) lists, in scene order
+        self.lists = lists
+        # index into lists per pixel, row by row
+        self.ids = ids
+
+    def candidates(self, i, j):
+        return self.lists[self.ids[i * self.width + j]]
+
+def project_boxes(camera, lo, hi):
+    # (x min, x max, y min, y max) in pixels of the projection of every box,
+    # and whether all its corners are in front of the camera
+    corners = np.stack([np.stack([(lo, hi)[a][:, 0], (lo, hi)[b][:, 1], (lo, hi)[c][:, 2]], axis=1)
+                        for a in (0, 1) for b in (0, 1) for c in (0, 1)], axis=1)  # (N, 8, 3)
+    eye = np.array([camera.eye.x, camera.eye.y, camera.eye.z])
+    u, v, w = (np.array([e.x, e.y, e.z]) for e in (camera.u, camera.v, camera.w))
+    rel = corners - eye
+    depth = -(rel @ w)
+    in_front = np.all(depth > 0, axis=1)
+    depth = np.where(depth > 0, depth, 1.0)
+    x = ((rel @ u) / depth + camera.su / 2) * camera.img_width / camera.su
+    y = ((rel @ v) / depth + camera.sv / 2) * camera.img_height / camera.sv
+    return x.min(axis=1), x.max(axis=1), y.min(axis=1), y.max(axis=1), in_front
+
+def build(scene, camera):
+    if not hasattr(camera, 'project') or not scene.shapes:
+        return None
+    width, height = camera.img_width, camera.img_height
+    num_shapes = len(scene.shapes)
+    cover = np.zeros((height, width, num_shapes), dtype=bool)
+
+    boxes = [shape.bounding_box() for shape in scene.shapes]
+    bounded = [k for k, box in enumerate(boxes) if box is not None]
+    unbounded = [k for k, box in enumerate(boxes) if box is None]
+    cover[:, :, unbounded] = True
+    if bounded:
+        lo = np.array([[boxes[k][0].x, boxes[k][0].y, boxes[k][0].z] for k in bounded])
+        hi = np.array([[boxes[k][1].x, boxes[k][1].y, boxes[k][1].z] for k in bounded])
+        x0, x1, y0, y1, in_front = project_boxes(camera, lo, hi)
+        # pixel j takes samples in [j, j + 1]: one pixel of margin
+        j0 = np.clip(np.floor(x0) - 1, 0, width).astype(np.int64)
+        j1 = np.clip(np.ceil(x1) + 1, 0, width).astype(np.int64)
+        i0 = np.clip(np.floor(y0) - 1, 0, height).astype(np.int64)
+        i1 = np.clip(np.ceil(y1) + 1, 0, height).astype(np.int64)
+        for n, k in enumerate(bounded):
+            if in_front[n]:
+                cover[i0[n]:i1[n], j0[n]:j1[n], k] = True
+            else:
+                cover[:, :, k] = True
+
+    # one list per distinct coverage pattern
+    patterns, ids = np.unique(np.packbits(cover.reshape(-1, num_shapes), axis=1), axis=0, return_inverse=True)
+    objects = list(zip(scene.shapes, scene.materials))
+    lists = [[objects[k] for k in np.flatnonzero(np.unpackbits(pattern)[:num_shapes])] for pattern in patterns]
+    return FirstHitBuffer(width, lists, array('i', ids.reshape(-1).tolist()))
@@ -0,0 +1,77 @@
+import os
+import struct
+import zlib
+
+# Minimal image writers, so saving a render does not need matplotlib.
+#
+# Images are flat sequences of RGB values in [0, 1], row by row starting
+# from the bottom row (like plt.imsave(..., origin='lower')). PNG and binary
+# PPM are written directly; any other format goes through matplotlib.
+
+def _rows(pixels, width, height):
+    # 8 bit rows, top row first
+    row_size = 3 * width
+    data = bytes(int(min(max(c, 0.0), 1.0) * 255 + 0.5) for c in pixels)
+    return [data[i * row_size:(i + 1) * row_size] for i in reversed(range(height))]
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+
+def write_png(path, pixels, width, height):
+    # filter type 0 (none) in front of every row
+    raw = b''.join(b'\x00' + row for row in _rows(pixels, width, height))
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(_png_chunk(b'IDAT', zlib.compress(raw, 6)))
+        f.write(_png_chunk(b'IEND', b''))
+
+def write_ppm(path, pixels, width, height):
+    with open(path, 'wb') as f:
+        f.write(b'P6\n%d %d\n255\n' % (width, height))
+        f.write(b''.join(_rows(pixels, width, height)))
+
+def write_image(path, pixels, width, height):
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.png':
+        write_png(path, pixels, width, height)
+    elif ext in ('.ppm', '.pnm'):
+        write_ppm(path, pixels, width, height)
+    else:
+        import numpy as np
+        import matplotlib.pyplot as plt
+        image = np.clip(np.asarray(pixels, dtype=np.float64).reshape(height, width, 3), 0, 1)
+        plt.imsave(path, image, vmin=0, vmax=1, origin='lower')
+
+def read_image(path):
+    # (pixels, width, height) in the layout of write_image
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.ppm', '.pnm'):
+        with open(path, 'rb') as f:
+            data = f.read()
+        # P6 header: magic, width, height, maxval, then one whitespace byte
+        fields = []
+        pos = 0
+        while len(fields) < 4:
+            while data[pos:pos + 1].isspace():
+                pos += 1
+            if data[pos:pos + 1] == b'#':
+                pos = data.index(b'\n', pos)
+                continue
+            end = pos
+            while not data[end:end + 1].isspace():
+                end += 1
+            fields.append(data[pos:end])
+            pos = end
+        width, height, maxval = int(fields[1]), int(fields[2]), int(fields[3])
+        raw = data[pos + 1:pos + 1 + 3 * width * height]
+        row_size = 3 * width
+        rows = [raw[i * row_size:(i + 1) * row_size] for i in reversed(range(height))]
+        return [c / maxval for row in rows for c in row], width, height
+    import matplotlib.pyplot as plt
+    image = plt.imread(path)
+    if image.dtype.kind in 'ui':
+        image = image / float(255)
+    height, width = image.shape[:2]
+    return image[::-1, :, :3].ravel().tolist(), width, height
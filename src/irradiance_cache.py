@@ -0,0 +1,76 @@
+import math
+
+from .base import Color
+
+# World space irradiance cache for diffuse-only materials.
+#
+# Each record stores the direct irradiance (sum of visible light colors
+# weighted by intensity and N.L) computed at a point, its normal and a
+# validity radius. Records live in a uniform grid whose cells are as large as
+# the biggest radius, so a lookup only visits the 27 cells around the query
+# point. Diffuse shading interpolates nearby records and only computes (and
+# inserts) a new one where the cache has no coverage.
+#
+# Records are plain tuples so caches built by different worker processes
+# can be returned to the main process and merged into one shared cache.
+
+class IrradianceCache:
+    def __init__(self, max_radius=0.5, normal_tolerance=0.95):
+        self.max_radius = max_radius
+        # minimum cosine between the query normal and a record normal
+        self.normal_tolerance = normal_tolerance
+        self.records = []
+        self.grid = dict()
+
+    def cell(self, x, y, z):
+        inv = 1.0 / self.max_radius
+        return (math.floor(x * inv), math.floor(y * inv), math.floor(z * inv))
+
+    def insert(self, point, normal, irradiance, radius=None):
+        radius = self.max_radius if radius is None else min(radius, self.max_radius)
+        record = (point.x, point.y, point.z, normal.x, normal.y, normal.z,
+                  irradiance.x, irradiance.y, irradiance.z, radius)
+        self.add_record(record)
+
+    def add_record(self, record):
+        self.records.append(record)
+        self.grid.setdefault(self.cell(*record[:3]), []).append(record)
+
+    def clear(self):
+        self.records = []
+        self.grid = dict()
+
+    def merge(self, records):
+        # records is another cache or a list of record tuples
+        if isinstance(records, IrradianceCache):
+            records = records.records
+        for record in records:
+            self.add_record(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def lookup(self, point, normal):
+        # weighted interpolation of the records covering point, None if there
+        # is no valid record
+        cx, cy, cz = self.cell(point.x, point.y, point.z)
+        total = 0.0
+        r = g = b = 0.0
+        for i in (cx - 1, cx, cx + 1):
+            for j in (cy - 1, cy, cy + 1):
+                for k in (cz - 1, cz, cz + 1):
+                    for record in self.grid.get((i, j, k), ()):
+                        px, py, pz, nx, ny, nz, er, eg, eb, radius = record
+                        if normal.x * nx + normal.y * ny + normal.z * nz < self.normal_tolerance:
+                            continue
+                        dist2 = (point.x - px)**2 + (point.y - py)**2 + (point.z - pz)**2
+                        if dist2 >= radius * radius:
+                            continue
+                        weight = 1.0 - math.sqrt(dist2) / radius
+                        total += weight
+                        r += er * weight
+                        g += eg * weight
+                        b += eb * weight
+        if total <= 0:
+            return None
+        return Color(r / total, g / total, b / total)
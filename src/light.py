@@ -1,15 +1,39 @@
-from random import uniform
+import math
+from .sampling import rng
 from .vector3d import Vector3D
 from .base import Color
 
 class Light:
-    def __init__(self):
-        pass
+    def __init__(self, radius: float = None):
+        # optional influence radius: the light contributes nothing beyond it
+        # and fades smoothly to zero when approaching it
+        self.radius = radius
 
     def position(self):
         raise NotImplementedError("Subclasses should implement this method")
-class PointLight:
-    def __init__(self, position: Vector3D, color: Color, intensity: float = 1.0):
+
+    def extent(self):
+        # half size of the region the light samples positions from
+        return 0.0
+
+    def intensity_at(self, distance):
+        # intensity reaching a point at the given distance, faded by the
+        # influence radius
+        if self.radius is None:
+            return self.intensity
+        return self.intensity * self.attenuation(distance)
+
+    def attenuation(self, distance):
+        if self.radius is None:
+            return 1.0
+        x = distance / self.radius
+        if x >= 1.0:
+            return 0.0
+        return (1.0 - x * x) ** 2
+
+class PointLight(Light):
+    def __init__(self, position: Vector3D, color: Color, intensity: float = 1.0, radius: float = None):
+        super().__init__(radius)
         self.pos = position  # position is a Vector3
         self.color = color  # color is a Color
         self.intensity = intensity  # intensity is a float
@@ -17,8 +41,9 @@ class PointLight:
     def position(self):
         return self.pos
 
-class AreaLight:
-    def __init__(self, position, look_at, up, width, height, color=Color(1, 1, 1), intensity=1.0):
+class AreaLight(Light):
+    def __init__(self, position, look_at, up, width, height, color=Color(1, 1, 1), intensity=1.0, radius=None):
+        super().__init__(radius)
         self.pos = position
         self.color = color
         self.intensity = intensity
@@ -29,12 +54,62 @@ class AreaLight:
         self.u = up.cross(self.w).normalize()
         self.v = self.w.cross(self.u).normalize()
 
+    def extent(self):
+        return 0.5 * (self.su**2 + self.sv**2) ** 0.5
+
     def position(self):
         # from image coordinates to coordinates 
         # in the camera's view plane
+        uniform = rng().uniform
         u, v = uniform(0, 1), uniform(0, 1)
         x = self.su * u - self.su / 2
         y = self.sv * v - self.sv / 2
 
         # from view plane to world coordinates
-        return self.pos + self.u * x + self.v * y
\ No newline at end of file
+        return self.pos + self.u * x + self.v * y
+
+class LightGrid:
+    # Uniform grid over the influence spheres of the lights, so shading only
+    # loops over the lights that can reach a point. Lights without radius
+    # affect every point.
+    def __init__(self, lights, cell_size=None):
+        self.lights = lights
+        self.total_intensity = sum(light.intensity for light in lights)
+        self.global_lights = []
+        self.cells = dict()
+        radii = [light.radius + light.extent() for light in lights if light.radius is not None]
+        self.culling = len(radii) > 0
+        self.cell_size = cell_size or (0.5 * max(radii) if radii else 1.0)
+        # statistics
+        self.queries = 0
+        self.evaluated = 0
+
+        for light_id, light in enumerate(lights):
+            if light.radius is None:
+                self.global_lights.append((light_id, light))
+                continue
+            reach = light.radius + light.extent()
+            lo = self.cell(light.pos - Vector3D(reach, reach, reach))
+            hi = self.cell(light.pos + Vector3D(reach, reach, reach))
+            for i in range(lo[0], hi[0] + 1):
+                for j in range(lo[1], hi[1] + 1):
+                    for k in range(lo[2], hi[2] + 1):
+                        self.cells.setdefault((i, j, k), []).append((light_id, light))
+
+    def cell(self, point):
+        inv = 1.0 / self.cell_size
+        return (math.floor(point.x * inv), math.floor(point.y * inv), math.floor(point.z * inv))
+
+    def lights_at(self, point):
+        # (light_id, light) pairs that may light point, in scene order
+        lights = self.global_lights
+        local = self.cells.get(self.cell(point))
+        if local:
+            lights = sorted(lights + local, key=lambda item: item[0]) if lights else local
+        self.queries += 1
+        self.evaluated += len(lights)
+        return lights
+
+    def stats(self):
+        per_hit = self.evaluated / self.queries if self.queries else 0.0
+        return f"Lights: {per_hit:.2f} of {len(self.lights)} evaluated per hit ({self.queries} hits)"
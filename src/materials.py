@@ -1,10 +1,47 @@
 import math
 
-from .base import Color, CastEpsilon, Material
-from .ray import Ray
+from .base import Color, Material
+from .ray import Ray, CastEpsilon
+from .shading import ShadingContext
+from .textures import CheckerTexture
 from .vector3d import Vector3D
 
+def direct_irradiance(context):
+    # sum of the visible lights weighted by N.L, interpolated from the
+    # scene's irradiance cache when possible
+    cache = context.scene.irradiance_cache
+    irradiance = cache.lookup(context.point, context.normal)
+    if irradiance is not None:
+        return irradiance
+
+    irradiance = Color(0, 0, 0)
+    radius = cache.max_radius
+    for sample in context.lights:
+        # lighting changes faster close to the light
+        radius = min(radius, 0.1 * sample.distance)
+        # no shadow ray for lights behind the surface
+        shadowed = sample.cos <= 0 or context.shadowed(sample)
+        if sample.cos < 0.1 or shadowed:
+            # grazing or shadowed: probably close to a terminator or to a
+            # shadow edge, keep the record local
+            radius = min(radius, 0.25 * cache.max_radius)
+        if not shadowed:
+            irradiance += sample.light.color * (sample.cos * sample.intensity)
+
+    cache.insert(context.point, context.normal, irradiance, radius)
+    return irradiance
+
+def shade_diffuse_cached(material, diffuse_color, context):
+    # same result as the per light loop of the shadowed materials without
+    # specular: ambient once per light plus diffuse_color @ irradiance
+    intensity = context.scene.light_grid.total_intensity
+    amb_color = context.scene.ambient_light * (material.ambient_coefficient * intensity)
+    irradiance = direct_irradiance(context)
+    return amb_color + (diffuse_color @ irradiance) * material.diffuse_coefficient
+
 class ColorMaterial(Material):
+    view_dependent = False
+
     def __init__(self,
                 diffuse_color: Color,
     ):
@@ -31,104 +68,88 @@ class SimpleMaterial(Material):
         self.specular_color = specular_color
         self.specular_shininess = specular_shininess
 
-    def shade(self, hit_record, scene):
-        shaded_color = Color(0, 0, 0)
-        # Ambient component
-        amb_color = scene.ambient_light * self.ambient_coefficient 
-        for light in scene.lights:
-            light_vector = light.position() - hit_record.point
+    @property
+    def view_dependent(self):
+        return self.specular_coefficient > 0
+
+    def specular(self, context, sample):
+        # Phong lobe around the reflected view vector
+        spec_intensity = max(context.reflect_dir.dot(sample.direction), 0) ** self.specular_shininess
+        return (self.specular_color @ sample.light.color) * (self.specular_coefficient * spec_intensity)
 
+    def shade(self, hit_record, scene):
+        context = ShadingContext.of(hit_record, scene)
+        # Ambient component, once per light of the scene
+        shaded_color = scene.ambient_light * (self.ambient_coefficient * scene.light_grid.total_intensity)
+        for sample in context.lights:
             # Diffuse component
-            light_dir = light_vector.normalize()
-            diff_intensity = max(hit_record.normal.dot(light_dir), 0)
-            diff_color = (self.diffuse_color @ light.color) * (self.diffuse_coefficient * diff_intensity)
+            diff_intensity = max(sample.cos, 0)
+            diff_color = (self.diffuse_color @ sample.light.color) * (self.diffuse_coefficient * diff_intensity)
 
             # Specular component
-            view_dir = (scene.camera.eye - hit_record.point).normalize()
-            reflect_dir = (hit_record.normal * 2 * hit_record.normal.dot(light_dir) - light_dir).normalize()
-            spec_intensity = max(view_dir.dot(reflect_dir), 0) ** self.specular_shininess
-            spec_color = (self.specular_color @ light.color) * self.specular_coefficient * spec_intensity
+            spec_color = self.specular(context, sample)
 
             # Accumulate color contributions
-            shaded_color += (amb_color + diff_color + spec_color) * light.intensity
+            shaded_color += (diff_color + spec_color) * sample.intensity
 
         return shaded_color
 
 class SimpleMaterialWithShadows(SimpleMaterial):
+    shadow_rays = True
+
     def __init__(self, ambient_coefficient: float, diffuse_coefficient: float, diffuse_color: Color, specular_coefficient: float, specular_color: Color, specular_shininess: float = 32):
         super().__init__(ambient_coefficient, diffuse_coefficient, diffuse_color, specular_coefficient, specular_color, specular_shininess)
 
-    def shade(self, hit_record, scene):
-        shaded_color = Color(0, 0, 0)
-        # Ambient component
-        amb_color = scene.ambient_light * self.ambient_coefficient 
-        for light in scene.lights:
-            light_vector = light.position() - hit_record.point
+    def surface_color(self, hit_record, scene):
+        # diffuse color at the hit, computed once for all the lights
+        return self.diffuse_color
 
-            # add ambient component once
-            shaded_color += amb_color * light.intensity
+    def shade(self, hit_record, scene):
+        context = ShadingContext.of(hit_record, scene)
+        diffuse_color = self.surface_color(hit_record, scene)
+        if scene.irradiance_cache is not None and not self.view_dependent:
+            return shade_diffuse_cached(self, diffuse_color, context)
+
+        # Ambient component, once per light of the scene
+        shaded_color = scene.ambient_light * (self.ambient_coefficient * scene.light_grid.total_intensity)
+        for sample in context.lights:
+            # Light behind the surface: no shadow ray needed
+            if sample.cos <= 0:
+                continue
 
             # Shadow check
-            shadow_ray = Ray(hit_record.point + hit_record.normal * CastEpsilon, light_vector.normalize())
-            shadow_hit = scene.hit(shadow_ray)
-            if shadow_hit.hit and shadow_hit.t < light_vector.length():
+            if context.shadowed(sample):
                 continue  # In shadow, skip this light
 
             # Diffuse component
-            light_dir = light_vector.normalize()
-            diff_intensity = max(hit_record.normal.dot(light_dir), 0)
-            diff_color = (self.diffuse_color @ light.color) * (self.diffuse_coefficient * diff_intensity)
+            diff_color = (diffuse_color @ sample.light.color) * (self.diffuse_coefficient * sample.cos)
 
             # Specular component
-            view_dir = (scene.camera.eye - hit_record.point).normalize()
-            reflect_dir = (hit_record.normal * 2 * hit_record.normal.dot(light_dir) - light_dir).normalize()
-            spec_intensity = max(view_dir.dot(reflect_dir), 0) ** self.specular_shininess
-            spec_color = (self.specular_color @ light.color) * self.specular_coefficient * spec_intensity
+            if self.specular_coefficient:
+                diff_color += self.specular(context, sample)
 
             # Accumulate color contributions
-            shaded_color += (diff_color + spec_color) * light.intensity
+            shaded_color += diff_color * sample.intensity
 
         return shaded_color
 
-class CheckerboardMaterial(SimpleMaterial):
+class TextureMaterial(SimpleMaterialWithShadows):
+    # diffuse color from a texture, sampled once per hit
+    def __init__(self, ambient_coefficient: float, diffuse_coefficient: float, texture, specular_coefficient: float = 0, specular_color: Color = Color(0, 0, 0), specular_shininess: float = 32):
+        super().__init__(ambient_coefficient, diffuse_coefficient, Color(0, 0, 0), specular_coefficient, specular_color, specular_shininess)
+        self.texture = texture
+
+    def surface_color(self, hit_record, scene):
+        # footprint of a pixel on the surface, from the angle of a camera
+        # pixel, stretched at grazing angles
+        ray = hit_record.ray
+        cos = abs(hit_record.normal.dot(ray.direction))
+        footprint = hit_record.t * getattr(scene.camera, 'pixel_angle', 0.0) / max(cos, 0.1)
+        return self.texture.sample(hit_record.uv.x, hit_record.uv.y, footprint)
+
+class CheckerboardMaterial(TextureMaterial):
     def __init__(self, ambient_coefficient: float, diffuse_coefficient: float, square_size: float, white_color: Color = Color(1,1,1), black_color: Color = Color(0,0,0)):
-        super().__init__(ambient_coefficient, diffuse_coefficient, Color(0, 0, 0), 0, Color(0,0,0), 32)
-        self.square_size = square_size
-        self.white_color = white_color
-        self.black_color = black_color
-
-    def shade(self, hit_record, scene):
-        shaded_color = Color(0, 0, 0)
-        # Ambient component
-        amb_color = scene.ambient_light * self.ambient_coefficient 
-        for light in scene.lights:
-            light_vector = light.position() - hit_record.point
-
-            # add ambient component once
-            shaded_color += amb_color * light.intensity
-
-            # Shadow check
-            shadow_ray = Ray(hit_record.point + hit_record.normal * CastEpsilon, light_vector.normalize())
-            shadow_hit = scene.hit(shadow_ray)
-            if shadow_hit.hit and shadow_hit.t < light_vector.length():
-                continue  # In shadow, skip this light
-
-            # Diffuse component from checkerboard pattern
-            u = hit_record.uv.x / self.square_size
-            v = hit_record.uv.y / self.square_size
-
-            diffuse_color = self.black_color  # black
-            if (int(math.floor(u)) + int(math.floor(v))) % 2 == 0:
-                diffuse_color = self.white_color  # white
-
-            light_dir = light_vector.normalize()
-            diff_intensity = max(hit_record.normal.dot(light_dir), 0)
-            diff_color = (diffuse_color @ light.color) * (self.diffuse_coefficient * diff_intensity)
-
-            # Accumulate color contributions
-            shaded_color += diff_color * light.intensity
-
-        return shaded_color
+        super().__init__(ambient_coefficient, diffuse_coefficient, CheckerTexture(square_size, white_color, black_color))
 
 class TranslucidMaterial(SimpleMaterial):
     def __init__(self, ambient_coefficient: float, diffuse_coefficient: float, diffuse_color: Color, specular_coefficient: float, specular_color: Color, specular_shininess: float = 32, transmission_coefficient: float = 0.5, refraction_index: float = 1.5):
@@ -136,48 +157,54 @@ class TranslucidMaterial(SimpleMaterial):
         self.transmission_coefficient = transmission_coefficient
         self.refraction_index = refraction_index
 
-    def shade(self, hit_record, scene):
-        # Ambient component
-        shaded_color = scene.ambient_light * self.ambient_coefficient 
-        origin = hit_record.ray.origin
-        view_dir = (origin - hit_record.point).normalize()
+    @property
+    def view_dependent(self):
+        return True
 
+    def refraction(self, context):
         # we assume that outside the object is air with refraction index = 1.0
         # this is a simplification. A more complete implementation would track
         # whether we are inside or outside the object and use the appropriate refraction indices
         eta = 1.0 / self.refraction_index
 
         # We need to handle the case when we are inside the object
-        c = hit_record.normal.dot(view_dir)
-        n = hit_record.normal
-        if c < 0:
-            # we are inside the object
-            # flip normal and adjust eta
-            n = -n
+        n = context.facing_normal
+        c = n.dot(context.view_dir)
+        if context.inside:
+            # we are inside the object: the normal is already flipped,
+            # adjust eta
             eta = 1.0 / eta
-            # we also need to flip c so refraction calculations work correctly
-            c = -c
+        return n, c, eta
 
-        for light in scene.lights:
-            light_vector = light.position() - hit_record.point
+    def secondary_rays(self, hit_record, scene):
+        if hit_record.ray.depth >= scene.max_depth:
+            return []
+        context = ShadingContext.of(hit_record, scene)
+        n, c, eta = self.refraction(context)
+        k = 1 - eta**2 * (1 - c**2)
+        if k < 0: # if k < 0 total internal reflection occurs
+            return []
+        refract_dir =  (-context.view_dir * eta  + n * (eta * c - math.sqrt(k))).normalize()
+        return [Ray(hit_record.point, refract_dir, hit_record.ray.depth + 1)]
+
+    def shade(self, hit_record, scene):
+        context = ShadingContext.of(hit_record, scene)
+        # Ambient component
+        shaded_color = scene.ambient_light * self.ambient_coefficient 
+        n, _, _ = self.refraction(context)
+
+        for sample in context.lights:
             # # Diffuse component
-            light_dir = light_vector.normalize()
-            diff_intensity = max(n.dot(light_dir), 0)
-            shaded_color += (self.diffuse_color @ light.color) * (self.diffuse_coefficient * diff_intensity)*light.intensity
+            diff_intensity = max(n.dot(sample.direction), 0)
+            shaded_color += (self.diffuse_color @ sample.light.color) * (self.diffuse_coefficient * diff_intensity)*sample.intensity
 
             # # Specular component
-            reflect_dir = (n * 2 * n.dot(light_dir) - light_dir).normalize()
-            spec_intensity = max(view_dir.dot(reflect_dir), 0) ** self.specular_shininess
-            shaded_color += (self.specular_color @ light.color) * self.specular_coefficient * spec_intensity*light.intensity
+            shaded_color += self.specular(context, sample) * sample.intensity
 
         transmitted_color = Color(1, 0, 0)
         if hit_record.ray.depth < scene.max_depth:
-            # transmission component
-            k = 1 - eta**2 * (1 - c**2)
-            if k >= 0: # if k < 0 total internal reflection occurs
-                refract_dir =  (-view_dir * eta  + n * (eta * c - math.sqrt(k))).normalize()
-                transmission_ray = Ray(hit_record.point, refract_dir, hit_record.ray.depth + 1)
-                transmission_hit = scene.hit(transmission_ray)
+            # transmission component (no ray on total internal reflection)
+            for transmission_hit in context.secondary_hits():
                 if transmission_hit.hit:
                     transmission_material = transmission_hit.material
                     transmitted_color = transmission_material.shade(transmission_hit, scene) * self.transmission_coefficient
@@ -197,25 +224,27 @@ class MirrorMaterial(Material):
         super().__init__()
         self.reflection_coefficient = reflection_coefficient
 
-    def shade(self, hit_record, scene):
+    def secondary_rays(self, hit_record, scene):
         # profundidad reflejo
         if hit_record.ray.depth >= scene.max_depth:
-            return scene.background * self.reflection_coefficient
+            return []
 
-        incident = hit_record.ray.direction
-        normal = hit_record.normal
-
-        if incident.dot(normal) > 0:
-            normal = -normal
+        context = ShadingContext.of(hit_record, scene)
 
         #  ecuacion reflexion ideal
-        reflect_dir = (incident - normal * 2 * incident.dot(normal)).normalize()
+        reflect_dir = context.reflect_dir
 
         # rayo secundario
-        reflect_origin = hit_record.point + normal * CastEpsilon
-        reflect_ray = Ray(reflect_origin, reflect_dir, hit_record.ray.depth + 1)
-        
-        reflect_hit = scene.hit(reflect_ray)
+        reflect_origin = hit_record.point + context.facing_normal * CastEpsilon
+        return [Ray(reflect_origin, reflect_dir, hit_record.ray.depth + 1)]
+
+    def shade(self, hit_record, scene):
+        # profundidad reflejo
+        if hit_record.ray.depth >= scene.max_depth:
+            return scene.background * self.reflection_coefficient
+
+        context = ShadingContext.of(hit_record, scene)
+        reflect_hit, = context.secondary_hits()
 
         # evaluacion recursiva
         if reflect_hit.hit:
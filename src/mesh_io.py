@@ -0,0 +1,139 @@
+from array import array
+
+import numpy as np
+
+# Streaming OBJ and PLY readers for TriangleMesh.
+#
+# Vertices and triangle indices are accumulated into flat typed arrays
+# (array module or NumPy record reads for binary PLY) and returned as
+# contiguous (N, 3) float64 / (M, 3) int64 NumPy arrays, without building a
+# Python object per vertex. Polygons are triangulated as fans.
+
+def load_mesh(path):
+    if path.lower().endswith('.obj'):
+        return load_obj(path)
+    if path.lower().endswith('.ply'):
+        return load_ply(path)
+    raise ValueError(f"Unsupported mesh format: {path}")
+
+def _pack(vertices, indices):
+    vertices = np.frombuffer(vertices, dtype=np.float64).reshape(-1, 3)
+    indices = np.frombuffer(indices, dtype=np.int64).reshape(-1, 3)
+    return np.ascontiguousarray(vertices), np.ascontiguousarray(indices)
+
+def _add_polygon(indices, polygon):
+    for k in range(1, len(polygon) - 1):
+        indices.extend((polygon[0], polygon[k], polygon[k + 1]))
+
+def load_obj(path):
+    vertices = array('d')
+    indices = array('q')
+    num_vertices = 0
+    with open(path, 'r') as f:
+        for line in f:
+            if line.startswith('v '):
+                x, y, z = line.split()[1:4]
+                vertices.extend((float(x), float(y), float(z)))
+                num_vertices += 1
+            elif line.startswith('f '):
+                polygon = []
+                for token in line.split()[1:]:
+                    # v, v/vt, v//vn or v/vt/vn; negative indices are relative
+                    index = int(token.split('/', 1)[0])
+                    polygon.append(index - 1 if index > 0 else num_vertices + index)
+                _add_polygon(indices, polygon)
+    return _pack(vertices, indices)
+
+_ply_types = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+def _read_ply_header(f):
+    if f.readline().strip() != b'ply':
+        raise ValueError("Not a PLY file")
+    fmt = None
+    elements = []  # [name, count, [(property name, type or (count type, item type))]]
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError("Truncated PLY header")
+        words = line.decode('ascii').split()
+        if not words or words[0] in ('comment', 'obj_info'):
+            continue
+        if words[0] == 'format':
+            fmt = words[1]
+        elif words[0] == 'element':
+            elements.append([words[1], int(words[2]), []])
+        elif words[0] == 'property':
+            if words[1] == 'list':
+                elements[-1][2].append((words[4], (_ply_types[words[2]], _ply_types[words[3]])))
+            else:
+                elements[-1][2].append((words[2], _ply_types[words[1]]))
+        elif words[0] == 'end_header':
+            return fmt, elements
+
+def load_ply(path):
+    with open(path, 'rb') as f:
+        fmt, elements = _read_ply_header(f)
+        if fmt == 'ascii':
+            return _load_ply_ascii(f, elements)
+        endian = '<' if fmt == 'binary_little_endian' else '>'
+        return _load_ply_binary(f, elements, endian)
+
+def _load_ply_ascii(f, elements):
+    vertices = array('d')
+    indices = array('q')
+    for name, count, properties in elements:
+        names = [p[0] for p in properties]
+        for _ in range(count):
+            values = f.readline().split()
+            if name == 'vertex':
+                row = dict(zip(names, values))
+                vertices.extend((float(row['x']), float(row['y']), float(row['z'])))
+            elif name == 'face':
+                # the vertex index list is the first list property
+                n = int(values[0])
+                _add_polygon(indices, [int(v) for v in values[1:n + 1]])
+    return _pack(vertices, indices)
+
+def _load_ply_binary(f, elements, endian):
+    vertices = None
+    indices = array('q')
+    for name, count, properties in elements:
+        if all(not isinstance(t, tuple) for _, t in properties):
+            dtype = np.dtype([(p, endian + t) for p, t in properties])
+            data = np.frombuffer(f.read(dtype.itemsize * count), dtype=dtype, count=count)
+            if name == 'vertex':
+                vertices = np.stack([data['x'], data['y'], data['z']], axis=1).astype(np.float64)
+            continue
+        if name == 'face' and len(properties) == 1:
+            count_type, item_type = properties[0][1]
+            # fast path: all triangles, read as fixed size records
+            dtype = np.dtype([('n', endian + count_type), ('v', endian + item_type, 3)])
+            start = f.tell()
+            data = np.frombuffer(f.read(dtype.itemsize * count), dtype=dtype, count=count)
+            if len(data) == count and np.all(data['n'] == 3):
+                indices = data['v'].astype(np.int64)
+                continue
+            f.seek(start)
+        # general case: variable length lists, one element at a time
+        for _ in range(count):
+            polygon = None
+            for _, t in properties:
+                if isinstance(t, tuple):
+                    count_dtype = np.dtype(endian + t[0])
+                    n = int(np.frombuffer(f.read(count_dtype.itemsize), dtype=count_dtype)[0])
+                    item_dtype = np.dtype(endian + t[1])
+                    items = np.frombuffer(f.read(item_dtype.itemsize * n), dtype=item_dtype)
+                    if polygon is None:
+                        polygon = items.tolist()
+                else:
+                    f.read(np.dtype(t).itemsize)
+            if name == 'face' and polygon is not None:
+                _add_polygon(indices, polygon)
+    if not isinstance(indices, np.ndarray):
+        indices = np.frombuffer(indices, dtype=np.int64).reshape(-1, 3)
+    return np.ascontiguousarray(vertices), np.ascontiguousarray(indices)
@@ -1,6 +1,6 @@
 
 
-from src.base import Shape, HitRecord, CastEpsilon
+from src.base import Shape, HitRecord
 from src.ray import Ray
 from src.vector3d import Vector3D
 
@@ -99,6 +99,7 @@ class ObjectTransform(Shape):
         self.shape = shape
         self.translation = translation
 
+        self.matrix = matrix
         self.inv_matrix = matrix.inverse()
         self.inv_trans_matrix = self.inv_matrix.transpose()
 
@@ -109,7 +110,10 @@ class ObjectTransform(Shape):
         local_direction_raw = self.inv_matrix.multiply_vector(ray.direction)
         direction_magnitude = local_direction_raw.length()
 
-        local_ray = Ray(local_origin, local_direction_raw, ray.depth)
+        # the local ray is normalized again, so local distances are
+        # direction_magnitude times the global ones
+        local_ray = Ray(local_origin, local_direction_raw, ray.depth,
+                        ray.t_min * direction_magnitude, ray.t_max * direction_magnitude)
 
         hit_rec = self.shape.hit(local_ray)
 
@@ -118,11 +122,26 @@ class ObjectTransform(Shape):
 
         t_global = hit_rec.t / direction_magnitude
 
-        if t_global < CastEpsilon:
+        if not ray.t_min <= t_global < ray.t_max:
             return HitRecord(False, float('inf'), None, None)
 
-        global_point = ray.point_at_parameter(t_global)
-        global_normal = self.inv_trans_matrix.multiply_vector(hit_rec.normal).normalize()
-
-        return HitRecord(True, t_global, global_point, global_normal, uv=getattr(hit_rec, 'uv', None))
+        return HitRecord(True, t_global, payload=(local_ray, hit_rec))
+
+    def finalize(self, ray, hit_rec):
+        local_ray, local_hit = hit_rec.payload
+        self.shape.finalize(local_ray, local_hit)
+        hit_rec.point = ray.point_at_parameter(hit_rec.t)
+        hit_rec.normal = self.inv_trans_matrix.multiply_vector(local_hit.normal).normalize()
+        hit_rec.uv = local_hit.uv
+
+    def bounding_box(self):
+        # around the 8 transformed corners of the box of the shape
+        box = self.shape.bounding_box()
+        if box is None:
+            return None
+        lo, hi = box
+        corners = [self.matrix.multiply_vector(Vector3D(x, y, z)) + self.translation
+                   for x in (lo.x, hi.x) for y in (lo.y, hi.y) for z in (lo.z, hi.z)]
+        return (Vector3D(min(c.x for c in corners), min(c.y for c in corners), min(c.z for c in corners)),
+                Vector3D(max(c.x for c in corners), max(c.y for c in corners), max(c.z for c in corners)))
 
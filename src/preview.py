@@ -0,0 +1,262 @@
+import ast
+import os
+import sys
+import time
+import queue
+import socket
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .vector3d import Vector3D
+from .image_io import write_image
+
+# Interactive preview with progressive refinement.
+#
+# The scene is loaded once and rendered by a pool of threads that stays up
+# between edits. Every (re)start first shows a 1/8 resolution image with
+# one sample per 8x8 block, then 1/4, 1/2 and full resolution, and then
+# keeps adding one sample per pixel until max_samples. Each pass rewrites
+# the output image. Rendering can be restricted to a region of interest;
+# pixels outside of it keep their last value.
+#
+# Commands, one per line on stdin or on a local TCP port:
+#   set <path> <value>     e.g. set camera.focal_distance 8
+#                               set lights.0.pos (0, -5, 12)
+#   roi <x0> <y0> <x1> <y1>  render only this rectangle, "roi" alone resets
+#   samples <n>            samples per pixel to refine up to
+#   save <file>            write the current preview to another file
+#   quit
+
+Levels = (8, 4, 2)
+
+def _get(obj, key):
+    if isinstance(obj, list):
+        return obj[int(key)]
+    if key.startswith('_'):
+        raise AttributeError(key)
+    return getattr(obj, key)
+
+def _set(obj, key, value):
+    if isinstance(obj, list):
+        obj[int(key)] = value
+    elif key.startswith('_'):
+        raise AttributeError(key)
+    else:
+        setattr(obj, key, value)
+
+def parse_value(text, old):
+    # Python literal; tuples become vectors (or colors) where one was set
+    value = ast.literal_eval(text)
+    if isinstance(old, Vector3D) and isinstance(value, (tuple, list)):
+        return type(old)(*value)
+    return value
+
+def apply_setting(scene, path, text):
+    # path is a dotted attribute path from the scene, list items by index
+    keys = path.split('.')
+    parent, obj = None, scene
+    for key in keys[:-1]:
+        parent, obj = obj, _get(obj, key)
+    name = keys[-1]
+    if hasattr(obj, 'params') and name in obj.params and parent is not None:
+        # cameras derive their frame from the constructor arguments
+        _set(parent, keys[-2], obj.updated(**{name: parse_value(text, obj.params[name])}))
+    else:
+        old = _get(obj, name)
+        if callable(old):
+            raise TypeError(f"{path} is a method")
+        _set(obj, name, parse_value(text, old))
+
+class Preview:
+    def __init__(self, scene, sample, output, num_jobs=4, max_samples=16, tile_size=16):
+        # sample(scene, i, j, n) -> Color of the n-th sample of pixel (i, j)
+        self.scene = scene
+        self.sample = sample
+        self.output = output
+        self.max_samples = max_samples
+        self.tile_size = tile_size
+        self.executor = ThreadPoolExecutor(num_jobs)
+        self.commands = queue.Queue()
+        self.roi = None
+        self.resize()
+
+    def resize(self):
+        self.width = self.scene.camera.img_width
+        self.height = self.scene.camera.img_height
+        self.display = array('d', bytes(8 * 3 * self.width * self.height))
+        self.reset()
+
+    def reset(self):
+        self.accum = array('d', bytes(8 * 3 * self.width * self.height))
+        self.count = array('i', bytes(4 * self.width * self.height))
+
+    def region(self):
+        # (i0, i1, j0, j1) rows and columns to render
+        if self.roi is None:
+            return 0, self.height, 0, self.width
+        x0, y0, x1, y1 = self.roi
+        return max(0, y0), min(self.height, y1), max(0, x0), min(self.width, x1)
+
+    def passes(self):
+        # (name, pixels) of every refinement pass over the region
+        # coarse levels sample one pixel per block, on a grid shared by all
+        # regions so the samples are reused when the region changes
+        i0, i1, j0, j1 = self.region()
+        if i0 >= i1 or j0 >= j1:
+            return
+        width, count = self.width, self.count
+        for step in Levels:
+            pixels = [(i, j) for i in range(i0 - i0 % step, i1, step) for j in range(j0 - j0 % step, j1, step)
+                      if count[i * width + j] == 0]
+            yield f"1/{step} resolution", pixels
+        while True:
+            samples = min(count[i * width + j] for i in range(i0, i1) for j in range(j0, j1))
+            if samples >= self.max_samples:
+                return
+            pixels = [(i, j) for i in range(i0, i1) for j in range(j0, j1) if count[i * width + j] == samples]
+            yield f"full resolution, sample {samples + 1}", pixels
+
+    def render_pixels(self, pixels):
+        return [(i, j, self.sample(self.scene, i, j, self.count[i * self.width + j])) for i, j in pixels]
+
+    def render_pass(self, pixels):
+        # False if a command arrived before the pass was done
+        tiles = dict()
+        for i, j in pixels:
+            tiles.setdefault((i // self.tile_size, j // self.tile_size), []).append((i, j))
+        pending = {self.executor.submit(self.render_pixels, tile) for tile in tiles.values()}
+        while pending:
+            done, pending = wait(pending, timeout=0.05, return_when=FIRST_COMPLETED)
+            for future in done:
+                for i, j, color in future.result():
+                    k = i * self.width + j
+                    self.accum[3 * k] += color.x
+                    self.accum[3 * k + 1] += color.y
+                    self.accum[3 * k + 2] += color.z
+                    self.count[k] += 1
+            if not self.commands.empty():
+                for future in pending:
+                    future.cancel()
+                # the scene must not change while tiles are still rendering
+                wait(pending)
+                return False
+        return True
+
+    def update_display(self):
+        # own samples where there are some, else the closest coarse level
+        i0, i1, j0, j1 = self.region()
+        width, count, accum, display = self.width, self.count, self.accum, self.display
+        for i in range(i0, i1):
+            for j in range(j0, j1):
+                k = i * width + j
+                if count[k] == 0:
+                    for step in Levels[::-1]:
+                        source = (i - i % step) * width + (j - j % step)
+                        if count[source]:
+                            k = source
+                            break
+                    else:
+                        continue
+                n = count[k]
+                d = 3 * (i * width + j)
+                display[d] = accum[3 * k] / n
+                display[d + 1] = accum[3 * k + 1] / n
+                display[d + 2] = accum[3 * k + 2] / n
+
+    def write(self, path=None):
+        path = path or self.output
+        # write and rename, so image viewers never load half written files
+        root, ext = os.path.splitext(path)
+        tmp = root + '.tmp' + ext
+        write_image(tmp, self.display, self.width, self.height)
+        os.replace(tmp, path)
+
+    def refine(self):
+        # run the passes until done or interrupted; True when done
+        start = time.perf_counter()
+        for name, pixels in self.passes():
+            if not pixels:
+                continue
+            if not self.render_pass(pixels):
+                return False
+            self.update_display()
+            self.write()
+            print(f"{name}: {time.perf_counter() - start:.2f}s", flush=True)
+        return True
+
+    def handle(self, line, reply):
+        # True to quit
+        words = line.split(None, 2)
+        if not words:
+            return False
+        command = words[0]
+        try:
+            if command == 'quit':
+                reply("ok")
+                return True
+            if command == 'set':
+                apply_setting(self.scene, words[1], words[2])
+                self.scene.invalidate_caches()
+                if (self.scene.camera.img_width, self.scene.camera.img_height) != (self.width, self.height):
+                    self.resize()
+                else:
+                    self.reset()
+            elif command == 'roi':
+                values = [int(v) for v in line.split()[1:]]
+                if values and len(values) != 4:
+                    raise ValueError("roi needs x0 y0 x1 y1")
+                self.roi = tuple(values) if values else None
+            elif command == 'samples':
+                self.max_samples = int(words[1])
+            elif command == 'save':
+                self.write(words[1])
+            else:
+                raise ValueError(f"unknown command {command}")
+            reply("ok")
+        except (IndexError, KeyError, AttributeError, TypeError, ValueError, SyntaxError) as e:
+            reply(f"error: {e}")
+        return False
+
+    def read_stdin(self, quit_on_eof):
+        for line in sys.stdin:
+            self.commands.put((line, print))
+        if quit_on_eof:
+            self.commands.put(('quit', lambda text: None))
+
+    def serve_client(self, conn):
+        def reply(text):
+            try:
+                conn.sendall((text + '\n').encode())
+            except OSError:
+                pass
+        with conn, conn.makefile('r') as lines:
+            for line in lines:
+                self.commands.put((line, reply))
+
+    def serve(self, server):
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=self.serve_client, args=(conn,), daemon=True).start()
+
+    def run(self, port=None):
+        if port is not None:
+            # local connections only
+            server = socket.create_server(('localhost', port))
+            print(f"Preview commands on localhost:{server.getsockname()[1]}", flush=True)
+            threading.Thread(target=self.serve, args=(server,), daemon=True).start()
+        threading.Thread(target=self.read_stdin, args=(port is None,), daemon=True).start()
+        try:
+            while True:
+                done = self.refine()
+                if done:
+                    print("Preview done, waiting for commands", flush=True)
+                # a finished preview waits for the next command
+                commands = [self.commands.get()] if done else []
+                while not self.commands.empty():
+                    commands.append(self.commands.get())
+                for line, reply in commands:
+                    if self.handle(line.strip(), reply):
+                        return
+        finally:
+            self.executor.shutdown(cancel_futures=True)
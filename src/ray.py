@@ -1,8 +1,21 @@
+# hits closer than this to the ray origin are self intersections
+CastEpsilon = 1e-4
+
 class Ray:
-    def __init__(self, origin, direction, depth=0):
+    def __init__(self, origin, direction, depth=0, t_min=CastEpsilon, t_max=float('inf')):
         self.origin = origin
         self.direction = direction.normalize()
         self.depth = depth  # for recursion depth if needed
+        # interval of accepted hits; BaseScene.hit shrinks t_max to the
+        # closest hit found so far, so shapes can reject farther ones early
+        self.t_min = t_min
+        self.t_max = t_max
+        # for slab tests: 1 / direction (inf along zero components) and
+        # whether each component is negative
+        d = self.direction
+        inf = float('inf')
+        self.inv_direction = (1.0 / d.x if d.x else inf, 1.0 / d.y if d.y else inf, 1.0 / d.z if d.z else inf)
+        self.sign = (int(d.x < 0), int(d.y < 0), int(d.z < 0))
 
     def point_at_parameter(self, t):
-        return self.origin + self.direction * t
\ No newline at end of file
+        return self.origin + self.direction * t
@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+
+from .vector3d import Vector3D
+
+# Temporal reprojection cache for camera-only animations.
+#
+# Each frame stores, for every pixel whose shading does not depend on the
+# view direction (see Material.view_dependent), the primary hit point, the
+# index of the hit shape and the shaded color. The next frame projects those
+# points into the new camera and reuses the color wherever a single primary
+# ray through the pixel center confirms the same surface is still visible.
+# Everything else (disocclusions, specular pixels) is traced normally.
+
+class ReprojectionCache:
+    def __init__(self, tolerance=1e-2):
+        # maximum distance between the cached point and the new hit point,
+        # relative to the hit distance
+        self.tolerance = tolerance
+        self.points = []
+        self.shape_ids = []
+        self.colors = []
+
+    def add(self, point, shape_id, color):
+        self.points.append((point.x, point.y, point.z))
+        self.shape_ids.append(shape_id)
+        self.colors.append((color.x, color.y, color.z))
+
+    def __len__(self):
+        return len(self.shape_ids)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            np.savez(
+                f,
+                points=np.array(self.points, dtype=np.float64).reshape(-1, 3),
+                shape_ids=np.array(self.shape_ids, dtype=np.int64),
+                colors=np.array(self.colors, dtype=np.float64).reshape(-1, 3),
+                tolerance=np.array(self.tolerance),
+            )
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        data = np.load(path)
+        cache = cls(float(data['tolerance']))
+        cache.points = [tuple(p) for p in data['points'].tolist()]
+        cache.shape_ids = data['shape_ids'].tolist()
+        cache.colors = [tuple(c) for c in data['colors'].tolist()]
+        return cache
+
+    def reproject(self, camera):
+        # splat cached samples into the new image, keeping the nearest one
+        # per pixel (z-buffer)
+        samples = {}
+        depths = {}
+        for point, shape_id, color in zip(self.points, self.shape_ids, self.colors):
+            point = Vector3D(*point)
+            projected = camera.project(point)
+            if projected is None:
+                continue
+            x, y, depth = projected
+            i, j = int(y), int(x)
+            if not (0 <= i < camera.img_height and 0 <= j < camera.img_width):
+                continue
+            if depth < depths.get((i, j), float('inf')):
+                depths[(i, j)] = depth
+                samples[(i, j)] = (point, shape_id, color)
+        return samples
+
+    def validate(self, sample, hit_rec, shape_id):
+        # the cached sample is reusable if the pixel center still sees the
+        # same shape at (almost) the same point
+        point, cached_id, _ = sample
+        if not hit_rec.hit or shape_id != cached_id:
+            return False
+        return (hit_rec.point - point).length() <= self.tolerance * hit_rec.t
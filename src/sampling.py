@@ -0,0 +1,59 @@
+import random
+import threading
+
+# Random number generators for rendering.
+#
+# Every sample of every pixel draws from its own counter based stream: the
+# n-th number of the stream is a hash of (seed, pixel, sample, n), so the
+# image only depends on the seed, never on the number of jobs, the backend
+# or the order in which tiles are rendered. render_pixel starts the stream
+# of each sample with begin(); the camera, the lights and the materials
+# draw from it through rng(), which is per thread so threads rendering
+# tiles of the same scene never share a stream.
+#
+# Outside of a sample (scene setup, tools) rng() falls back to an ordinary
+# per-thread random.Random.
+
+Mask = (1 << 64) - 1
+
+def mix(z):
+    # splitmix64 finalizer
+    z = (z + 0x9E3779B97F4A7C15) & Mask
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & Mask
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & Mask
+    return z ^ (z >> 31)
+
+class SampleStream:
+    def __init__(self, seed, pixel, sample):
+        self.key = mix(mix(mix(seed) ^ pixel) ^ sample)
+        self.counter = 0
+
+    def random(self):
+        # 53 random bits in [0, 1)
+        self.counter += 1
+        return (mix(self.key ^ mix(self.counter)) >> 11) * (1.0 / (1 << 53))
+
+    def uniform(self, a, b):
+        return a + (b - a) * self.random()
+
+_local = threading.local()
+
+def rng():
+    generator = getattr(_local, 'generator', None)
+    if generator is None:
+        generator = _local.generator = random.Random()
+    return generator
+
+def begin(seed, pixel, sample):
+    # the stream of one sample of one pixel, for the calling thread
+    _local.generator = SampleStream(seed, pixel, sample)
+
+def current():
+    # the stream of the calling thread, to continue it later with resume()
+    return rng()
+
+def resume(generator):
+    _local.generator = generator
+
+def seed(value):
+    _local.generator = random.Random(value)
@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import inspect
+import argparse
+import importlib
+from contextlib import contextmanager
+
+from .base import BaseScene, Color
+from .vector3d import Vector3D
+from . import camera, light, materials, object_transform, sdf, shapes, surfaces, textures
+
+# Declarative scene files.
+#
+# A scene file is JSON describing the scene attributes and its objects;
+# bulk arrays live in .npy sidecars next to it and are memory mapped, so a
+# SphereSet of millions of spheres loads without a Python object per
+# sphere (and with an AccelCache, without rebuilding its BVH).
+#
+#   {"format": 1, "name": "...", "max_depth": 4,
+#    "background": {"rgb": [0, 0, 0]}, "ambient_light": {"rgb": [0.1, 0.1, 0.1]},
+#    "camera": {"type": "Camera", "eye": {"vec": [0, -10, 2]}, ...},
+#    "lights": [{"type": "PointLight", "position": {"vec": [...]}, "color": {"rgb": [...]}}],
+#    "defs": {"floor": {"type": "CheckerboardMaterial", ...}},
+#    "objects": [{"shape": {"type": "SphereSet", "centers": {"npy": "centers.npy"},
+#                           "radii": {"npy": "radii.npy"}},
+#                 "material": {"ref": "floor"}}]}
+#
+# Objects are {"type": class name, "args": [positional arguments], other
+# keys are keyword arguments}; "sdf.X" names the SDF nodes. Values tagged
+# {"vec": ...}, {"rgb": ...}, {"npy": path} and {"ref": name of defs}
+# become vectors, colors, arrays and shared objects.
+#
+# Module scenes convert to scene files by recording the constructor
+# arguments of every object while the scene is built:
+#   python -m src.scene_file convert ball_scene ball_scene.json
+#   python -m src.scene_file roundtrip ball_scene
+
+FormatVersion = 1
+
+def _registry():
+    # the classes a scene file may name
+    types = dict()
+    for module in (camera, light, materials, object_transform, shapes, surfaces, textures):
+        for name, cls in vars(module).items():
+            if inspect.isclass(cls) and cls.__module__ == module.__name__ and not name.startswith('_'):
+                types[name] = cls
+    for name, cls in vars(sdf).items():
+        if inspect.isclass(cls) and issubclass(cls, sdf.SDF):
+            types['sdf.' + name] = cls
+    types['SDFShape'] = sdf.SDFShape
+    return types
+
+Types = _registry()
+TypeNames = {cls: name for name, cls in Types.items()}
+
+# loading
+
+def _sphere_set(centers, radii, leaf_size=4, bins=16):
+    # spheres from sidecars go through the cache of SphereSet.from_files
+    paths = [getattr(a, 'filename', None) for a in (centers, radii)]
+    if all(paths):
+        return shapes.SphereSet.from_files(paths[0], paths[1], leaf_size, bins)
+    return shapes.SphereSet(centers, radii, leaf_size, bins)
+
+def _triangle_mesh(vertices=None, indices=None, file=None, leaf_size=4, bins=16):
+    if file is not None:
+        return shapes.TriangleMesh.from_file(file, leaf_size, bins)
+    return shapes.TriangleMesh(vertices, indices, leaf_size, bins)
+
+Factories = {'SphereSet': _sphere_set, 'TriangleMesh': _triangle_mesh}
+
+class SceneLoader:
+    def __init__(self, data, directory):
+        self.data = data
+        self.directory = directory
+        self.defs = dict()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def value(self, v):
+        if isinstance(v, list):
+            return [self.value(item) for item in v]
+        if not isinstance(v, dict):
+            return v
+        if 'vec' in v:
+            return Vector3D(*v['vec'])
+        if 'rgb' in v:
+            return Color(*v['rgb'])
+        if 'npy' in v:
+            import numpy as np
+            return np.load(self.path(v['npy']), mmap_mode='r')
+        if 'ref' in v:
+            name = v['ref']
+            if name not in self.defs:
+                self.defs[name] = self.value(self.data['defs'][name])
+            return self.defs[name]
+        if 'type' in v:
+            return self.object(v)
+        raise ValueError(f"Unknown value in scene file: {v}")
+
+    def object(self, spec):
+        kind = spec['type']
+        if kind not in Types:
+            raise ValueError(f"Unknown type in scene file: {kind}")
+        args = [self.value(a) for a in spec.get('args', [])]
+        kwargs = {k: self.value(v) for k, v in spec.items() if k not in ('type', 'args')}
+        if kind == 'TriangleMesh' and 'file' in kwargs:
+            kwargs['file'] = self.path(kwargs['file'])
+        return Factories.get(kind, Types[kind])(*args, **kwargs)
+
+    def scene(self):
+        data = self.data
+        if data.get('format', FormatVersion) > FormatVersion:
+            raise ValueError(f"Scene file format {data['format']} is newer than this loader")
+        scene = BaseScene(data.get('name', 'Scene'))
+        for attr in ('background', 'ambient_light', 'max_depth'):
+            if attr in data:
+                setattr(scene, attr, self.value(data[attr]))
+        if 'camera' in data:
+            scene.camera = self.value(data['camera'])
+        scene.lights = [self.value(spec) for spec in data.get('lights', [])]
+        for item in data.get('objects', []):
+            scene.add(self.value(item['shape']), self.value(item['material']))
+        return scene
+
+def load_scene(path):
+    with open(path) as f:
+        data = json.load(f)
+    return SceneLoader(data, os.path.dirname(os.path.abspath(path))).scene()
+
+# converting
+
+@contextmanager
+def recording():
+    # objects built inside remember the arguments of their constructor
+    originals = []
+    for cls in set(Types.values()):
+        init = cls.__dict__.get('__init__')
+        if init is None:
+            continue
+
+        def recorded(self, *args, _init=init, **kwargs):
+            # only the outermost constructor, not the super() chain
+            if '_scene_args' not in self.__dict__:
+                self._scene_args = (type(self), args, kwargs)
+            _init(self, *args, **kwargs)
+
+        originals.append((cls, init))
+        cls.__init__ = recorded
+    try:
+        yield
+    finally:
+        for cls, init in originals:
+            cls.__init__ = init
+
+def _flat(value):
+    # scalars, lists of scalars and tagged values stay on one line
+    if isinstance(value, dict):
+        return len(value) == 1 and all(_flat(v) for v in value.values())
+    if isinstance(value, list):
+        return all(not isinstance(v, (dict, list)) for v in value)
+    return True
+
+def _dumps(value, indent=''):
+    if _flat(value):
+        return json.dumps(value)
+    inner = indent + ' '
+    if isinstance(value, dict):
+        items = [f"{inner}{json.dumps(k)}: {_dumps(v, inner)}" for k, v in value.items()]
+        return '{\n' + ',\n'.join(items) + '\n' + indent + '}'
+    return '[\n' + ',\n'.join(inner + _dumps(v, inner) for v in value) + '\n' + indent + ']'
+
+class SceneWriter:
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.stem = os.path.splitext(os.path.basename(path))[0]
+        self.defs = dict()
+        self.names = dict()
+        self.uses = dict()
+        self.sidecars = 0
+
+    def count(self, obj):
+        # how often every object is referenced, to share repeated ones
+        if isinstance(obj, (list, tuple)):
+            for item in obj:
+                self.count(item)
+            return
+        if type(obj) not in TypeNames:
+            return
+        self.uses[id(obj)] = self.uses.get(id(obj), 0) + 1
+        if self.uses[id(obj)] == 1:
+            _, args, kwargs = self.record(obj)
+            self.count(list(args) + list(kwargs.values()))
+
+    def record(self, obj):
+        record = obj.__dict__.get('_scene_args')
+        if record is not None:
+            return record
+        if isinstance(obj, shapes.TriangleMesh):
+            # loaded from a file or the cache, without the constructor
+            return type(obj), (), {'vertices': obj.vertices, 'indices': obj.indices}
+        raise ValueError(f"Cannot convert {type(obj).__name__}: it was not built while recording")
+
+    def sidecar(self, array):
+        import numpy as np
+        name = f"{self.stem}.{self.sidecars}.npy"
+        self.sidecars += 1
+        np.save(os.path.join(self.directory, name), np.ascontiguousarray(array))
+        return {'npy': name}
+
+    def value(self, v):
+        if v is None or isinstance(v, (bool, int, float, str)):
+            return v
+        if type(v) is Vector3D:
+            return {'vec': [v.x, v.y, v.z]}
+        if type(v) is Color:
+            return {'rgb': [v.x, v.y, v.z]}
+        if isinstance(v, (list, tuple)):
+            return [self.value(item) for item in v]
+        if type(v) in TypeNames:
+            if self.uses.get(id(v), 0) > 1:
+                if id(v) not in self.names:
+                    name = f"{TypeNames[type(v)].replace('.', '_').lower()}{len(self.names)}"
+                    self.names[id(v)] = name
+                    self.defs[name] = self.object(v)
+                return {'ref': self.names[id(v)]}
+            return self.object(v)
+        if hasattr(v, '__array__'):
+            return self.sidecar(v)
+        raise ValueError(f"Cannot convert value of type {type(v).__name__}")
+
+    def object(self, obj):
+        cls, args, kwargs = self.record(obj)
+        spec = {'type': TypeNames[cls]}
+        if args:
+            spec['args'] = [self.value(a) for a in args]
+        for k, v in kwargs.items():
+            spec[k] = self.value(v)
+        return spec
+
+    def write(self, scene):
+        self.count([scene.camera] + list(scene.lights) + list(scene.shapes) + list(scene.materials))
+        data = {'format': FormatVersion, 'name': scene.name}
+        for attr in ('background', 'ambient_light', 'max_depth'):
+            if hasattr(scene, attr):
+                data[attr] = self.value(getattr(scene, attr))
+        data['camera'] = self.value(scene.camera)
+        data['lights'] = [self.value(l) for l in scene.lights]
+        data['objects'] = [{'shape': self.value(s), 'material': self.value(m)} for s, m in scene]
+        if self.defs:
+            data['defs'] = self.defs
+        with open(self.path, 'w') as f:
+            f.write(_dumps(data) + '\n')
+
+def convert_module(module_name, path):
+    # build the scene of a module while recording, and write it as a file
+    with recording():
+        scene = importlib.import_module(module_name).Scene()
+    SceneWriter(path).write(scene)
+    return scene
+
+def compare_scenes(a, b, stride=1, seed=0):
+    # pixels (every stride-th row and column) whose colors differ, with
+    # the same random stream per pixel in both scenes
+    from . import sampling
+    differences = 0
+    cam_a, cam_b = a.camera, b.camera
+    for i in range(0, cam_a.img_height, stride):
+        for j in range(0, cam_a.img_width, stride):
+            colors = []
+            for scene, cam in ((a, cam_a), (b, cam_b)):
+                sampling.begin(seed, i * cam.img_width + j, 0)
+                hit_rec = scene.hit(cam.ray(j + 0.5, i + 0.5))
+                color = hit_rec.material.shade(hit_rec, scene) if hit_rec.hit else scene.background
+                colors.append((color.x, color.y, color.z))
+            differences += colors[0] != colors[1]
+    return differences
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert scene modules to scene files")
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert = commands.add_parser('convert', help='Write the scene of a module as a scene file')
+    convert.add_argument('module', help='Scene module, e.g. ball_scene')
+    convert.add_argument('output', help='Scene file to write (.json)')
+    roundtrip = commands.add_parser('roundtrip', help='Convert a module and check that the file renders the same')
+    roundtrip.add_argument('module', help='Scene module, e.g. ball_scene')
+    roundtrip.add_argument('--stride', type=int, help='Compare every stride-th row and column', default=4)
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convert_module(args.module, args.output)
+    else:
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, args.module + '.json')
+            original = convert_module(args.module, path)
+            loaded = load_scene(path)
+        differences = compare_scenes(original, loaded, args.stride)
+        print(f"{args.module}: {differences} differing pixels")
+        sys.exit(1 if differences else 0)
@@ -0,0 +1,66 @@
+import heapq
+
+import numpy as np
+
+# Cost ordered tile scheduler.
+#
+# A cheap low resolution pass measures the cost of one sample every
+# `stride` pixels; the estimates are spread over the pixels they stand for
+# and summed per tile with a summed area table. Tiles are handed out most
+# expensive first, so the long ones start early instead of trailing at the
+# end of the frame. When fewer tiles than workers are left, the most
+# expensive one is split in halves (down to min_size pixels) so idle
+# workers can take part of it.
+
+def upsample_costs(samples, stride, img_height, img_width):
+    # per pixel costs from one estimate every stride pixels
+    costs = np.repeat(np.repeat(samples, stride, axis=0), stride, axis=1)
+    return costs[:img_height, :img_width] / (stride * stride)
+
+class TileScheduler:
+    def __init__(self, tiles, costs, num_workers, min_size=4):
+        self.num_workers = num_workers
+        self.min_size = min_size
+        # summed area table with a zero row and column in front
+        self.table = np.zeros((costs.shape[0] + 1, costs.shape[1] + 1))
+        self.table[1:, 1:] = costs.cumsum(axis=0).cumsum(axis=1)
+        self.heap = []
+        for tile in tiles:
+            self.push(tile)
+        self.splits = 0
+
+    def cost(self, tile):
+        i0, i1, j0, j1 = tile
+        t = self.table
+        return t[i1, j1] - t[i0, j1] - t[i1, j0] + t[i0, j0]
+
+    def push(self, tile):
+        # the tile itself breaks ties, so the order is deterministic
+        heapq.heappush(self.heap, (-self.cost(tile), tuple(tile)))
+
+    def split(self, tile):
+        i0, i1, j0, j1 = tile
+        if max(i1 - i0, j1 - j0) < 2 * self.min_size:
+            return None
+        if i1 - i0 >= j1 - j0:
+            mid = (i0 + i1) // 2
+            return (i0, mid, j0, j1), (mid, i1, j0, j1)
+        mid = (j0 + j1) // 2
+        return (i0, i1, j0, mid), (i0, i1, mid, j1)
+
+    def __len__(self):
+        return len(self.heap)
+
+    def next(self):
+        # most expensive tile, split while the queue runs low; None when done
+        while self.heap:
+            _, tile = heapq.heappop(self.heap)
+            if len(self.heap) + 1 >= self.num_workers:
+                return tile
+            halves = self.split(tile)
+            if halves is None:
+                return tile
+            self.splits += 1
+            for half in halves:
+                self.push(half)
+        return None
@@ -0,0 +1,376 @@
+import math
+
+from .base import Shape, HitRecord
+from .vector3d import Vector3D
+
+# Signed distance field shapes.
+#
+# An SDF is a tree of distance primitives (Sphere, Box, Torus, Cylinder),
+# transforms (Translate, Scale, Repeat) and combinators (Union, SmoothUnion,
+# Intersection, Subtraction). Every node writes its distance once, in
+# _distance(x, y, z, m), against a small math namespace `m`: plain floats
+# use _Scalar, NumPy arrays use the numpy module, so the same formula
+# serves both sphere tracing and baking whole lattices at once.
+# Every node also knows axis aligned bounds of its surface, used to clip
+# rays (and for culling).
+#
+# SDFShape renders an SDF by sphere tracing with tetrahedral normals (4
+# evaluations). GridSDF bakes a complex SDF into a 3D NumPy distance grid
+# with trilinear lookup, so it traces at constant cost per step.
+
+class _Scalar:
+    sqrt = staticmethod(math.sqrt)
+    abs = staticmethod(abs)
+    maximum = staticmethod(max)
+    minimum = staticmethod(min)
+    rint = staticmethod(round)
+
+    @staticmethod
+    def clip(a, lo, hi):
+        return min(max(a, lo), hi)
+
+class SDF:
+    def _distance(self, x, y, z, m):
+        raise NotImplementedError("distance not implemented")
+
+    def bounds(self):
+        # ((min x, y, z), (max x, y, z)) enclosing the surface
+        raise NotImplementedError("bounds not implemented")
+
+    def distance(self, x, y, z):
+        return self._distance(x, y, z, _Scalar)
+
+    def distance_grid(self, x, y, z):
+        # distances at arrays of points
+        import numpy as np
+        return self._distance(x, y, z, np)
+
+def _merge(a, b):
+    return (tuple(map(min, a[0], b[0])), tuple(map(max, a[1], b[1])))
+
+def _expand(bounds, amount):
+    return (tuple(v - amount for v in bounds[0]), tuple(v + amount for v in bounds[1]))
+
+# primitives, centered at the origin
+
+class Sphere(SDF):
+    def __init__(self, radius):
+        self.radius = radius
+
+    def _distance(self, x, y, z, m):
+        return m.sqrt(x * x + y * y + z * z) - self.radius
+
+    def bounds(self):
+        r = self.radius
+        return ((-r, -r, -r), (r, r, r))
+
+class Box(SDF):
+    def __init__(self, size: Vector3D, rounding: float = 0.0):
+        self.half_size = size * 0.5
+        self.rounding = rounding
+
+    def _distance(self, x, y, z, m):
+        r = self.rounding
+        qx = m.abs(x) - self.half_size.x + r
+        qy = m.abs(y) - self.half_size.y + r
+        qz = m.abs(z) - self.half_size.z + r
+        ox, oy, oz = m.maximum(qx, 0.0), m.maximum(qy, 0.0), m.maximum(qz, 0.0)
+        return m.sqrt(ox * ox + oy * oy + oz * oz) + m.minimum(m.maximum(qx, m.maximum(qy, qz)), 0.0) - r
+
+    def bounds(self):
+        h = self.half_size
+        return ((-h.x, -h.y, -h.z), (h.x, h.y, h.z))
+
+class Torus(SDF):
+    # in the xy plane, around the z axis
+    def __init__(self, major_radius, minor_radius):
+        self.major_radius = major_radius
+        self.minor_radius = minor_radius
+
+    def _distance(self, x, y, z, m):
+        q = m.sqrt(x * x + y * y) - self.major_radius
+        return m.sqrt(q * q + z * z) - self.minor_radius
+
+    def bounds(self):
+        r = self.major_radius + self.minor_radius
+        return ((-r, -r, -self.minor_radius), (r, r, self.minor_radius))
+
+class Cylinder(SDF):
+    # capped, along the z axis
+    def __init__(self, radius, height):
+        self.radius = radius
+        self.half_height = height * 0.5
+
+    def _distance(self, x, y, z, m):
+        dr = m.sqrt(x * x + y * y) - self.radius
+        dz = m.abs(z) - self.half_height
+        ox, oz = m.maximum(dr, 0.0), m.maximum(dz, 0.0)
+        return m.minimum(m.maximum(dr, dz), 0.0) + m.sqrt(ox * ox + oz * oz)
+
+    def bounds(self):
+        r, h = self.radius, self.half_height
+        return ((-r, -r, -h), (r, r, h))
+
+# transforms
+
+class Translate(SDF):
+    def __init__(self, sdf, offset: Vector3D):
+        self.sdf = sdf
+        self.offset = offset
+
+    def _distance(self, x, y, z, m):
+        o = self.offset
+        return self.sdf._distance(x - o.x, y - o.y, z - o.z, m)
+
+    def bounds(self):
+        lo, hi = self.sdf.bounds()
+        o = (self.offset.x, self.offset.y, self.offset.z)
+        return (tuple(map(sum, zip(lo, o))), tuple(map(sum, zip(hi, o))))
+
+class Scale(SDF):
+    # uniform, so distances stay exact
+    def __init__(self, sdf, factor):
+        self.sdf = sdf
+        self.factor = factor
+
+    def _distance(self, x, y, z, m):
+        s = self.factor
+        return self.sdf._distance(x / s, y / s, z / s, m) * s
+
+    def bounds(self):
+        lo, hi = self.sdf.bounds()
+        return (tuple(v * self.factor for v in lo), tuple(v * self.factor for v in hi))
+
+class Repeat(SDF):
+    # copies every `spacing` along each axis, `counts` copies to each side
+    # of the original (0 along axes that are not repeated)
+    def __init__(self, sdf, spacing: Vector3D, counts=(1, 1, 1)):
+        self.sdf = sdf
+        self.spacing = spacing
+        self.counts = counts
+
+    def _repeat(self, v, s, c, m):
+        if s == 0 or c == 0:
+            return v
+        return v - s * m.clip(m.rint(v / s), -c, c)
+
+    def _distance(self, x, y, z, m):
+        s, (cx, cy, cz) = self.spacing, self.counts
+        return self.sdf._distance(self._repeat(x, s.x, cx, m), self._repeat(y, s.y, cy, m), self._repeat(z, s.z, cz, m), m)
+
+    def bounds(self):
+        lo, hi = self.sdf.bounds()
+        extent = (self.spacing.x * self.counts[0], self.spacing.y * self.counts[1], self.spacing.z * self.counts[2])
+        return (tuple(v - e for v, e in zip(lo, extent)), tuple(v + e for v, e in zip(hi, extent)))
+
+# combinators
+
+class Union(SDF):
+    def __init__(self, *sdfs):
+        self.sdfs = sdfs
+
+    def _distance(self, x, y, z, m):
+        d = self.sdfs[0]._distance(x, y, z, m)
+        for sdf in self.sdfs[1:]:
+            d = m.minimum(d, sdf._distance(x, y, z, m))
+        return d
+
+    def bounds(self):
+        bounds = self.sdfs[0].bounds()
+        for sdf in self.sdfs[1:]:
+            bounds = _merge(bounds, sdf.bounds())
+        return bounds
+
+class SmoothUnion(SDF):
+    # polynomial smooth minimum with blend radius k
+    def __init__(self, a, b, k):
+        self.a = a
+        self.b = b
+        self.k = k
+
+    def _distance(self, x, y, z, m):
+        da = self.a._distance(x, y, z, m)
+        db = self.b._distance(x, y, z, m)
+        h = m.clip(0.5 + 0.5 * (db - da) / self.k, 0.0, 1.0)
+        return db + (da - db) * h - self.k * h * (1.0 - h)
+
+    def bounds(self):
+        # the blend adds at most k / 4 to the union
+        return _expand(_merge(self.a.bounds(), self.b.bounds()), self.k * 0.25)
+
+class Intersection(SDF):
+    def __init__(self, *sdfs):
+        self.sdfs = sdfs
+
+    def _distance(self, x, y, z, m):
+        d = self.sdfs[0]._distance(x, y, z, m)
+        for sdf in self.sdfs[1:]:
+            d = m.maximum(d, sdf._distance(x, y, z, m))
+        return d
+
+    def bounds(self):
+        los, his = zip(*(sdf.bounds() for sdf in self.sdfs))
+        return (tuple(map(max, *los)), tuple(map(min, *his)))
+
+class Subtraction(SDF):
+    # a with b carved out
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def _distance(self, x, y, z, m):
+        return m.maximum(self.a._distance(x, y, z, m), -self.b._distance(x, y, z, m))
+
+    def bounds(self):
+        return self.a.bounds()
+
+class GridSDF(SDF):
+    # sdf baked on a lattice of resolution points along its longest axis
+    def __init__(self, sdf, resolution: int = 64, padding: float = 0.05):
+        import numpy as np
+        lo, hi = sdf.bounds()
+        extent = max(h - l for l, h in zip(lo, hi))
+        self.cell = extent / (resolution - 1)
+        # a margin of cells around the surface, so lookups near it never
+        # fall outside the grid
+        pad = padding * extent + self.cell
+        self.lo = tuple(v - pad for v in lo)
+        self.counts = tuple(int(math.ceil((h - l + 2 * pad) / self.cell)) + 1 for l, h in zip(lo, hi))
+        self.surface_bounds = (lo, hi)
+        axes = [l + self.cell * np.arange(n) for l, n in zip(self.lo, self.counts)]
+        x, y, z = np.meshgrid(*axes, indexing='ij')
+        self.grid = np.ascontiguousarray(sdf.distance_grid(x, y, z), dtype=np.float64)
+        # flat list for fast scalar lookups
+        self.values = self.grid.ravel().tolist()
+
+    def bounds(self):
+        return self.surface_bounds
+
+    def _cell(self, v, lo, n):
+        # lattice index and fraction, clamped to the grid; and how far
+        # outside of it v was
+        g = (v - lo) / self.cell
+        if g < 0.0:
+            return 0, 0.0, -g * self.cell
+        if g >= n - 1:
+            return n - 2, 1.0, (g - (n - 1)) * self.cell
+        i = int(g)
+        return i, g - i, 0.0
+
+    def distance(self, x, y, z):
+        nx, ny, nz = self.counts
+        i, fx, ex = self._cell(x, self.lo[0], nx)
+        j, fy, ey = self._cell(y, self.lo[1], ny)
+        k, fz, ez = self._cell(z, self.lo[2], nz)
+        v = self.values
+        base = (i * ny + j) * nz + k
+        sy, sx = nz, ny * nz
+        c00 = v[base] + (v[base + sx] - v[base]) * fx
+        c01 = v[base + 1] + (v[base + sx + 1] - v[base + 1]) * fx
+        c10 = v[base + sy] + (v[base + sx + sy] - v[base + sy]) * fx
+        c11 = v[base + sy + 1] + (v[base + sx + sy + 1] - v[base + sy + 1]) * fx
+        c0 = c00 + (c10 - c00) * fy
+        c1 = c01 + (c11 - c01) * fy
+        d = c0 + (c1 - c0) * fz
+        if ex or ey or ez:
+            # outside of the grid: plus the distance to it
+            d += math.sqrt(ex * ex + ey * ey + ez * ez)
+        return d
+
+    def distance_grid(self, x, y, z):
+        import numpy as np
+        nx, ny, nz = self.counts
+        idx, frac = [], []
+        for v, lo, n in ((x, self.lo[0], nx), (y, self.lo[1], ny), (z, self.lo[2], nz)):
+            g = np.clip((np.asarray(v) - lo) / self.cell, 0.0, n - 1)
+            i = np.minimum(g.astype(np.int64), n - 2)
+            idx.append(i)
+            frac.append(g - i)
+        (i, j, k), (fx, fy, fz) = idx, frac
+        g = self.grid
+        c00 = g[i, j, k] + (g[i + 1, j, k] - g[i, j, k]) * fx
+        c01 = g[i, j, k + 1] + (g[i + 1, j, k + 1] - g[i, j, k + 1]) * fx
+        c10 = g[i, j + 1, k] + (g[i + 1, j + 1, k] - g[i, j + 1, k]) * fx
+        c11 = g[i, j + 1, k + 1] + (g[i + 1, j + 1, k + 1] - g[i, j + 1, k + 1]) * fx
+        c0 = c00 + (c10 - c00) * fy
+        c1 = c01 + (c11 - c01) * fy
+        return c0 + (c1 - c0) * fz
+
+    def _distance(self, x, y, z, m):
+        if m is _Scalar:
+            return self.distance(x, y, z)
+        return self.distance_grid(x, y, z)
+
+    def __getstate__(self):
+        # workers rebuild the lookup list from the array
+        state = self.__dict__.copy()
+        del state['values']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.values = self.grid.ravel().tolist()
+
+class SDFShape(Shape):
+    def __init__(self, sdf, max_steps: int = 256, epsilon: float = 1e-5, step_scale: float = 1.0):
+        super().__init__("sdf")
+        self.sdf = sdf
+        self.max_steps = max_steps
+        # distance under which a point counts as on the surface
+        self.epsilon = epsilon
+        # below 1 for fields that overestimate distances (non uniform
+        # deformations, baked grids of very thin features)
+        self.step_scale = step_scale
+        self.lo, self.hi = sdf.bounds()
+
+    def bounding_box(self):
+        return Vector3D(*self.lo), Vector3D(*self.hi)
+
+    def hit(self, ray):
+        ox, oy, oz = ray.origin.x, ray.origin.y, ray.origin.z
+        dx, dy, dz = ray.direction.x, ray.direction.y, ray.direction.z
+
+        # only trace inside the bounds of the surface
+        t_in, t_out = ray.t_min, ray.t_max
+        for o, inv, lo, hi in zip((ox, oy, oz), ray.inv_direction, self.lo, self.hi):
+            t0 = (lo - o) * inv
+            t1 = (hi - o) * inv
+            if t0 != t0 or t1 != t1:
+                # parallel to the slab, on its boundary
+                continue
+            if t0 > t1:
+                t0, t1 = t1, t0
+            t_in = max(t_in, t0)
+            t_out = min(t_out, t1)
+            if t_in > t_out:
+                return HitRecord(False, float('inf'), None, None)
+
+        # sphere tracing; the absolute distance also walks out of the
+        # inside for rays that start within the shape
+        distance = self.sdf.distance
+        t = t_in
+        for _ in range(self.max_steps):
+            d = abs(distance(ox + dx * t, oy + dy * t, oz + dz * t))
+            if d < self.epsilon:
+                return HitRecord(True, t)
+            t += d * self.step_scale
+            if t >= t_out:
+                break
+        return HitRecord(False, float('inf'), None, None)
+
+    def finalize(self, ray, hit_rec):
+        point = ray.point_at_parameter(hit_rec.t)
+        # tetrahedral gradient: 4 evaluations instead of 6
+        h = 1e-4
+        f = self.sdf.distance
+        x, y, z = point.x, point.y, point.z
+        a = f(x + h, y - h, z - h)
+        b = f(x - h, y - h, z + h)
+        c = f(x - h, y + h, z - h)
+        d = f(x + h, y + h, z + h)
+        try:
+            normal = Vector3D(a - b - c + d, -a - b + c + d, -a + b - c + d).normalize()
+        except ValueError:
+            normal = -ray.direction
+        hit_rec.point = point
+        hit_rec.normal = normal
@@ -0,0 +1,236 @@
+from .light import PointLight
+from .ray import Ray, CastEpsilon
+
+# Per hit shading context shared by all materials.
+#
+# Everything a material needs about the hit geometry is computed once here
+# instead of once per light (and once more per material): the view direction
+# taken from the real incoming ray, the view vector reflected about the
+# normal, and per light its direction, distance, attenuated intensity and
+# the (lazily traced) shadow test.
+
+class LightSample:
+    def __init__(self, light_id, light, direction, distance, intensity, cos):
+        self.light_id = light_id
+        self.light = light
+        self.direction = direction  # unit vector from the hit point to the light
+        self.distance = distance
+        self.intensity = intensity
+        self.cos = cos  # N.L with the geometric normal
+        self.shadowed = None  # unknown until a material asks for it
+
+class ShadingContext:
+    def __init__(self, hit_record, scene):
+        self.hit_record = hit_record
+        self.scene = scene
+        self.point = hit_record.point
+        self.normal = hit_record.normal
+        self.incident = hit_record.ray.direction
+        self._lights = None
+        self._reflect_dir = None
+        self._secondary_rays = None
+        # hits of the secondary rays, traced on demand or ahead of shading
+        # (see trace_secondary_rays)
+        self.secondary = None
+
+    @property
+    def view_dir(self):
+        return -self.incident
+
+    @property
+    def inside(self):
+        # whether we hit the surface from behind (e.g. from inside a
+        # translucent object)
+        return self.normal.dot(self.incident) > 0
+
+    @property
+    def facing_normal(self):
+        # the normal facing the incoming ray
+        return -self.normal if self.inside else self.normal
+
+    @property
+    def reflect_dir(self):
+        # view vector reflected about the normal (independent of its sign):
+        # both the mirror direction and the Phong specular lobe axis
+        if self._reflect_dir is None:
+            incident = self.incident
+            self._reflect_dir = incident - self.normal * (2 * incident.dot(self.normal))
+        return self._reflect_dir
+
+    @staticmethod
+    def of(hit_record, scene):
+        # the context of a hit is built once and kept in the hit record, so
+        # a renderer can prepare it (e.g. fill shadow tests) before shading
+        context = hit_record.shading
+        if context is None:
+            context = ShadingContext(hit_record, scene)
+            hit_record.shading = context
+        return context
+
+    @property
+    def lights(self):
+        if self._lights is None:
+            self._lights = []
+            for light_id, light in self.scene.light_grid.lights_at(self.point):
+                light_vector = light.position() - self.point
+                distance = light_vector.length()
+                direction = light_vector / distance
+                self._lights.append(LightSample(light_id, light, direction, distance, light.intensity_at(distance), self.normal.dot(direction)))
+        return self._lights
+
+    @property
+    def secondary_rays(self):
+        if self._secondary_rays is None:
+            self._secondary_rays = self.hit_record.material.secondary_rays(self.hit_record, self.scene)
+        return self._secondary_rays
+
+    def secondary_hits(self):
+        if self.secondary is None:
+            self.secondary = [self.scene.hit(ray) for ray in self.secondary_rays]
+        return self.secondary
+
+    def shadowed(self, sample):
+        if sample.shadowed is None:
+            sample.shadowed = self.trace_shadow(sample)
+        return sample.shadowed
+
+    def trace_shadow(self, sample, occluded=None):
+        # occluded(ray), when given, answers the shadow ray instead of the
+        # whole scene (see trace_shadow_packets)
+        # static point lights can answer from the scene's visibility cache
+        cache = self.scene.visibility_cache if isinstance(sample.light, PointLight) else None
+        if cache is not None:
+            visible = cache.lookup(self.point, sample.light_id)
+            if visible is not None:
+                return not visible
+
+        # only occluders between the point and the light matter
+        shadow_ray = Ray(self.point + self.normal * CastEpsilon, sample.direction, t_max=sample.distance)
+        if occluded is not None:
+            shadowed = occluded(shadow_ray)
+        else:
+            shadowed = self.scene.hit(shadow_ray, finalize=False).hit
+
+        if cache is not None:
+            cache.store(self.point, sample.light_id, not shadowed)
+        return shadowed
+
+def trace_shadow_packets(scene, contexts):
+    # Shadow rays of many hits (e.g. the primary hits of a tile) traced
+    # before shading, one packet per point light. The rays of a packet all
+    # end at the light, so only the objects overlapping the bounding box of
+    # their segments can block them, and neighbouring rays tend to be
+    # blocked by the same object: the last occluder found is tried first.
+    # The results fill sample.shadowed, as the lazy tests would.
+    packets = dict()
+    for context in contexts:
+        for sample in context.lights:
+            if sample.cos > 0 and sample.shadowed is None and isinstance(sample.light, PointLight):
+                packets.setdefault(sample.light_id, []).append((context, sample))
+
+    boxes = scene.object_boxes() if packets else None
+    for packet in packets.values():
+        end = packet[0][1].light.position()
+        lo = [end.x, end.y, end.z]
+        hi = [end.x, end.y, end.z]
+        for context, sample in packet:
+            point = context.point
+            for k, c in enumerate((point.x, point.y, point.z)):
+                lo[k] = min(lo[k], c)
+                hi[k] = max(hi[k], c)
+        # the rays start (and end) CastEpsilon off the surface
+        margin = 2 * CastEpsilon
+        planes = [(1, 0, 0, lo[0] - margin), (0, 1, 0, lo[1] - margin), (0, 0, 1, lo[2] - margin),
+                  (-1, 0, 0, -hi[0] - margin), (0, -1, 0, -hi[1] - margin), (0, 0, -1, -hi[2] - margin)]
+        candidates = scene.cull(planes, boxes)
+        last = []
+
+        def occluded(ray):
+            nonlocal last
+            occluder = scene.occluder_among(ray, last) or scene.occluder_among(ray, candidates)
+            if occluder is not None:
+                last = [occluder]
+            return occluder is not None
+
+        for context, sample in packet:
+            sample.shadowed = context.trace_shadow(sample, occluded)
+
+def _spread_bits(v):
+    # the 10 low bits of v, two zero bits between each
+    v &= 0x3ff
+    v = (v | (v << 16)) & 0x030000ff
+    v = (v | (v << 8)) & 0x0300f00f
+    v = (v | (v << 4)) & 0x030c30c3
+    v = (v | (v << 2)) & 0x09249249
+    return v
+
+def trace_secondary_rays(scene, hit_records, batch_level=3):
+    # Reflection and refraction rays of many hits (e.g. the primary hits of
+    # a tile) traced before shading, one bounce at a time, until no hit
+    # spawns more rays. The rays of a bounce are sorted by direction octant
+    # and by the Morton code of their origin on a 1024^3 grid over the
+    # origins, so rays traced one after the other are close and parallel.
+    # Consecutive rays with the same octant and the same cell of the
+    # 2^batch_level grid form a batch: all of them start inside the box of
+    # their origins and move away from it along the octant, so only objects
+    # on that side of the box can be hit. The hits fill context.secondary,
+    # as the lazy traces of shade() would; the hits found are returned.
+    boxes = None
+    traced = []
+    while hit_records:
+        contexts = []
+        rays = []
+        for hit_rec in hit_records:
+            context = ShadingContext.of(hit_rec, scene)
+            if context.secondary is None and context.secondary_rays:
+                contexts.append(context)
+                rays.extend(context.secondary_rays)
+        if not rays:
+            break
+
+        lo = [min(ray.origin.x for ray in rays), min(ray.origin.y for ray in rays), min(ray.origin.z for ray in rays)]
+        hi = [max(ray.origin.x for ray in rays), max(ray.origin.y for ray in rays), max(ray.origin.z for ray in rays)]
+        scale = [1023.0 / (h - l) if h > l else 0.0 for l, h in zip(lo, hi)]
+        keys = []
+        for n, ray in enumerate(rays):
+            o, d = ray.origin, ray.direction
+            code = (_spread_bits(int((o.x - lo[0]) * scale[0]))
+                    | _spread_bits(int((o.y - lo[1]) * scale[1])) << 1
+                    | _spread_bits(int((o.z - lo[2]) * scale[2])) << 2)
+            octant = (d.x < 0) | (d.y < 0) << 1 | (d.z < 0) << 2
+            keys.append((octant << 30 | code, n))
+        keys.sort()
+
+        if boxes is None:
+            boxes = scene.object_boxes()
+        hits = [None] * len(rays)
+        shift = 3 * (10 - batch_level)
+        start = 0
+        while start < len(keys):
+            batch = keys[start][0] >> shift
+            end = start + 1
+            while end < len(keys) and keys[end][0] >> shift == batch:
+                end += 1
+            origins = [(rays[n].origin.x, rays[n].origin.y, rays[n].origin.z) for _, n in keys[start:end]]
+            # the half spaces ahead of the origins along the octant
+            planes = []
+            for k, axis in enumerate(((1, 0, 0), (0, 1, 0), (0, 0, 1))):
+                coords = [origin[k] for origin in origins]
+                if batch >> (3 * batch_level + k) & 1:
+                    planes.append((-axis[0], -axis[1], -axis[2], -max(coords) - CastEpsilon))
+                else:
+                    planes.append((axis[0], axis[1], axis[2], min(coords) - CastEpsilon))
+            candidates = scene.cull(planes, boxes)
+            for _, n in keys[start:end]:
+                hits[n] = scene.hit_among(rays[n], candidates)
+            start = end
+
+        hit_records = []
+        n = 0
+        for context in contexts:
+            count = len(context.secondary_rays)
+            context.secondary = hits[n:n + count]
+            n += count
+            hit_records.extend(hit_rec for hit_rec in context.secondary if hit_rec.hit)
+        traced.extend(hit_records)
+    return traced
@@ -1,5 +1,7 @@
+from fractions import Fraction
+
 from src.vector3d import Vector3D
-from .base import Shape, HitRecord, CastEpsilon
+from .base import Shape, HitRecord
 
 class Ball(Shape):
     def __init__(self, center, radius):
@@ -17,20 +19,27 @@ class Ball(Shape):
         if discriminant < 0:
             return HitRecord(False, float('inf'), None, None)
         else:
-            hit, point, normal = False, None, None
+            hit = False
             t = (-b - discriminant**0.5) / (2.0 * a)
-            if t > CastEpsilon:
+            if t >= ray.t_max:
+                # both roots are beyond a closer hit
+                return HitRecord(False, float('inf'), None, None)
+            if t > ray.t_min:
                 hit = True
-                point = ray.point_at_parameter(t)
-                normal = (point - self.center).normalize()
             else:
                 t = (-b + discriminant**0.5) / (2.0 * a)
-                if t > CastEpsilon:
+                if ray.t_min < t < ray.t_max:
                     hit = True
-                    point = ray.point_at_parameter(t)
-                    normal = (point - self.center).normalize()
 
-            return HitRecord(hit, t, point, normal)
+            return HitRecord(hit, t)
+
+    def finalize(self, ray, hit_rec):
+        hit_rec.point = ray.point_at_parameter(hit_rec.t)
+        hit_rec.normal = (hit_rec.point - self.center).normalize()
+
+    def bounding_box(self):
+        r = Vector3D(self.radius, self.radius, self.radius)
+        return self.center - r, self.center + r
 
 class Plane(Shape):
     def __init__(self, point, normal):
@@ -42,11 +51,14 @@ class Plane(Shape):
         denom = self.normal.dot(ray.direction)
         if abs(denom) > 1e-6:
             t = (self.point - ray.origin).dot(self.normal) / denom
-            if t >= CastEpsilon:
-                point = ray.point_at_parameter(t)
-                return HitRecord(True, t, point, self.normal)
+            if ray.t_min <= t < ray.t_max:
+                return HitRecord(True, t)
         return HitRecord(False, float('inf'), None, None)
 
+    def finalize(self, ray, hit_rec):
+        hit_rec.point = ray.point_at_parameter(hit_rec.t)
+        hit_rec.normal = self.normal
+
 class PlaneUV(Shape):
     def __init__(self, point, normal, forward_direction):
         super().__init__("plane")
@@ -60,16 +72,20 @@ class PlaneUV(Shape):
         denom = self.normal.dot(ray.direction)
         if abs(denom) > 1e-6:
             t = (self.point - ray.origin).dot(self.normal) / denom
-            if t >= CastEpsilon:
-                point = ray.point_at_parameter(t)
-                # Calculate UV coordinates
-                vec = point - self.point
-                u = vec.dot(self.right_direction)
-                v = vec.dot(self.forward_direction)
-                uv = Vector3D(u, v, 0)
-                return HitRecord(True, t, point, self.normal, uv=uv)
+            if ray.t_min <= t < ray.t_max:
+                return HitRecord(True, t)
         return HitRecord(False, float('inf'), None, None)
 
+    def finalize(self, ray, hit_rec):
+        point = ray.point_at_parameter(hit_rec.t)
+        # Calculate UV coordinates
+        vec = point - self.point
+        u = vec.dot(self.right_direction)
+        v = vec.dot(self.forward_direction)
+        hit_rec.point = point
+        hit_rec.normal = self.normal
+        hit_rec.uv = Vector3D(u, v, 0)
+
 class ImplicitFunction(Shape):
     def __init__(self, function):
         super().__init__("implicit_function")
@@ -88,35 +104,38 @@ class Box(Shape):
 
     def hit(self, ray):
         local_origin = ray.origin - self.center
-        
-        def calc_slab(o_axis, d_axis, half_s):
-            if abs(d_axis) < 1e-6:
-                if abs(o_axis) > half_s:
-                    return float('inf'), float('-inf')
-                return float('-inf'), float('inf')
-            inv_d = 1.0 / d_axis
-            t0 = (-half_s - o_axis) * inv_d
-            t1 = (half_s - o_axis) * inv_d
-            return (t0, t1) if t0 < t1 else (t1, t0)
-
-        tx_close, tx_far = calc_slab(local_origin.x, ray.direction.x, self.half_size.x)
-        ty_close, ty_far = calc_slab(local_origin.y, ray.direction.y, self.half_size.y)
-        tz_close, tz_far = calc_slab(local_origin.z, ray.direction.z, self.half_size.z)
+        ox, oy, oz = local_origin.x, local_origin.y, local_origin.z
+        hx, hy, hz = self.half_size.x, self.half_size.y, self.half_size.z
+        ix, iy, iz = ray.inv_direction
+        sx, sy, sz = ray.sign
+
+        # slabs: the near side is the -half_size face unless the direction
+        # is negative; zero components give +-inf from the inverse
+        tx_close = ((hx if sx else -hx) - ox) * ix
+        tx_far = ((-hx if sx else hx) - ox) * ix
+        ty_close = ((hy if sy else -hy) - oy) * iy
+        ty_far = ((-hy if sy else hy) - oy) * iy
+        tz_close = ((hz if sz else -hz) - oz) * iz
+        tz_far = ((-hz if sz else hz) - oz) * iz
 
         t_close = max(tx_close, ty_close, tz_close)
         t_far = min(tx_far, ty_far, tz_far)
 
-        if t_close > t_far or t_far < CastEpsilon:
+        # nan: parallel to a slab through its boundary
+        if not t_close <= t_far or t_far <= ray.t_min or t_close >= ray.t_max:
             return HitRecord(False, float('inf'), None, None)
 
-        t_hit = t_close if t_close >= CastEpsilon else t_far
-        if t_hit < CastEpsilon:
+        t_hit = t_close if t_close > ray.t_min else t_far
+        if t_hit >= ray.t_max:
             return HitRecord(False, float('inf'), None, None)
+        return HitRecord(True, t_hit)
 
+    def finalize(self, ray, hit_rec):
+        t_hit = hit_rec.t
         global_point = ray.point_at_parameter(t_hit)
         
         # normal
-        local_point = local_origin + ray.direction * t_hit
+        local_point = global_point - self.center
         epsilon = 1e-4
         normal = Vector3D(0, 0, 0)
         if abs(local_point.x + self.half_size.x) < epsilon: normal = Vector3D(-1, 0, 0)
@@ -126,7 +145,11 @@ class Box(Shape):
         elif abs(local_point.z + self.half_size.z) < epsilon: normal = Vector3D(0, 0, -1)
         elif abs(local_point.z - self.half_size.z) < epsilon: normal = Vector3D(0, 0, 1)
 
-        return HitRecord(True, t_hit, global_point, normal)
+        hit_rec.point = global_point
+        hit_rec.normal = normal
+
+    def bounding_box(self):
+        return self.center - self.half_size, self.center + self.half_size
 
 
 
@@ -137,10 +160,15 @@ class Cylinder(Shape):
         self.radius = radius
         self.half_height = height * 0.5
 
+    def bounding_box(self):
+        extent = Vector3D(self.radius, self.radius, self.half_height)
+        return self.center - extent, self.center + extent
+
     def hit(self, ray):
         local_origin = ray.origin - self.center
         
-        t_closest = float('inf')
+        t_closest = ray.t_max
+        t_min = ray.t_min
         hit_normal = None
         has_hit = False
 
@@ -159,48 +187,384 @@ class Cylinder(Shape):
                 
                 # Evaluacion de la primera raiz
                 t0 = (-b - sqrt_d) * inv_2a
-                if CastEpsilon < t0 < t_closest:
+                if t_min < t0 < t_closest:
                     z_proj = oz + t0 * dz
                     if -self.half_height <= z_proj <= self.half_height:
                         t_closest = t0
                         has_hit = True
-                        hit_normal = Vector3D(ox + t0 * dx, oy + t0 * dy, 0).normalize()
+                        hit_normal = 'side'
 
                 # Evaluacion de la segunda raiz
                 if not has_hit:
                     t1 = (-b + sqrt_d) * inv_2a
-                    if CastEpsilon < t1 < t_closest:
+                    if t_min < t1 < t_closest:
                         z_proj = oz + t1 * dz
                         if -self.half_height <= z_proj <= self.half_height:
                             t_closest = t1
                             has_hit = True
-                            hit_normal = Vector3D(ox + t1 * dx, oy + t1 * dy, 0).normalize()
+                            hit_normal = 'side'
 
         if abs(dz) > 1e-6:
             inv_dz = 1.0 / dz
             
             # Tapa inferior 
             t_bottom = (-self.half_height - oz) * inv_dz
-            if CastEpsilon < t_bottom < t_closest:
+            if t_min < t_bottom < t_closest:
                 px = ox + t_bottom * dx
                 py = oy + t_bottom * dy
                 if px**2 + py**2 <= self.radius**2:
                     t_closest = t_bottom
                     has_hit = True
-                    hit_normal = Vector3D(0, 0, -1)
+                    hit_normal = 'bottom'
 
             # Tapa superior
             t_top = (self.half_height - oz) * inv_dz
-            if CastEpsilon < t_top < t_closest:
+            if t_min < t_top < t_closest:
                 px = ox + t_top * dx
                 py = oy + t_top * dy
                 if px**2 + py**2 <= self.radius**2:
                     t_closest = t_top
                     has_hit = True
-                    hit_normal = Vector3D(0, 0, 1)
+                    hit_normal = 'top'
 
         if has_hit:
-            global_point = ray.point_at_parameter(t_closest)
-            return HitRecord(True, t_closest, global_point, hit_normal)
+            # payload: the part of the cylinder that was hit
+            return HitRecord(True, t_closest, payload=hit_normal)
         
         return HitRecord(False, float('inf'), None, None)
+
+    def finalize(self, ray, hit_rec):
+        point = ray.point_at_parameter(hit_rec.t)
+        if hit_rec.payload == 'side':
+            local_point = point - self.center
+            normal = Vector3D(local_point.x, local_point.y, 0).normalize()
+        else:
+            normal = Vector3D(0, 0, -1) if hit_rec.payload == 'bottom' else Vector3D(0, 0, 1)
+        hit_rec.point = point
+        hit_rec.normal = normal
+
+
+class PackedArrays:
+    # Shapes whose data lives in the NumPy arrays named by array_names.
+    # array_source says where the arrays live when they are not private to
+    # this process: (cache directory, key) of an AccelCache entry or a
+    # SharedArrays block.
+    array_names = ()
+    array_source = None
+
+    def set_arrays(self, arrays):
+        import numpy as np
+        for name in self.array_names:
+            setattr(self, name, arrays[name] if isinstance(arrays[name], np.memmap) else np.ascontiguousarray(arrays[name]))
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.array_names}
+
+    def __getstate__(self):
+        # memory mapped or shared arrays travel to worker processes as a
+        # reference to their source, so all workers map the same pages
+        state = self.__dict__.copy()
+        if self.array_source is not None:
+            for name in self.array_names:
+                del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if isinstance(self.array_source, tuple):
+            from .accel_cache import AccelCache
+            directory, key = self.array_source
+            self.set_arrays(AccelCache(directory).load(key))
+        elif self.array_source is not None:
+            self.set_arrays(self.array_source.arrays())
+
+# 1 + 2 gamma(3) of Ize (2013), robust BVH ray traversal: enough for the
+# three roundings of a slab distance
+SlabTolerance = 1.0 + 2 * (3 * 2.0**-53) / (1 - 3 * 2.0**-53)
+
+def _exact_edge(a, b, c, d):
+    # a * b - c * d without rounding in the products (to the nearest float)
+    return float(Fraction(a) * Fraction(b) - Fraction(c) * Fraction(d))
+
+class TriangleMesh(PackedArrays, Shape):
+    # Triangle mesh stored in contiguous NumPy arrays with its own BVH.
+    # Triangles are reordered so that every BVH leaf is a contiguous slice of
+    # tri_data, which holds the vertices v0, v1, v2 of every triangle: the
+    # watertight test below needs the shared vertices themselves, not edges
+    # computed per triangle.
+    # The same mesh can be instanced many times with ObjectTransform.
+    array_names = ('vertices', 'indices', 'node_bounds', 'node_child', 'node_start', 'node_count', 'tri_data')
+
+    def __init__(self, vertices, indices, leaf_size: int = 4, bins: int = 16):
+        super().__init__("triangle_mesh")
+        self.array_source = None
+        # NumPy only loads for scenes that use meshes
+        import numpy as np
+        from .bvh import build_bvh
+        vertices = np.ascontiguousarray(vertices, dtype=np.float64).reshape(-1, 3)
+        indices = np.ascontiguousarray(indices, dtype=np.int64).reshape(-1, 3)
+
+        tri = vertices[indices]  # (M, 3 vertices, 3 coordinates)
+        bvh = build_bvh(tri.min(axis=1), tri.max(axis=1), leaf_size, bins)
+        tri = tri[bvh['order']]
+        self.set_arrays({
+            'vertices': vertices,
+            'indices': indices[bvh['order']],
+            'node_bounds': bvh['node_bounds'],
+            'node_child': bvh['node_child'],
+            'node_start': bvh['node_start'],
+            'node_count': bvh['node_count'],
+            'tri_data': tri.reshape(-1, 9),
+        })
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        mesh = cls.__new__(cls)
+        Shape.__init__(mesh, "triangle_mesh")
+        mesh.array_source = None
+        mesh.set_arrays(arrays)
+        return mesh
+
+    @classmethod
+    def from_file(cls, path, leaf_size: int = 4, bins: int = 16, cache=None):
+        # with an AccelCache (by default from $RAYTRACER_ACCEL_CACHE) the
+        # parsed mesh and its BVH are built once and memory mapped afterwards
+        from .accel_cache import default_cache
+        cache = cache or default_cache()
+        key = None
+        if cache is not None:
+            key = cache.key('mesh', leaf_size, bins, files=[path])
+            arrays = cache.load(key)
+            if arrays is not None:
+                mesh = cls.from_arrays(arrays)
+                mesh.array_source = (cache.directory, key)
+                return mesh
+
+        from .mesh_io import load_mesh
+        vertices, indices = load_mesh(path)
+        mesh = cls(vertices, indices, leaf_size, bins)
+        if cache is not None:
+            mesh.set_arrays(cache.store(key, mesh.arrays()))
+            mesh.array_source = (cache.directory, key)
+        return mesh
+
+    def __len__(self):
+        return len(self.indices)
+
+    def bounding_box(self):
+        x0, y0, z0, x1, y1, z1 = self.node_bounds[0].tolist()
+        return Vector3D(x0, y0, z0), Vector3D(x1, y1, z1)
+
+    def hit(self, ray):
+        ox, oy, oz = ray.origin.x, ray.origin.y, ray.origin.z
+        dx, dy, dz = ray.direction.x, ray.direction.y, ray.direction.z
+        inf = float('inf')
+        ix, iy, iz = ray.inv_direction
+        t_min = ray.t_min
+
+        # watertight ray-triangle test (Woop, Benthin and Wald 2013): the
+        # ray becomes the +z axis after permuting the axes (kz the largest
+        # direction component) and shearing, and the edge functions of a
+        # triangle are 2D cross products of its sheared vertices. A shared
+        # edge gives exactly opposite values in both of its triangles, so
+        # rays through it are never lost between them.
+        d = (dx, dy, dz)
+        kz = max(range(3), key=lambda k: abs(d[k]))
+        kx, ky = (kz + 1) % 3, (kz + 2) % 3
+        if d[kz] < 0.0:
+            # keep the winding of the triangles
+            kx, ky = ky, kx
+        sx, sy, sz = d[kx] / d[kz], d[ky] / d[kz], 1.0 / d[kz]
+        o = (ox, oy, oz)
+        okx, oky, okz = o[kx], o[ky], o[kz]
+
+        t_best = ray.t_max
+        best = None
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            x0, y0, z0, x1, y1, z1 = self.node_bounds[node].tolist()
+
+            # slab test, rejecting nodes behind a closer hit
+            tx0, tx1 = (x0 - ox) * ix, (x1 - ox) * ix
+            ty0, ty1 = (y0 - oy) * iy, (y1 - oy) * iy
+            tz0, tz1 = (z0 - oz) * iz, (z1 - oz) * iz
+            t_near = max(min(tx0, tx1), min(ty0, ty1), min(tz0, tz1))
+            t_far = min(max(tx0, tx1), max(ty0, ty1), max(tz0, tz1))
+            if t_near != t_near or t_far != t_far:
+                # 0 * inf for rays parallel to a slab through its boundary
+                t_near, t_far = -inf, inf
+            # the rounding of the slab distances must not lose hits on the
+            # boundary of a node, e.g. on edges shared with another node
+            t_far *= SlabTolerance
+            if t_near > t_far or t_far < t_min or t_near >= t_best:
+                continue
+
+            child = int(self.node_child[node])
+            if child >= 0:
+                stack.append(child + 1)
+                stack.append(child)
+                continue
+
+            first = int(self.node_start[node])
+            rows = self.tri_data[first:first + int(self.node_count[node])].tolist()
+            for row in rows:
+                # vertices relative to the origin, permuted and sheared
+                az, bz, cz = row[kz] - okz, row[3 + kz] - okz, row[6 + kz] - okz
+                ax, ay = row[kx] - okx - sx * az, row[ky] - oky - sy * az
+                bx, by = row[3 + kx] - okx - sx * bz, row[3 + ky] - oky - sy * bz
+                cx, cy = row[6 + kx] - okx - sx * cz, row[6 + ky] - oky - sy * cz
+
+                # edge functions: the barycentric weights of v0, v1, v2
+                u = cx * by - cy * bx
+                v = ax * cy - ay * cx
+                w = bx * ay - by * ax
+                if u == 0.0 or v == 0.0 or w == 0.0:
+                    # the ray may pass exactly through an edge: the paper
+                    # redoes these in double precision, floats already are,
+                    # so the signs come from the exact products instead
+                    u = _exact_edge(cx, by, cy, bx)
+                    v = _exact_edge(ax, cy, ay, cx)
+                    w = _exact_edge(bx, ay, by, ax)
+                if (u < 0.0 or v < 0.0 or w < 0.0) and (u > 0.0 or v > 0.0 or w > 0.0):
+                    continue
+                det = u + v + w
+                if det == 0.0:
+                    continue
+                t = (u * az + v * bz + w * cz) * sz / det
+                if t_min < t < t_best:
+                    t_best = t
+                    best = (v / det, w / det, row)
+
+        if best is None:
+            return HitRecord(False, float('inf'), None, None)
+        u, v, row = best
+        ax, ay, az, bx, by, bz, cx, cy, cz = row
+        e1x, e1y, e1z = bx - ax, by - ay, bz - az
+        e2x, e2y, e2z = cx - ax, cy - ay, cz - az
+        return HitRecord(True, t_best, payload=(u, v, e1y * e2z - e1z * e2y, e1z * e2x - e1x * e2z, e1x * e2y - e1y * e2x))
+
+    def finalize(self, ray, hit_rec):
+        u, v, nx, ny, nz = hit_rec.payload
+        hit_rec.point = ray.point_at_parameter(hit_rec.t)
+        hit_rec.normal = Vector3D(nx, ny, nz).normalize()
+        hit_rec.uv = Vector3D(u, v, 0)
+
+
+class SphereSet(PackedArrays, Shape):
+    # Many balls in contiguous NumPy arrays with their own BVH, for scenes
+    # with far more spheres than Ball objects can hold. sphere_data holds
+    # center and radius per sphere, reordered like TriangleMesh triangles so
+    # that every BVH leaf is a contiguous slice.
+    array_names = ('sphere_data', 'node_bounds', 'node_child', 'node_start', 'node_count')
+
+    def __init__(self, centers, radii, leaf_size: int = 4, bins: int = 16):
+        super().__init__("sphere_set")
+        self.array_source = None
+        import numpy as np
+        from .bvh import build_bvh
+        centers = np.ascontiguousarray(centers, dtype=np.float64).reshape(-1, 3)
+        radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), (len(centers),))
+
+        extent = radii[:, None]
+        bvh = build_bvh(centers - extent, centers + extent, leaf_size, bins)
+        order = bvh['order']
+        self.set_arrays({
+            'sphere_data': np.concatenate((centers[order], radii[order, None]), axis=1),
+            'node_bounds': bvh['node_bounds'],
+            'node_child': bvh['node_child'],
+            'node_start': bvh['node_start'],
+            'node_count': bvh['node_count'],
+        })
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        spheres = cls.__new__(cls)
+        Shape.__init__(spheres, "sphere_set")
+        spheres.array_source = None
+        spheres.set_arrays(arrays)
+        return spheres
+
+    @classmethod
+    def from_files(cls, centers_path, radii_path, leaf_size: int = 4, bins: int = 16, cache=None):
+        # centers and radii in .npy files; with an AccelCache the packed
+        # spheres and their BVH are built once, like TriangleMesh.from_file
+        import numpy as np
+        from .accel_cache import default_cache
+        cache = cache or default_cache()
+        if cache is not None:
+            key = cache.key('spheres', leaf_size, bins, files=[centers_path, radii_path])
+            arrays = cache.load(key)
+            if arrays is not None:
+                spheres = cls.from_arrays(arrays)
+                spheres.array_source = (cache.directory, key)
+                return spheres
+
+        spheres = cls(np.load(centers_path, mmap_mode='r'), np.load(radii_path, mmap_mode='r'), leaf_size, bins)
+        if cache is not None:
+            spheres.set_arrays(cache.store(key, spheres.arrays()))
+            spheres.array_source = (cache.directory, key)
+        return spheres
+
+    def __len__(self):
+        return len(self.sphere_data)
+
+    def bounding_box(self):
+        x0, y0, z0, x1, y1, z1 = self.node_bounds[0].tolist()
+        return Vector3D(x0, y0, z0), Vector3D(x1, y1, z1)
+
+    def hit(self, ray):
+        ox, oy, oz = ray.origin.x, ray.origin.y, ray.origin.z
+        dx, dy, dz = ray.direction.x, ray.direction.y, ray.direction.z
+        inf = float('inf')
+        ix, iy, iz = ray.inv_direction
+        t_min = ray.t_min
+
+        t_best = ray.t_max
+        best = None
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            x0, y0, z0, x1, y1, z1 = self.node_bounds[node].tolist()
+
+            # slab test, rejecting nodes behind a closer hit
+            tx0, tx1 = (x0 - ox) * ix, (x1 - ox) * ix
+            ty0, ty1 = (y0 - oy) * iy, (y1 - oy) * iy
+            tz0, tz1 = (z0 - oz) * iz, (z1 - oz) * iz
+            t_near = max(min(tx0, tx1), min(ty0, ty1), min(tz0, tz1))
+            t_far = min(max(tx0, tx1), max(ty0, ty1), max(tz0, tz1))
+            if t_near != t_near or t_far != t_far:
+                t_near, t_far = -inf, inf
+            if t_near > t_far or t_far < t_min or t_near >= t_best:
+                continue
+
+            child = int(self.node_child[node])
+            if child >= 0:
+                stack.append(child + 1)
+                stack.append(child)
+                continue
+
+            first = int(self.node_start[node])
+            for cx, cy, cz, r in self.sphere_data[first:first + int(self.node_count[node])].tolist():
+                # the direction is normalized: a = 1
+                sx, sy, sz = ox - cx, oy - cy, oz - cz
+                b = sx * dx + sy * dy + sz * dz
+                discriminant = b * b - (sx * sx + sy * sy + sz * sz - r * r)
+                if discriminant < 0.0:
+                    continue
+                root = discriminant ** 0.5
+                t = -b - root
+                if t <= t_min:
+                    t = -b + root
+                if t_min < t < t_best:
+                    t_best = t
+                    best = (cx, cy, cz)
+
+        if best is None:
+            return HitRecord(False, float('inf'), None, None)
+        return HitRecord(True, t_best, payload=best)
+
+    def finalize(self, ray, hit_rec):
+        point = ray.point_at_parameter(hit_rec.t)
+        hit_rec.point = point
+        hit_rec.normal = (point - Vector3D(*hit_rec.payload)).normalize()
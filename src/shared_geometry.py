@@ -0,0 +1,90 @@
+from multiprocessing import shared_memory
+
+# Read-only geometry buffers shared by all worker processes.
+#
+# Shapes that keep their data in flat NumPy arrays (see TriangleMesh.arrays)
+# can move them into one multiprocessing.shared_memory block owned by the
+# main process. Pickling the shape then only sends the block name and the
+# array layout; every worker attaches to the same physical pages, so worker
+# memory no longer grows with the scene size, and Python refcount updates on
+# the thin per-process wrapper never touch the geometry pages.
+
+Alignment = 64
+
+def _attach(name):
+    try:
+        # do not let worker processes unlink blocks they did not create
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track argument
+        return shared_memory.SharedMemory(name=name)
+
+class SharedArrays:
+    def __init__(self, arrays):
+        # NumPy is only loaded when the scene has array geometry
+        import numpy as np
+        self.layout = []
+        offset = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            self.layout.append((name, array.dtype.str, array.shape, offset))
+            offset += (array.nbytes + Alignment - 1) // Alignment * Alignment
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        self.owner = True
+        for (name, dtype, shape, start), array in zip(self.layout, arrays.values()):
+            np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=start)[...] = array
+
+    def arrays(self):
+        import numpy as np
+        result = dict()
+        for name, dtype, shape, start in self.layout:
+            view = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=start)
+            view.flags.writeable = False
+            result[name] = view
+        return result
+
+    def __getstate__(self):
+        return {'name': self.shm.name, 'layout': self.layout}
+
+    def __setstate__(self, state):
+        self.layout = state['layout']
+        self.shm = _attach(state['name'])
+        self.owner = False
+
+    def close(self):
+        # only the main process removes the block, once rendering is done;
+        # the pages are released when the last mapping goes away
+        if self.owner:
+            self.shm.unlink()
+        try:
+            self.shm.close()
+        except BufferError:
+            # arrays of this process still point into the block
+            pass
+
+def _array_shapes(shape, seen):
+    if id(shape) in seen:
+        return
+    seen.add(id(shape))
+    if hasattr(shape, 'array_names'):
+        yield shape
+    inner = getattr(shape, 'shape', None)
+    if inner is not None:
+        # ObjectTransform and other wrappers
+        yield from _array_shapes(inner, seen)
+
+def share_scene(scene):
+    # move the array geometry of the scene to shared memory; returns the
+    # blocks, to be closed by the caller when the workers are done
+    blocks = []
+    seen = set()
+    for shape in scene.shapes:
+        for array_shape in _array_shapes(shape, seen):
+            if array_shape.array_source is not None:
+                # already memory mapped from the on-disk cache
+                continue
+            block = SharedArrays(array_shape.arrays())
+            array_shape.set_arrays(block.arrays())
+            array_shape.array_source = block
+            blocks.append(block)
+    return blocks
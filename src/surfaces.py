@@ -1,12 +1,104 @@
-from src.base import Shape, HitRecord, CastEpsilon
+from src.base import Shape, HitRecord
 from src.vector3d import Vector3D
 
+class _Interval:
+    # natural interval extension of the arithmetic in evaluate(), over NumPy
+    # arrays of per cell bounds; x * x of the same interval is a tight square
+    def __init__(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+
+    def __add__(self, other):
+        if isinstance(other, _Interval):
+            return _Interval(self.lo + other.lo, self.hi + other.hi)
+        return _Interval(self.lo + other, self.hi + other)
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return _Interval(-self.hi, -self.lo)
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __rsub__(self, other):
+        return (-self) + other
+
+    def __mul__(self, other):
+        import numpy as np
+        if other is self:
+            lo2, hi2 = self.lo * self.lo, self.hi * self.hi
+            lo = np.where((self.lo <= 0) & (self.hi >= 0), 0.0, np.minimum(lo2, hi2))
+            return _Interval(lo, np.maximum(lo2, hi2))
+        if not isinstance(other, _Interval):
+            if other >= 0:
+                return _Interval(self.lo * other, self.hi * other)
+            return _Interval(self.hi * other, self.lo * other)
+        products = (self.lo * other.lo, self.lo * other.hi, self.hi * other.lo, self.hi * other.hi)
+        return _Interval(np.minimum.reduce(products), np.maximum.reduce(products))
+
+    __rmul__ = __mul__
+
 class AlgebraicSurface(Shape):
-    def __init__(self, bounds: Vector3D, step_size: float = 0.05, max_bisection_steps: int = 20):
+    # With grid_resolution, the bounds are split into that many cells per
+    # axis and hit() only marches the cells that can contain the surface,
+    # walking the grid with a 3D-DDA. Cells are classified once, either by
+    # evaluating the surface over each cell with interval arithmetic (exact,
+    # when evaluate() only adds and multiplies) or else by sign changes
+    # between the cell corners, grown by one cell. The occupancy is cached
+    # in the AccelCache when there is one.
+    def __init__(self, bounds: Vector3D, step_size: float = 0.05, max_bisection_steps: int = 20,
+                 grid_resolution: int = None):
         super().__init__("algebraic_surface")
         self.bounds = bounds 
         self.step_size = step_size
         self.max_bisection_steps = max_bisection_steps
+        self.grid_resolution = grid_resolution
+        # flat bytes, 1 for candidate cells; built on the first hit
+        self.occupancy = None
+
+    def occupancy_key(self, cache):
+        # the formula, the grid and the plain parameters of the surface
+        code = type(self).evaluate.__code__
+        params = sorted((k, v) for k, v in vars(self).items() if isinstance(v, (int, float, str)))
+        bounds = (self.bounds.x, self.bounds.y, self.bounds.z)
+        return cache.key('algebraic', type(self).__qualname__, code.co_code, code.co_consts, bounds, params)
+
+    def build_occupancy(self):
+        import numpy as np
+        from .accel_cache import default_cache
+        cache = default_cache()
+        if cache is not None:
+            key = self.occupancy_key(cache)
+            arrays = cache.load(key)
+            if arrays is not None:
+                self.occupancy = arrays['occupancy'].tobytes()
+                return self.occupancy
+
+        n = self.grid_resolution
+        axes = [np.linspace(-b, b, n + 1) for b in (self.bounds.x, self.bounds.y, self.bounds.z)]
+        try:
+            lo = np.meshgrid(*(a[:-1] for a in axes), indexing='ij')
+            hi = np.meshgrid(*(a[1:] for a in axes), indexing='ij')
+            f = self.evaluate(Vector3D(*(_Interval(l, h) for l, h in zip(lo, hi))))
+            occupancy = (f.lo <= 0) & (f.hi >= 0)
+        except (TypeError, AttributeError):
+            # evaluate() does more than arithmetic: sign changes at the corners
+            f = self.evaluate(Vector3D(*np.meshgrid(*axes, indexing='ij')))
+            positive = f > 0
+            corners = [positive[i:i + n, j:j + n, k:k + n] for i in (0, 1) for j in (0, 1) for k in (0, 1)]
+            occupancy = np.logical_or.reduce(corners) & ~np.logical_and.reduce(corners)
+            padded = np.pad(occupancy, 1)
+            occupancy = np.logical_or.reduce([padded[i:i + n, j:j + n, k:k + n]
+                                              for i in range(3) for j in range(3) for k in range(3)])
+        occupancy = np.ascontiguousarray(occupancy, dtype=np.uint8)
+        if cache is not None:
+            cache.store(key, {'occupancy': occupancy})
+        self.occupancy = occupancy.tobytes()
+        return self.occupancy
+
+    def bounding_box(self):
+        return -self.bounds, self.bounds
 
     def evaluate(self, point: Vector3D) -> float:
         raise NotImplementedError("Subclases deben implementar la función de nivel cero.")
@@ -23,14 +115,13 @@ class AlgebraicSurface(Shape):
         t_max = float('inf')
 
         axes = [
-            (ray.origin.x, ray.direction.x, self.bounds.x),
-            (ray.origin.y, ray.direction.y, self.bounds.y),
-            (ray.origin.z, ray.direction.z, self.bounds.z)
+            (ray.origin.x, ray.direction.x, ray.inv_direction[0], self.bounds.x),
+            (ray.origin.y, ray.direction.y, ray.inv_direction[1], self.bounds.y),
+            (ray.origin.z, ray.direction.z, ray.inv_direction[2], self.bounds.z)
         ]
 
-        for o, d, bound in axes:
+        for o, d, inv_d, bound in axes:
             if abs(d) > 1e-6:
-                inv_d = 1.0 / d
                 t0 = (-bound - o) * inv_d
                 t1 = (bound - o) * inv_d
                 if t0 > t1:
@@ -43,16 +134,75 @@ class AlgebraicSurface(Shape):
             elif abs(o) > bound:
                 return HitRecord(False, float('inf'), None, None)
 
-        if t_max < CastEpsilon:
+        # march only the part of the ray interval inside the bounds, never
+        # past a closer hit
+        t_in = max(t_min, ray.t_min)
+        t_out = min(t_max, ray.t_max)
+        if t_in >= t_out:
             return HitRecord(False, float('inf'), None, None)
 
-        t_in = max(t_min, CastEpsilon)
-        t_out = t_max
+        occupancy = self.occupancy
+        if occupancy is None and self.grid_resolution:
+            occupancy = self.build_occupancy()
+        if occupancy is None:
+            return self.march(ray, t_in, t_out, t_out)
+        return self.march_grid(ray, occupancy, t_in, t_out)
+
+    def march_grid(self, ray, occupancy, t_in, t_out):
+        # 3D-DDA over the cells crossed by [t_in, t_out], marching each run
+        # of consecutive candidate cells
+        n = self.grid_resolution
+        cells = []
+        for o, d, inv_d, bound in ((ray.origin.x, ray.direction.x, ray.inv_direction[0], self.bounds.x),
+                                   (ray.origin.y, ray.direction.y, ray.inv_direction[1], self.bounds.y),
+                                   (ray.origin.z, ray.direction.z, ray.inv_direction[2], self.bounds.z)):
+            size = 2.0 * bound / n
+            i = min(max(int((o + d * t_in + bound) / size), 0), n - 1)
+            if d > 0:
+                cells.append([i, 1, (-bound + (i + 1) * size - o) * inv_d, size * inv_d])
+            elif d < 0:
+                cells.append([i, -1, (-bound + i * size - o) * inv_d, -size * inv_d])
+            else:
+                cells.append([i, 0, float('inf'), float('inf')])
+        x, y, z = cells
+
+        t = t_in
+        run_start = None
+        while True:
+            t_exit = min(x[2], y[2], z[2])
+            if occupancy[(x[0] * n + y[0]) * n + z[0]]:
+                if run_start is None:
+                    run_start = t
+            elif run_start is not None:
+                hit_rec = self.march_run(ray, run_start, t, t_in, t_out)
+                if hit_rec.hit:
+                    return hit_rec
+                run_start = None
+            if t_exit >= t_out:
+                break
+            axis = x if t_exit == x[2] else y if t_exit == y[2] else z
+            axis[0] += axis[1]
+            if not 0 <= axis[0] < n:
+                break
+            axis[2] += axis[3]
+            t = t_exit
+
+        if run_start is not None:
+            return self.march_run(ray, run_start, t_out, t_in, t_out)
+        return HitRecord(False, float('inf'), None, None)
+
+    def march_run(self, ray, run_start, run_end, t_in, t_out):
+        # march from the step of the whole interval at or before the run, so
+        # the samples are those of a march without the grid
+        steps = int((run_start - t_in) / self.step_size)
+        return self.march(ray, t_in + steps * self.step_size, run_end, t_out)
 
-        t_current = t_in
+    def march(self, ray, t_start, t_stop, t_out):
+        # fixed steps from t_start until past t_stop, never past t_out
+        t_current = t_start
         f_current = self.evaluate(ray.point_at_parameter(t_current))
 
-        while t_current < t_out:
+        while t_current < t_stop:
             t_next = t_current + self.step_size
             if t_next > t_out:
                 t_next = t_out
@@ -75,26 +225,28 @@ class AlgebraicSurface(Shape):
                         t_a = t_mid
                         f_current = f_mid
 
-                t_hit = t_a
-                hit_point = ray.point_at_parameter(t_hit)
-                normal_vec = self.gradient(hit_point)
-
-                try:
-                    hit_normal = normal_vec.normalize()
-                except ValueError:
-                    return HitRecord(False, float('inf'), None, None)
-
-                return HitRecord(True, t_hit, hit_point, hit_normal)
+                return HitRecord(True, t_a)
 
             t_current = t_next
             f_current = f_next
 
         return HitRecord(False, float('inf'), None, None)
 
+    def finalize(self, ray, hit_rec):
+        # the six evaluations of the gradient only for the closest hit
+        hit_point = ray.point_at_parameter(hit_rec.t)
+        try:
+            hit_normal = self.gradient(hit_point).normalize()
+        except ValueError:
+            # singular point of the surface: face the ray
+            hit_normal = -ray.direction
+        hit_rec.point = hit_point
+        hit_rec.normal = hit_normal
+
 
 class MitchelSurface(AlgebraicSurface):
-    def __init__(self):
-        super().__init__(bounds=Vector3D(2.5, 2.5, 2.5), step_size=0.02)
+    def __init__(self, grid_resolution: int = 32):
+        super().__init__(bounds=Vector3D(2.5, 2.5, 2.5), step_size=0.02, grid_resolution=grid_resolution)
 
     def evaluate(self, p: Vector3D) -> float:
         x2 = p.x * p.x
@@ -108,8 +260,8 @@ class MitchelSurface(AlgebraicSurface):
 
 
 class HeartSurface(AlgebraicSurface):
-    def __init__(self):
-        super().__init__(bounds=Vector3D(1.5, 1.5, 1.5), step_size=0.02)
+    def __init__(self, grid_resolution: int = 32):
+        super().__init__(bounds=Vector3D(1.5, 1.5, 1.5), step_size=0.02, grid_resolution=grid_resolution)
 
     def evaluate(self, p: Vector3D) -> float:
         x2 = p.x * p.x
@@ -0,0 +1,209 @@
+import math
+
+from .base import Color
+
+# Textures: colors as a function of the uv coordinates of a hit.
+#
+# sample(u, v, footprint) returns the Color at one point; footprint is the
+# size of a pixel in uv units at the hit (see TextureMaterial), used to pick
+# a mip level. evaluate(u, v) does the same over NumPy arrays of uv's,
+# returning an array of shape u.shape + (3,), for renderers that shade
+# many hits at once. Procedural textures compute both with the same
+# formulas, so they agree exactly.
+#
+# ImageTexture keeps a pyramid of mip levels; with an AccelCache the levels
+# live in memory mapped .npy files, so only the texels that are read are
+# paged in, and distant surfaces only touch the small levels.
+
+def _rgb(color):
+    return (color.x, color.y, color.z)
+
+class Texture:
+    def sample(self, u, v, footprint=0.0):
+        raise NotImplementedError("sample not implemented")
+
+    def evaluate(self, u, v, footprint=0.0):
+        raise NotImplementedError("evaluate not implemented")
+
+class CheckerTexture(Texture):
+    def __init__(self, square_size: float, white_color: Color = Color(1, 1, 1), black_color: Color = Color(0, 0, 0)):
+        self.square_size = square_size
+        self.white_color = white_color
+        self.black_color = black_color
+
+    def sample(self, u, v, footprint=0.0):
+        u = u / self.square_size
+        v = v / self.square_size
+        if (int(math.floor(u)) + int(math.floor(v))) % 2 == 0:
+            return self.white_color
+        return self.black_color
+
+    def evaluate(self, u, v, footprint=0.0):
+        import numpy as np
+        even = (np.floor(np.asarray(u) / self.square_size) + np.floor(np.asarray(v) / self.square_size)) % 2 == 0
+        return np.where(even[..., None], _rgb(self.white_color), _rgb(self.black_color))
+
+class StripeTexture(Texture):
+    # stripes across u, or across v with along_u=False
+    def __init__(self, width: float, color_a: Color, color_b: Color, along_u: bool = True):
+        self.width = width
+        self.color_a = color_a
+        self.color_b = color_b
+        self.along_u = along_u
+
+    def sample(self, u, v, footprint=0.0):
+        s = u if self.along_u else v
+        return self.color_a if int(math.floor(s / self.width)) % 2 == 0 else self.color_b
+
+    def evaluate(self, u, v, footprint=0.0):
+        import numpy as np
+        s = np.asarray(u if self.along_u else v)
+        even = np.floor(s / self.width) % 2 == 0
+        return np.where(even[..., None], _rgb(self.color_a), _rgb(self.color_b))
+
+Mask32 = 0xffffffff
+
+def _lattice(i, j, seed):
+    # value in [0, 1) of a lattice point, the same for Python ints and
+    # int64 arrays
+    h = (i * 0x27d4eb2d ^ j * 0x165667b1 ^ seed * 0x9e3779b1) & Mask32
+    h = ((h ^ (h >> 15)) * 0x2c1b3c6d) & Mask32
+    h = ((h ^ (h >> 12)) * 0x297a2d39) & Mask32
+    return (h ^ (h >> 15)) * (1.0 / (1 << 32))
+
+class NoiseTexture(Texture):
+    # fractal value noise blending two colors; scale is the size of the
+    # coarsest features in uv units
+    def __init__(self, scale: float, color_a: Color, color_b: Color, octaves: int = 4, seed: int = 0):
+        self.scale = scale
+        self.color_a = color_a
+        self.color_b = color_b
+        self.octaves = octaves
+        self.seed = seed
+
+    def noise(self, u, v, floor):
+        # in [0, 1]; floor is math.floor or an array version returning ints
+        total, amplitude, norm = 0.0, 1.0, 0.0
+        x, y = u / self.scale, v / self.scale
+        for octave in range(self.octaves):
+            i, j = floor(x), floor(y)
+            fx, fy = x - i, y - j
+            sx, sy = fx * fx * (3.0 - 2.0 * fx), fy * fy * (3.0 - 2.0 * fy)
+            seed = self.seed + octave
+            a = _lattice(i, j, seed)
+            b = _lattice(i + 1, j, seed)
+            c = _lattice(i, j + 1, seed)
+            d = _lattice(i + 1, j + 1, seed)
+            top = a + (b - a) * sx
+            bottom = c + (d - c) * sx
+            total = total + (top + (bottom - top) * sy) * amplitude
+            norm += amplitude
+            amplitude *= 0.5
+            x, y = x * 2.0, y * 2.0
+        return total / norm
+
+    def sample(self, u, v, footprint=0.0):
+        n = self.noise(u, v, math.floor)
+        return self.color_a + (self.color_b - self.color_a) * n
+
+    def evaluate(self, u, v, footprint=0.0):
+        import numpy as np
+        n = self.noise(np.asarray(u, dtype=np.float64), np.asarray(v, dtype=np.float64),
+                       lambda a: np.floor(a).astype(np.int64))
+        a, b = np.array(_rgb(self.color_a)), np.array(_rgb(self.color_b))
+        return a + (b - a) * n[..., None]
+
+class ImageTexture(Texture):
+    # an image (any format read_image reads, or an .npy array of shape
+    # (height, width, 3) with values in [0, 1], rows from the bottom)
+    # repeated every `size` uv units
+    def __init__(self, path: str, size: float = 1.0, cache=None):
+        from .accel_cache import default_cache
+        self.path = path
+        self.size = size
+        cache = cache or default_cache()
+        # (cache directory, key) of the memory mapped levels
+        self.array_source = None
+        if cache is not None:
+            key = cache.key('texture', files=[path])
+            arrays = cache.load(key)
+            if arrays is None:
+                arrays = cache.store(key, self.build_levels())
+            self.array_source = (cache.directory, key)
+        else:
+            arrays = self.build_levels()
+        self.set_levels(arrays)
+
+    def set_levels(self, arrays):
+        self.levels = [arrays[f'level{k}'] for k in range(len(arrays))]
+
+    def __getstate__(self):
+        # workers map the cached levels instead of receiving copies
+        state = self.__dict__.copy()
+        if self.array_source is not None:
+            del state['levels']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.array_source is not None:
+            from .accel_cache import AccelCache
+            directory, key = self.array_source
+            self.set_levels(AccelCache(directory).load(key))
+
+    def build_levels(self):
+        # the full image then halves, box filtered, down to 1x1
+        import numpy as np
+        from .image_io import read_image
+        if self.path.endswith('.npy'):
+            image = np.load(self.path, mmap_mode='r')
+        else:
+            pixels, width, height = read_image(self.path)
+            image = np.asarray(pixels, dtype=np.float32).reshape(height, width, 3)
+        levels = {'level0': np.asarray(image, dtype=np.float32)}
+        level = levels['level0']
+        while level.shape[0] > 1 or level.shape[1] > 1:
+            # odd sizes drop their last row or column
+            h, w = max(level.shape[0] // 2, 1), max(level.shape[1] // 2, 1)
+            rows = level[:2 * h] if level.shape[0] > 1 else level
+            rows = rows.reshape(h, -1, level.shape[1], 3).mean(axis=1)
+            cols = rows[:, :2 * w] if level.shape[1] > 1 else rows
+            level = np.ascontiguousarray(cols.reshape(h, w, -1, 3).mean(axis=2), dtype=np.float32)
+            levels[f'level{len(levels)}'] = level
+        return levels
+
+    def level_for(self, footprint):
+        # the level where a texel is about as large as the footprint
+        texels = footprint / self.size * self.levels[0].shape[1]
+        if texels <= 1.0:
+            return 0
+        return min(int(math.log2(texels) + 0.5), len(self.levels) - 1)
+
+    def sample(self, u, v, footprint=0.0):
+        # bilinear within the chosen level, wrapping around
+        level = self.levels[self.level_for(footprint)]
+        h, w = level.shape[0], level.shape[1]
+        x = (u / self.size) % 1.0 * w - 0.5
+        y = (v / self.size) % 1.0 * h - 0.5
+        i0, j0 = math.floor(y), math.floor(x)
+        fy, fx = y - i0, x - j0
+        i0, j0 = i0 % h, j0 % w
+        i1, j1 = (i0 + 1) % h, (j0 + 1) % w
+        a, b = level[i0, j0].tolist(), level[i0, j1].tolist()
+        c, d = level[i1, j0].tolist(), level[i1, j1].tolist()
+        rgb = [(a[k] + (b[k] - a[k]) * fx) * (1.0 - fy) + (c[k] + (d[k] - c[k]) * fx) * fy for k in range(3)]
+        return Color(*rgb)
+
+    def evaluate(self, u, v, footprint=0.0):
+        import numpy as np
+        level = self.levels[self.level_for(footprint)]
+        h, w = level.shape[0], level.shape[1]
+        x = np.asarray(u, dtype=np.float64) / self.size % 1.0 * w - 0.5
+        y = np.asarray(v, dtype=np.float64) / self.size % 1.0 * h - 0.5
+        i0, j0 = np.floor(y), np.floor(x)
+        fy, fx = (y - i0)[..., None], (x - j0)[..., None]
+        i0, j0 = i0.astype(np.int64) % h, j0.astype(np.int64) % w
+        i1, j1 = (i0 + 1) % h, (j0 + 1) % w
+        top = level[i0, j0] + (level[i0, j1] - level[i0, j0]) * fx
+        bottom = level[i1, j0] + (level[i1, j1] - level[i1, j0]) * fx
+        return top + (bottom - top) * fy
@@ -0,0 +1,57 @@
+import math
+from collections import OrderedDict
+
+# Shadow ray cache for static point lights.
+#
+# Hit points are quantized to cells of size `tolerance` and the visibility
+# of each light is remembered per (light, cell). Neighbouring samples of the
+# same pixel (or of nearby pixels) land in the same cell and reuse the answer
+# instead of tracing a new shadow ray. The cache is bounded: once it holds
+# `max_entries` results the least recently used one is dropped.
+# Area lights sample a different position on every call, so they must keep
+# tracing real shadow rays.
+
+class VisibilityCache:
+    def __init__(self, tolerance=1e-2, max_entries=100000):
+        self.tolerance = tolerance
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, point, light_id):
+        inv = 1.0 / self.tolerance
+        return (light_id, math.floor(point.x * inv), math.floor(point.y * inv), math.floor(point.z * inv))
+
+    def lookup(self, point, light_id):
+        # returns True (visible), False (in shadow) or None if not cached
+        key = self.key(point, light_id)
+        visible = self.entries.get(key)
+        if visible is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            self.entries.move_to_end(key)
+        except KeyError:
+            # evicted meanwhile by another rendering thread
+            pass
+        return visible
+
+    def store(self, point, light_id, visible):
+        self.entries[self.key(point, light_id)] = visible
+        if len(self.entries) > self.max_entries:
+            try:
+                self.entries.popitem(last=False)
+            except KeyError:
+                pass
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = 100.0 * self.hits / total if total else 0.0
+        return f"Visibility cache: {self.hits} hits, {self.misses} misses ({rate:.1f}% hit rate), {len(self.entries)} entries"